@@ -27,7 +27,8 @@ import html
 import logging
 import os
 import traceback
-from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
+from typing import (Any, Callable, Dict, List, Optional, Tuple,
+                    TYPE_CHECKING)
 
 from cardinal_pythonlib.rnc_datetime import (
     coerce_to_date,
@@ -238,6 +239,54 @@ class AlterMethod(object):
             # Modifies other alter methods; doesn't do anything itself
             return value, True
 
+    def get_alter_func(
+            self,
+            ddr: "DataDictionaryRow",
+            ddrows: List["DataDictionaryRow"]) -> Callable[
+                [Any, List[Any], Optional["Patient"]], Tuple[Any, bool]]:
+        """
+        Returns a function that does the same as alter() for this data
+        dictionary row (and list of rows), taking (value, row, patient), with
+        the choice of alteration made in advance rather than for every value.
+        """
+        if self.scrub:
+            scrub_func = self._scrub_func
+            return lambda value, row, patient: (scrub_func(value, patient),
+                                                False)
+
+        if self.truncate_date:
+            truncate_date_func = self._truncate_date_func
+            return lambda value, row, patient: (truncate_date_func(value),
+                                                False)
+
+        if self.extract_text:
+            skip_if_fails = ddr.skip_row_if_extract_text_fails()
+
+            def extract(value: Any, row: List[Any],
+                        patient: Optional["Patient"]) -> Tuple[Any, bool]:
+                value, extracted = self._extract_text_func(value, row, ddrows)
+                if not extracted and skip_if_fails:
+                    log.debug("Skipping row as text extraction failed")
+                    return None, True
+                return value, False
+
+            return extract
+
+        if self.hash:
+            assert self.hasher is not None
+            hasher = self.hasher
+            return lambda value, row, patient: (hasher.hash(value), False)
+
+        if self.html_unescape:
+            return lambda value, row, patient: (html.unescape(value), False)
+
+        if self.html_untag:
+            html_untag_func = self._html_untag_func
+            return lambda value, row, patient: (html_untag_func(value), False)
+
+        return lambda value, row, patient: self.alter(
+            value=value, ddr=ddr, row=row, ddrows=ddrows, patient=patient)
+
     @staticmethod
     def _scrub_func(value: Any, patient: "Patient") -> Any:
         if value is None:
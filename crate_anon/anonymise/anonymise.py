@@ -29,41 +29,84 @@ Anonymise multiple SQL-based databases using a data dictionary.
 # Imports
 # =============================================================================
 
+from bisect import bisect_left
+import collections
+import datetime
+from functools import lru_cache
 import logging
+import os
 import random
+import socket
 import sys
-from typing import Any, Dict, Iterable, Generator, List, Tuple
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, Generator, List, Optional, Tuple
+import unittest
+from unittest import mock
 
 from sortedcontainers import SortedSet
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.session import Session
 from sqlalchemy.schema import Column, Index, MetaData, Table
 from sqlalchemy.sql import column, func, or_, select, table
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DatabaseError
+from sqlalchemy.sql.expression import Insert, Select
 from cardinal_pythonlib.rnc_datetime import get_now_utc
 
+from crate_anon.anonymise.bulkload import BulkLoader
 from crate_anon.anonymise.config_singleton import config
 from crate_anon.anonymise.constants import (
     BIGSEP,
     DEFAULT_CHUNKSIZE,
     DEFAULT_REPORT_EVERY,
+    DELETIONMETHOD,
     INDEX,
+    INDEX_COST_DEFAULT_WIDTH,
+    INDEX_COST_FULLTEXT_FACTOR,
+    INDEX_COST_UNBOUNDED_TEXT_WIDTH,
+    LEDGER_ENTRIES_PER_WRITE,
+    MAX_IN_CLAUSE_VALUES,
+    PROGRESSCOUNTS,
     TABLE_KWARGS,
     SEP,
 )
 from crate_anon.anonymise.models import (
+    IndexJob,
     OptOutMpid,
     OptOutPid,
+    PatientBatch,
     PatientInfo,
+    PatientQueueEntry,
+    ProgressLedgerEntry,
+    ScrubberElementStore,
+    SourceWatermark,
     TridRecord,
 )
-from crate_anon.anonymise.patient import Patient
+from crate_anon.anonymise.optout import OptOutFilter
+from crate_anon.anonymise.patient import Patient, ScrubSourceFetcher
+from crate_anon.anonymise.patientscan import PatientTableScan
+from crate_anon.anonymise.rowplan import RowPlan
+from crate_anon.anonymise.scrubpool import ScrubberPool
 from crate_anon.anonymise.ddr import DataDictionaryRow
 from crate_anon.common.formatting import print_record_counts
-from crate_anon.common.parallel import is_my_job_by_hash, is_my_job_by_int
-from crate_anon.common.sql import matches_tabledef
+from crate_anon.common.memory import report_memory_high_water_mark
+from crate_anon.common.parallel import (
+    BackgroundConsumer,
+    gen_prefetched,
+    is_my_job_by_hash,
+    is_my_job_by_int,
+)
+from crate_anon.common.sql import matches_tabledef, TransactionSizeLimiter
 from crate_anon.common.sqla import (
     add_index,
     count_star,
+    drop_index,
+    estimate_count_star,
     exists_plain,
     get_column_names,
+    is_sqlatype_string,
 )
 
 log = logging.getLogger(__name__)
@@ -98,6 +141,89 @@ def identical_record_exists_by_pk(dest_table: str,
                         column(pkfield) == pkvalue)
 
 
+def get_dest_pk_hash_map(dest_table: str,
+                         pkfield: str,
+                         *criteria: Any,
+                         with_hash: bool = True) -> Dict[Any, Optional[str]]:
+    """
+    Fetch, in a single query, {pk: source_hash} for all destination records
+    matching the criteria. (If with_hash is False, the values are None; the
+    keys alone tell you which records exist.) Used for bulk change detection
+    in incremental mode.
+    """
+    cols = [column(pkfield)]
+    if with_hash:
+        cols.append(column(config.source_hash_fieldname))
+    query = select(cols).select_from(table(dest_table))
+    for criterion in criteria:
+        query = query.where(criterion)
+    result = config.destdb.session.execute(query)
+    if with_hash:
+        return {row[0]: row[1] for row in result}
+    return {row[0]: None for row in result}
+
+
+def get_pk_span(session: Session,
+                tablename: str,
+                pkname: str) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Returns (MIN(pk), MAX(pk)) for a table; (None, None) if it's empty.
+    """
+    pkcol = column(pkname)
+    query = select([func.min(pkcol), func.max(pkcol)]).select_from(
+        table(tablename))
+    pkmin, pkmax = session.execute(query).fetchone()
+    return pkmin, pkmax
+
+
+def split_pk_span(pkmin: Optional[int],
+                  pkmax: Optional[int],
+                  n_ranges: int) -> List[Tuple[int, int]]:
+    """
+    Divides the integers from pkmin to pkmax into (up to) n_ranges contiguous
+    ranges of equal width. Returns a list of inclusive (first, last) tuples,
+    in ascending order.
+    """
+    if pkmin is None:
+        return []  # empty table
+    width = (pkmax - pkmin + n_ranges) // n_ranges  # ceiling division
+    return [(first, min(first + width - 1, pkmax))
+            for first in range(pkmin, pkmax + 1, width)]
+
+
+def get_pk_ranges(dbname: str,
+                  sourcetable: str,
+                  pkname: str,
+                  n_ranges: int) -> List[Tuple[int, int]]:
+    """
+    Divides a source table into (up to) n_ranges contiguous ranges of its
+    integer PK, of equal width between MIN(pk) and MAX(pk). Returns a list
+    of inclusive (first, last) tuples, in ascending order.
+    """
+    pkmin, pkmax = get_pk_span(config.sources[dbname].session,
+                               sourcetable, pkname)
+    return split_pk_span(pkmin, pkmax, n_ranges)
+
+
+def get_task_pk_ranges(dbname: str,
+                       sourcetable: str,
+                       pkname: str,
+                       tasknum: int = 0,
+                       ntasks: int = 1) -> Optional[List[Tuple[int, int]]]:
+    """
+    If we're using keyset PK-range partitioning, returns this task's PK
+    ranges of a non-patient table, in order; they're assigned to tasks in
+    rotation (see get_pk_ranges()). Otherwise, returns None.
+    """
+    if not config.pk_range_partitioning:
+        return None
+    all_pk_ranges = get_pk_ranges(
+        dbname, sourcetable, pkname,
+        n_ranges=ntasks * config.pk_ranges_per_process)
+    return [pk_range for i, pk_range in enumerate(all_pk_ranges)
+            if i % ntasks == tasknum]
+
+
 # =============================================================================
 # Database actions
 # =============================================================================
@@ -194,29 +320,32 @@ def delete_dest_rows_with_no_src_row(
     temptable.create(destengine, checkfirst=True)
 
     # Populate temporary table, +/- PK translation
-    n = count_star(config.sources[srcdbname].session, src_table)
-    log.debug("... populating temporary table: {} records to go".format(n))
+    n = count_rows_for_progress(srcdbname, src_table)
+    log.debug("... populating temporary table: {} records to go".format(
+        "?" if n is None else n))
 
-    def insert(records_):
-        log.debug(start + "... inserting {} records".format(len(records_)))
-        destsession.execute(temptable.insert(), records_)
+    def insert(pks_):
+        log.debug(start + "... inserting {} records".format(len(pks_)))
+        if pkddr.primary_pid:
+            pks_ = config.encrypt_primary_pids(pks_)
+        elif pkddr.master_pid:
+            pks_ = config.encrypt_master_pids(pks_)
+        destsession.execute(temptable.insert(),
+                            [{pkfield: pk_} for pk_ in pks_])
 
     i = 0
-    records = []  # type: List[Dict[str: Any]]
+    pks = []  # type: List[Any]
     for pk in gen_pks(srcdbname, src_table, pkddr.src_field):
         i += 1
         if report_every and i % report_every == 0:
-            log.debug(start + "... src row# {} / {}".format(i, n))
-        if pkddr.primary_pid:
-            pk = config.encrypt_primary_pid(pk)
-        elif pkddr.master_pid:
-            pk = config.encrypt_master_pid(pk)
-        records.append({pkfield: pk})
+            log.debug(start + "... src row# {} / {}".format(
+                i, "?" if n is None else n))
+        pks.append(pk)
         if i % chunksize == 0:
-            insert(records)
-            records = []  # type: List[Dict[str: Any]]
-    if records:  # remainder
-        insert(records)
+            insert(pks)
+            pks = []  # type: List[Any]
+    if pks:  # remainder
+        insert(pks)
     commit_destdb()
 
     # 4. Index -- no, hang on, it's a primary key already
@@ -244,6 +373,197 @@ def delete_dest_rows_with_no_src_row(
     commit_destdb()
 
 
+def deletes_by_sorted_diff(srcdbname: str, src_table: str) -> bool:
+    """
+    Should dead destination rows for this source table be found by comparing
+    sorted PK lists (see delete_dest_rows_with_no_src_row_by_diff()), rather
+    than via a temporary table? Only if the config asks for it, and the table
+    has an integer PK that is copied unchanged to the destination (i.e. isn't
+    a patient ID, which is encrypted and so doesn't sort in the same order).
+    """
+    if config.deletion_method != DELETIONMETHOD.SORTED_DIFF:
+        return False
+    if not config.dd.has_active_destination(srcdbname, src_table):
+        return False
+    pkddr = config.dd.get_pk_ddr(srcdbname, src_table)
+    return bool(
+        pkddr and
+        pkddr is config.dd.get_int_pk_ddr(srcdbname, src_table) and
+        not pkddr.omit and
+        not pkddr.primary_pid and
+        not pkddr.master_pid and
+        not pkddr.addition_only
+    )
+
+
+def gen_pks_in_order(session: Session,
+                     tablename: str,
+                     pkname: str,
+                     pk_range: Tuple[int, int],
+                     page_size: int) -> Generator[int, None, None]:
+    """
+    Generates the integer PK values of a table within an inclusive range, in
+    ascending order, a page at a time (see gen_rows_by_keyset()). Each page
+    is read in full before any of it is yielded, so the caller may delete
+    rows it has already seen as it goes.
+    """
+    pkcol = column(pkname)
+    first, last = pk_range
+    query = (
+        select([pkcol]).
+        select_from(table(tablename)).
+        where(pkcol >= first).
+        where(pkcol <= last).
+        order_by(pkcol).
+        limit(page_size)
+    )
+    last_pk_seen = None
+    while True:
+        page_query = query
+        if last_pk_seen is not None:
+            page_query = query.where(pkcol > last_pk_seen)
+        pks = [row[0] for row in session.execute(page_query).fetchall()]
+        yield from pks
+        if len(pks) < page_size:
+            return
+        last_pk_seen = pks[-1]
+
+
+def delete_dest_rows_with_no_src_row_by_diff(
+        srcdbname: str,
+        src_table: str,
+        pk_range: Tuple[int, int],
+        page_size: int = DEFAULT_CHUNKSIZE) -> int:
+    """
+    For a given source database/table, and an inclusive range of its integer
+    PK, delete any rows in the corresponding destination table where there is
+    no corresponding source row. Returns the number of rows deleted.
+
+    Reads the source and destination PKs in ascending order and steps through
+    them together (a merge, as in a sort-merge join), collecting destination
+    PKs with no source partner; these are deleted a batch at a time. Nothing
+    is copied between databases, memory use is bounded by the page size, and
+    different PK ranges can be handled by different processes.
+    """
+    dest_table_name = config.dd.get_dest_table_for_src_db_table(srcdbname,
+                                                                src_table)
+    pkddr = config.dd.get_pk_ddr(srcdbname, src_table)
+    dest_table = config.dd.get_dest_sqla_table(dest_table_name)
+    destsession = config.destdb.session
+    destpkcol = dest_table.columns[pkddr.dest_field]
+    n_deleted = 0
+
+    def delete(pks_: List[int]) -> None:
+        destsession.execute(dest_table.delete().where(destpkcol.in_(pks_)))
+
+    src_pks = gen_pks_in_order(config.sources[srcdbname].session,
+                               src_table, pkddr.src_field, pk_range,
+                               page_size)
+    src_pk = next(src_pks, None)
+    dead = []  # type: List[int]
+    for dest_pk in gen_pks_in_order(destsession, dest_table_name,
+                                    pkddr.dest_field, pk_range, page_size):
+        while src_pk is not None and src_pk < dest_pk:
+            src_pk = next(src_pks, None)
+        if src_pk == dest_pk:
+            continue
+        dead.append(dest_pk)
+        if len(dead) >= MAX_IN_CLAUSE_VALUES:
+            delete(dead)
+            n_deleted += len(dead)
+            dead = []  # type: List[int]
+    if dead:
+        delete(dead)
+        n_deleted += len(dead)
+    commit_destdb()
+    log.debug("delete_dest_rows_with_no_src_row_by_diff: {}.{} -> {}.{}, "
+              "PKs {}-{}: deleted {} rows".format(
+                  srcdbname, src_table, config.destdb.name, dest_table_name,
+                  pk_range[0], pk_range[1], n_deleted))
+    return n_deleted
+
+
+def delete_dead_dest_rows(tasknum: int = 0, ntasks: int = 1) -> None:
+    """
+    For incremental runs using the sorted-diff deletion method: delete
+    destination rows with no corresponding source row, for all tables where
+    that method applies (see deletes_by_sorted_diff()). Each table's PKs,
+    from the lowest to the highest in either database, are divided into
+    ranges, shared out among tasks in rotation.
+    """
+    log.info(SEP + "Deleting dead data by sorted diff: task {}/{}".format(
+        tasknum, ntasks))
+    n_ranges = ntasks * config.pk_ranges_per_process
+    for d in config.dd.get_source_databases():
+        for t in config.dd.get_src_tables(d):
+            if not deletes_by_sorted_diff(d, t):
+                continue
+            pkddr = config.dd.get_pk_ddr(d, t)
+            dest_table_name = config.dd.get_dest_table_for_src_db_table(d, t)
+            spans = [
+                span for span in (
+                    get_pk_span(config.sources[d].session, t,
+                                pkddr.src_field),
+                    get_pk_span(config.destdb.session, dest_table_name,
+                                pkddr.dest_field),
+                )
+                if span[0] is not None
+            ]
+            if not spans:
+                continue
+            pk_ranges = split_pk_span(min(span[0] for span in spans),
+                                      max(span[1] for span in spans),
+                                      n_ranges)
+            n_deleted = 0
+            for i, pk_range in enumerate(pk_ranges):
+                if i % ntasks != tasknum:
+                    continue
+                n_deleted += delete_dest_rows_with_no_src_row_by_diff(
+                    d, t, pk_range, page_size=config.chunksize)
+            log.info("{}.{}: deleted {} dead destination rows".format(
+                d, t, n_deleted))
+
+
+def make_background_dest_writer(insert_query: Insert) -> BackgroundConsumer:
+    """
+    For pipelined processing: returns a BackgroundConsumer that takes
+    (records, n_bytes) tuples and writes each list of records to the
+    destination, with executemany. It uses its own session (and therefore
+    database connection) and its own transaction size limiter, and commits
+    when finished.
+    """
+    session = None  # type: Session
+    limiter = None  # type: TransactionSizeLimiter
+
+    def process(item: Tuple[List[Dict[str, Any]], int]) -> None:
+        nonlocal session, limiter
+        records, n_bytes = item
+        if session is None:  # create in the writer's own thread
+            session = sessionmaker(bind=config.destdb.engine)()
+            limiter = TransactionSizeLimiter(
+                session=session,
+                max_rows_before_commit=config.max_rows_before_commit,
+                max_bytes_before_commit=config.max_bytes_before_commit)
+        session.execute(insert_query, records)
+        limiter.notify(n_rows=len(records), n_bytes=n_bytes)
+        config.notify_dest_bytes_written(n_bytes)
+
+    def finish() -> None:
+        if session is not None:
+            limiter.commit()
+            session.close()
+
+    def abort() -> None:
+        if session is not None:
+            session.rollback()
+            session.close()
+
+    return BackgroundConsumer(process_fn=process, finish_fn=finish,
+                              abort_fn=abort,
+                              maxsize=config.pipeline_queue_size,
+                              name="dest_writer")
+
+
 def commit_destdb() -> None:
     """
     Execute a COMMIT on the destination database, and reset row counts.
@@ -258,14 +578,149 @@ def commit_admindb() -> None:
     config.admindb.session.commit()
 
 
+# =============================================================================
+# Bulk loading
+# =============================================================================
+
+_bulk_loaders = {}  # type: Dict[Tuple[str, Tuple[str, ...]], BulkLoader]
+_unloaded_progress = []  # type: List[Tuple[str, List[Tuple[str, str]], str, Optional[str]]]  # noqa
+_unwritten_progress = []  # type: List[Tuple[str, List[Tuple[str, str]], str, Optional[str]]]  # noqa
+_progress_ledger_started = False
+
+
+def get_bulk_loader(dest_table: str, fields: Iterable[str]) -> BulkLoader:
+    """
+    Returns this process's BulkLoader for a destination table and set of
+    fields.
+    """
+    key = (dest_table, tuple(sorted(fields)))
+    loader = _bulk_loaders.get(key)
+    if loader is None:
+        loader = BulkLoader(config.dd.get_dest_sqla_table(dest_table),
+                            key[1],
+                            dialect_name=config.destdb.engine.dialect.name,
+                            tmpdir=config.bulk_load_tmpdir)
+        _bulk_loaders[key] = loader
+    return loader
+
+
+def n_rows_awaiting_bulk_load() -> int:
+    return sum(loader.n_rows for loader in _bulk_loaders.values())
+
+
+def load_spooled_rows() -> None:
+    """
+    Bulk-loads all rows spooled by this process, commits, and then records
+    the work they came from as done (see record_progress()).
+    """
+    session = config.destdb.session
+    for loader in _bulk_loaders.values():
+        n = loader.load(session)
+        if n:
+            log.info("Bulk-loaded {} rows into {}".format(
+                n, loader.sqla_table.name))
+    _unwritten_progress.extend(_unloaded_progress)
+    _unloaded_progress.clear()
+    commit_destdb()
+    write_progress_ledger()
+
+
+def discard_spooled_rows() -> None:
+    """
+    Throws away rows spooled by this process, and the progress that depended
+    on them (e.g. after an error).
+    """
+    for loader in _bulk_loaders.values():
+        loader.discard()
+    _unloaded_progress.clear()
+    _unwritten_progress.clear()
+
+
+def record_progress(unit: str,
+                    db_table_pairs: List[Tuple[str, str]],
+                    dd_version: str,
+                    scrubber_hash: str = None) -> None:
+    """
+    Records a unit of work as done in the progress ledger (if we're keeping
+    one; see start_progress_ledger()), once its destination rows are
+    committed. Entries wait, and are written in
+    groups, after a commit of the destination database that happens anyway
+    (see write_progress_ledger()); any still waiting when the process ends
+    or fails are just redone by --resume. If rows are waiting to be
+    bulk-loaded, that's once they've been loaded; we load them when there are
+    enough.
+    """
+    if not _progress_ledger_started:
+        return
+    entry = (unit, db_table_pairs, dd_version, scrubber_hash)
+    if n_rows_awaiting_bulk_load():
+        _unloaded_progress.append(entry)
+        if n_rows_awaiting_bulk_load() >= config.bulk_load_max_rows:
+            load_spooled_rows()
+        return
+    _unwritten_progress.append(entry)
+
+
+def write_progress_ledger(min_entries: int = 1) -> None:
+    """
+    Writes waiting progress entries to the ledger, if there are at least
+    min_entries of them. Call only just after a commit of the destination
+    database, which will have included all their rows.
+    """
+    if not _unwritten_progress or len(_unwritten_progress) < min_entries:
+        return
+    ProgressLedgerEntry.record(config.admindb.session, _unwritten_progress)
+    _unwritten_progress.clear()
+
+
+def write_progress_ledger_after_commit() -> None:
+    write_progress_ledger(min_entries=LEDGER_ENTRIES_PER_WRITE)
+
+
+def start_progress_ledger() -> None:
+    """
+    Starts recording progress (see record_progress()): from now on, waiting
+    entries are written after commits of the destination database.
+    """
+    global _progress_ledger_started
+    if _progress_ledger_started:
+        return
+    config.add_dest_db_commit_callback(write_progress_ledger_after_commit)
+    _progress_ledger_started = True
+
+
 # =============================================================================
 # Opt-out
 # =============================================================================
 
+# With optout_in_memory, this process's copies of the opt-out lists; made
+# when first needed (see optout.py).
+_optout_filters = {}  # type: Dict[str, OptOutFilter]
+
+
+def get_optout_filter(model: Any, idcol: Any) -> OptOutFilter:
+    name = model.__tablename__
+    if name not in _optout_filters:
+        _optout_filters[name] = OptOutFilter(
+            model, idcol,
+            bloom_filter_threshold=config.optout_bloom_filter_threshold,
+            refresh_interval_s=config.optout_refresh_interval_s)
+    return _optout_filters[name]
+
+
+def clear_optout_filters() -> None:
+    """Make this process reload the opt-out lists when they're next needed."""
+    for optout_filter in _optout_filters.values():
+        optout_filter.clear()
+
+
 def opting_out_pid(pid: int) -> bool:
     """Does this patient wish to opt out?"""
     if pid is None:
         return False
+    if config.optout_in_memory:
+        return get_optout_filter(OptOutPid, OptOutPid.pid).opting_out(
+            config.admindb.session, pid)
     return OptOutPid.opting_out(config.admindb.session, pid)
 
 
@@ -273,6 +728,9 @@ def opting_out_mpid(mpid: int) -> bool:
     """Does this patient wish to opt out?"""
     if mpid is None:
         return False
+    if config.optout_in_memory:
+        return get_optout_filter(OptOutMpid, OptOutMpid.mpid).opting_out(
+            config.admindb.session, mpid)
     return OptOutMpid.opting_out(config.admindb.session, mpid)
 
 
@@ -349,7 +807,6 @@ def gen_patient_ids(tasknum: int = 0,
         if not ddr.defines_primary_pids:
             continue
         pidcol = column(ddr.src_field)
-        session = config.sources[ddr.src_db].session
         query = (
             select([pidcol]).
             select_from(table(ddr.src_table)).
@@ -359,7 +816,7 @@ def gen_patient_ids(tasknum: int = 0,
         )
         if ntasks > 1 and pid_is_integer:
             query = query.where(pidcol % ntasks == tasknum)
-        result = session.execute(query)
+        result = config.sources[ddr.src_db].gen_query_rows(query)
         log.debug("Looking for patient IDs in {}.{}".format(ddr.src_table,
                                                             ddr.src_field))
         for row in result:
@@ -400,21 +857,179 @@ def gen_patient_ids(tasknum: int = 0,
                 return
 
 
-def estimate_count_patients() -> int:
+def get_worker_name(tasknum: int = 0) -> str:
+    """
+    Name for this process, when claiming work from queues in the admin
+    database.
+    """
+    return "proc{}@{}:{}".format(tasknum, socket.gethostname(), os.getpid())
+
+
+class PatientBatchLease(object):
+    """
+    This process's lease on the patient batch it is working on (see
+    gen_patient_ids_from_queue()).
+    """
+    def __init__(self, batch_num: int, worker: str, lease_s: int,
+                 reclaimed: bool) -> None:
+        """
+        reclaimed: had another worker claimed this batch before us (so that
+            some of its patients may have destination rows already)?
+        """
+        self.batch_num = batch_num
+        self.worker = worker
+        self.lease_s = lease_s
+        self.reclaimed = reclaimed
+        self.lost = False
+        self._renewed_at = time.monotonic()
+
+    def renew(self) -> bool:
+        """
+        Extends the lease. Returns False if we've lost it (because it expired
+        and someone else has claimed the batch).
+        """
+        if not self.lost:
+            self.lost = not PatientBatch.renew(config.admindb.session,
+                                               self.batch_num, self.worker,
+                                               self.lease_s)
+            self._renewed_at = time.monotonic()
+        return not self.lost
+
+    def renew_if_due(self) -> None:
+        """
+        Extends the lease if a third of it has gone by since it was last
+        extended; for use while processing a patient with a lot of data.
+        """
+        if time.monotonic() - self._renewed_at < self.lease_s / 3:
+            return
+        if not self.renew():
+            log.warning("{}: lost lease on patient batch {} while "
+                        "processing a patient".format(self.worker,
+                                                      self.batch_num))
+
+
+# The lease this process holds, if we're using dynamic scheduling; see
+# gen_patient_ids_from_queue().
+_patient_batch_lease = None  # type: Optional[PatientBatchLease]
+
+
+def gen_patient_ids_from_queue(tasknum: int = 0) -> Generator[int, None,
+                                                               None]:
+    """
+    Generate patient IDs by claiming batches from the shared work queue in the
+    admin database (see build_patient_queue()), until none are left. Used for
+    dynamic scheduling; the alternative to gen_patient_ids().
+    """
+    session = config.admindb.session
+    lease_s = config.patient_batch_lease_s
+    worker = get_worker_name(tasknum)
+    if not session.query(PatientBatch).first():
+        log.warning("Patient work queue is empty; has it been built (with "
+                    "--patientqueue)?")
+        return
+    global _patient_batch_lease
+    while True:
+        batch_num = PatientBatch.claim(session, worker, lease_s)
+        if batch_num is None:
+            return
+        reclaimed = PatientBatch.was_reclaimed(session, batch_num)
+        log.debug("{} claimed patient batch {}{}".format(
+            worker, batch_num, " (reclaimed)" if reclaimed else ""))
+        lease = PatientBatchLease(batch_num, worker, lease_s, reclaimed)
+        _patient_batch_lease = lease
+        try:
+            for pid in PatientQueueEntry.get_pids(session, batch_num):
+                yield pid
+                if not lease.renew():
+                    break
+        finally:
+            _patient_batch_lease = None
+        # Don't mark the batch done until its data is safely committed (and,
+        # if we're bulk-loading, loaded). If another worker has taken the
+        # batch over, it will write the rows we haven't loaded.
+        if lease.lost:
+            discard_spooled_rows()
+        else:
+            load_spooled_rows()
+        commit_destdb()
+        if lease.lost or not PatientBatch.complete(session, batch_num,
+                                                   worker):
+            log.warning("{}: lease on patient batch {} expired and the batch "
+                        "was reclaimed by another process; consider "
+                        "increasing patient_batch_lease_s".format(
+                            worker, batch_num))
+
+
+def make_patient_table_scan(tasknum: int = 0,
+                            ntasks: int = 1) -> PatientTableScan:
+    """
+    Sets up a sorted-merge scan of all the patient tables (those defining
+    PIDs, those with scrub-source information, and those to be copied).
+    """
+    scan = PatientTableScan(tasknum=tasknum, ntasks=ntasks)
+    for ddr in config.dd.rows:
+        if ddr.defines_primary_pids:
+            scan.add_table(ddr.src_db, ddr.src_table, ddr.src_field, [],
+                           defines_pids=True)
+    for (src_db, src_table) in config.dd.get_scrub_from_db_table_pairs():
+        pidfield = config.sources[src_db].srccfg.ddgen_per_table_pid_field
+        if not pidfield:
+            continue  # as for gen_all_values_for_patient()
+        scan.add_table(src_db, src_table, pidfield, [
+            ddr.src_field
+            for ddr in config.dd.get_scrub_from_rows(src_db, src_table)
+        ])
+    for d in config.dd.get_source_databases():
+        for t in config.dd.get_patient_src_tables_with_active_dest(d):
+            fields = [ddr.src_field for ddr in get_ddrows_to_process(d, t)]
+            if fields:
+                scan.add_table(d, t, config.dd.get_pid_name(d, t), fields)
+    return scan
+
+
+def gen_patient_ids_from_scan(
+        scan: PatientTableScan) -> Generator[int, None, None]:
+    """
+    Generate patient IDs from a sorted-merge scan of the patient tables; the
+    alternative to gen_patient_ids() when stream_patient_tables is set.
+    Applies the same debugging options.
+    """
+    debug_pids = None
+    if config.debug_pid_list:
+        log.warning("USING MANUALLY SPECIFIED INTEGER PATIENT ID LIST")
+        debug_pids = set(int(pid) for pid in config.debug_pid_list)
+    n_found = 0
+    debuglimit = config.debug_max_n_patients
+    for pid in scan.gen_patient_ids():
+        if debug_pids is not None and pid not in debug_pids:
+            continue
+        n_found += 1
+        yield pid
+        if 0 < debuglimit <= n_found:
+            log.warning(
+                "Not fetching more than {} patients (in total for this "
+                "process) due to debug_max_n_patients limit".format(
+                    debuglimit))
+            return
+
+
+def estimate_count_patients() -> Optional[int]:
     """
     We can't easily and quickly get the total number of patients, because they
     may be defined in multiple tables across multiple databases. We shouldn't
     fetch them all into Python in case there are billions, and it's a waste of
     effort to stash them in a temporary table and count unique rows, because
-    this is all only for a progress indicator. So we approximate:
+    this is all only for a progress indicator. So we approximate.
+    Returns None if we're not counting (see progress_counts).
     """
     count = 0
     for ddr in config.dd.rows:
         if not ddr.defines_primary_pids:
             continue
-        session = config.sources[ddr.src_db].session
-        tablename = ddr.src_table
-        count += count_star(session, tablename)
+        n = count_rows_for_progress(ddr.src_db, ddr.src_table)
+        if n is None:
+            return None
+        count += n
     return count
 
 
@@ -425,7 +1040,11 @@ def gen_rows(dbname: str,
              intpkname: str = None,
              tasknum: int = 0,
              ntasks: int = 1,
-             debuglimit: int = 0) -> Generator[List[Any], None, None]:
+             debuglimit: int = 0,
+             order_by_pk: bool = False,
+             session: Session = None,
+             pk_range: Tuple[int, int] = None,
+             criterion: Any = None) -> Generator[List[Any], None, None]:
     """
     Generates rows from a source table
     ... each row being a list of values
@@ -435,25 +1054,106 @@ def gen_rows(dbname: str,
 
     If the table has a PK and we're operating in a multitasking situation,
     generate just the rows for this task (thread/process).
+
+    If order_by_pk is set (and intpkname is given), rows come in PK order.
+
+    If pk_range is given (an inclusive (first, last) tuple), only rows in that
+    range of intpkname are generated, in PK order, and tasknum/ntasks are
+    ignored (see get_pk_ranges()).
+
+    By default, the source database's main session is used; pass another
+    session to read via a different connection (e.g. from another thread).
+
+    If criterion is given, only rows meeting it are generated (e.g. see
+    get_watermark_criterion()).
     """
     t = config.sources[dbname].metadata.tables[sourcetable]
     q = select([column(c) for c in sourcefields]).select_from(t)
-    # not ordered
+    if criterion is not None:
+        q = q.where(criterion)
+    if order_by_pk and intpkname is not None and pk_range is None:
+        q = q.order_by(column(intpkname))
+    # otherwise, not ordered
 
     # Restrict to one patient?
     if pid is not None:
         pidcol_name = config.dd.get_pid_name(dbname, sourcetable)
         q = q.where(column(pidcol_name) == pid)
+        pk_range = None
     else:
         # For non-patient tables: divide up rows across tasks?
-        if intpkname is not None and ntasks > 1:
+        if intpkname is not None and ntasks > 1 and pk_range is None:
             q = q.where(column(intpkname) % ntasks == tasknum)
             # This does not require a user-defined PK to be unique. But other
             # constraints do: see delete_dest_rows_with_no_src_row().
 
+    if pk_range is not None:
+        result = gen_rows_by_keyset(dbname, q, intpkname, pk_range,
+                                    page_size=config.chunksize,
+                                    session=session)
+    else:
+        result = config.sources[dbname].gen_query_rows(q, session=session)
+    for row in gen_rows_within_debug_limit(dbname, sourcetable, result,
+                                           debuglimit):
+        config.notify_src_bytes_read(sys.getsizeof(row))  # ... approximate!
+        yield list(row)
+        # yield dict(zip(row.keys(), row))
+        # see also http://stackoverflow.com/questions/19406859
+    result.close()  # http://docs.sqlalchemy.org/en/latest/core/connections.html  # noqa
+
+
+def gen_rows_by_keyset(dbname: str,
+                       query: Select,
+                       pkname: str,
+                       pk_range: Tuple[int, int],
+                       page_size: int,
+                       session: Session = None) -> Generator[Tuple[Any, ...],
+                                                             None, None]:
+    """
+    Runs a SELECT query on a source table for an inclusive range of its
+    integer PK, a page at a time ("keyset pagination"):
+
+        ... WHERE pk BETWEEN first AND last AND pk > last_pk_seen
+        ORDER BY pk LIMIT page_size
+
+    Each page is a short query that uses the PK index, and rows are read only
+    by the process handling that range. Requires the PK to be unique.
+    """
+    pkcol = column(pkname)
+    first, last = pk_range
+    query = (
+        query.column(pkcol).
+        where(pkcol >= first).
+        where(pkcol <= last).
+        order_by(pkcol).
+        limit(page_size)
+    )
+    db = config.sources[dbname]
+    last_pk_seen = None
+    while True:
+        page_query = query
+        if last_pk_seen is not None:
+            page_query = query.where(pkcol > last_pk_seen)
+        n = 0
+        for row in db.gen_query_rows(page_query, session=session):
+            n += 1
+            last_pk_seen = row[-1]
+            yield tuple(row)[:-1]  # remove the PK we added
+        if n < page_size:
+            return
+
+
+def gen_rows_within_debug_limit(dbname: str,
+                                sourcetable: str,
+                                rows: Iterable[Any],
+                                debuglimit: int = 0) -> Generator[Any, None,
+                                                                  None]:
+    """
+    Passes on rows from a source table, stopping if the (per-process)
+    debugging row limit for that table is reached.
+    """
     db_table_tuple = (dbname, sourcetable)
-    result = config.sources[dbname].session.execute(q)
-    for row in result:
+    for row in rows:
         if 0 < debuglimit <= config.rows_inserted_per_table[db_table_tuple]:
             if not config.warned_re_limits[db_table_tuple]:
                 log.warning(
@@ -461,12 +1161,8 @@ def gen_rows(dbname: str,
                     "for this process) due to debugging limits".format(
                         dbname, sourcetable, debuglimit))
                 config.warned_re_limits[db_table_tuple] = True
-            result.close()  # http://docs.sqlalchemy.org/en/latest/core/connections.html  # noqa
             return
-        config.notify_src_bytes_read(sys.getsizeof(row))  # ... approximate!
-        yield list(row)
-        # yield dict(zip(row.keys(), row))
-        # see also http://stackoverflow.com/questions/19406859
+        yield row
         config.rows_inserted_per_table[db_table_tuple] += 1
 
 
@@ -480,6 +1176,22 @@ def count_rows(dbname: str, sourcetable: str, pid: int = None) -> int:
     return session.execute(query).scalar()
 
 
+def count_rows_for_progress(dbname: str,
+                            sourcetable: str,
+                            pid: int = None) -> Optional[int]:
+    """
+    Count (or estimate) the rows that gen_rows() will produce, for progress
+    reports only, as per the progress_counts option. Returns None if we're not
+    counting in advance.
+    """
+    if config.progress_counts is PROGRESSCOUNTS.EXACT:
+        return count_rows(dbname, sourcetable, pid)
+    if config.progress_counts is PROGRESSCOUNTS.ESTIMATED and pid is None:
+        return estimate_count_star(config.sources[dbname].session,
+                                   sourcetable)
+    return None
+
+
 def gen_index_row_sets_by_table(
         tasknum: int = 0,
         ntasks: int = 1) -> Generator[Tuple[str, List[DataDictionaryRow]],
@@ -539,11 +1251,70 @@ def gen_pks(srcdbname: str,
     db = config.sources[srcdbname]
     t = db.metadata.tables[tablename]
     q = select([column(pkname)]).select_from(t)
-    result = db.session.execute(q)
-    for row in result:
+    for row in db.gen_query_rows(q):
         yield row[0]
 
 
+# =============================================================================
+# Watermarks, for incremental runs
+# =============================================================================
+
+def get_watermark_field(dbname: str, tablename: str) -> Optional[str]:
+    return config.sources[dbname].srccfg.incremental_watermark_columns.get(
+        tablename)
+
+
+@lru_cache(maxsize=None)
+def get_watermark_criterion(dbname: str, tablename: str) -> Any:
+    """
+    For a source table with a watermark field, and a high-water mark from
+    the last completed run (see SourceWatermark), returns a criterion
+    selecting rows added or changed since; otherwise, None (read all rows).
+    """
+    field = get_watermark_field(dbname, tablename)
+    if not field:
+        return None
+    high_water = SourceWatermark.get_high_water(
+        config.admindb.session, dbname, tablename, field,
+        config.dd.get_version_hash())
+    if high_water is None:
+        log.info("{}.{}: no usable high-water mark; reading all rows".format(
+            dbname, tablename))
+        return None
+    log.info("{}.{}: reading rows with {} >= {!r}".format(
+        dbname, tablename, field, high_water))
+    wmcol = column(field)
+    return or_(wmcol >= high_water, wmcol == None)  # noqa
+
+
+def start_watermarks(incremental: bool = False) -> None:
+    """
+    At the start of a run: record each watermarked source table's current
+    highest watermark, to become its high-water mark when the run completes.
+    """
+    dd_version = config.dd.get_version_hash()
+    for d in config.dd.get_source_databases():
+        for t in config.dd.get_src_tables(d):
+            field = get_watermark_field(d, t)
+            if not field:
+                continue
+            query = select([func.max(column(field))]).select_from(table(t))
+            pending = config.sources[d].session.execute(query).scalar()
+            log.info("{}.{}: watermark {} now {!r}".format(d, t, field,
+                                                            pending))
+            SourceWatermark.start_run(config.admindb.session, d, t, field,
+                                      pending, dd_version, incremental)
+
+
+def save_watermarks() -> None:
+    """
+    Once a run has completed: make the watermarks recorded at its start the
+    high-water marks for the next incremental run.
+    """
+    n = SourceWatermark.complete_run(config.admindb.session)
+    log.info("Saved high-water marks for {} source tables".format(n))
+
+
 # =============================================================================
 # Core functions
 # =============================================================================
@@ -551,17 +1322,68 @@ def gen_pks(srcdbname: str,
 # - KEY THREADING RULE: ALL THREADS MUST HAVE FULLY INDEPENDENT DATABASE
 #   CONNECTIONS.
 
+def get_ddrows_to_process(sourcedbname: str,
+                          sourcetable: str) -> List[DataDictionaryRow]:
+    """
+    Returns the data dictionary rows for a source table whose fields
+    process_table() needs to read (in the order it reads them), or an empty
+    list if there's nothing to do for that table.
+    """
+    ddrows = config.dd.get_rows_for_src_table(sourcedbname, sourcetable)
+    if all(ddr.omit for ddr in ddrows):
+        return []
+    addhash = any(ddr.add_src_hash for ddr in ddrows)
+    # If addhash or constant is true AND we are not omitting all rows, then
+    # the non-omitted rows will include the source PK (by the data dictionary's
+    # validation process).
+    return [ddr for ddr in ddrows
+            if (
+                (not ddr.omit) or  # used for data
+                (addhash and ddr.scrub_src) or  # used for hash
+                ddr.inclusion_values or  # used for filter
+                ddr.exclusion_values  # used for filter
+            )]
+
+
+@lru_cache(maxsize=None)
+def get_row_plan(sourcedbname: str, sourcetable: str) -> RowPlan:
+    """
+    Returns the plan for transforming rows of a source table (made once per
+    table, per process), with the fields of get_ddrows_to_process().
+    """
+    return RowPlan(get_ddrows_to_process(sourcedbname, sourcetable))
+
+
 def process_table(sourcedbname: str,
                   sourcetable: str,
                   patient: Patient = None,
                   incremental: bool = False,
                   intpkname: str = None,
                   tasknum: int = 0,
-                  ntasks: int = 1) -> None:
+                  ntasks: int = 1,
+                  scrub_pool: ScrubberPool = None,
+                  source_rows: List[List[Any]] = None,
+                  pk_ranges: List[Tuple[int, int]] = None,
+                  delete_existing: bool = False) -> None:
     """
     Process a table. This can either be a patient table (in which case the
     patient's scrubber is applied and only rows for that patient are processed)
     or not (in which case the table is just copied).
+
+    If scrub_pool is given, long text values for a patient are scrubbed in
+    parallel by that pool, a batch of rows at a time.
+
+    If source_rows is given, those rows (for this patient, with fields as per
+    get_ddrows_to_process()) are processed, rather than reading them from the
+    source database; see PatientTableScan.
+
+    If pk_ranges is given (for a non-patient table with an integer PK), only
+    rows within those inclusive (first, last) PK ranges are processed; see
+    get_task_pk_ranges().
+
+    If delete_existing is set, destination rows that this call would write
+    (for this patient, or this task's share of a non-patient table) are
+    deleted first; that's for redoing work that was interrupted.
     """
     start = "process_table: {}.{}: ".format(sourcedbname, sourcetable)
     pid = None if patient is None else patient.get_pid()
@@ -577,21 +1399,11 @@ def process_table(sourcedbname: str,
         debuglimit = 0
 
     ddrows = config.dd.get_rows_for_src_table(sourcedbname, sourcetable)
-    if all(ddr.omit for ddr in ddrows):
-        return
     addhash = any(ddr.add_src_hash for ddr in ddrows)
     addtrid = any(ddr.primary_pid and not ddr.omit for ddr in ddrows)
     constant = any(ddr.constant for ddr in ddrows)
-    # If addhash or constant is true AND we are not omitting all rows, then
-    # the non-omitted rows will include the source PK (by the data dictionary's
-    # validation process).
-    ddrows = [ddr for ddr in ddrows
-              if (
-                  (not ddr.omit) or  # used for data
-                  (addhash and ddr.scrub_src) or  # used for hash
-                  ddr.inclusion_values or  # used for filter
-                  ddr.exclusion_values  # used for filter
-              )]
+    plan = get_row_plan(sourcedbname, sourcetable)
+    ddrows = plan.ddrows
     if not ddrows:
         # No columns to process at all.
         return
@@ -600,167 +1412,554 @@ def process_table(sourcedbname: str,
     pkfield_index = None
     src_pk_name = None
     dest_pk_name = None
+    pkddr = None  # type: DataDictionaryRow
+    dest_pid_name = None
     for i, ddr in enumerate(ddrows):
         # log.debug("DD row: {}".format(str(ddr)))
         if ddr.pk:
             pkfield_index = i
             src_pk_name = ddr.src_field
             dest_pk_name = ddr.dest_field
+            pkddr = ddr
+        if ddr.primary_pid and not ddr.omit:
+            dest_pid_name = ddr.dest_field
         sourcefields.append(ddr.src_field)
     srchash = None
     sqla_table = config.dd.get_dest_sqla_table(dest_table)
     session = config.destdb.session
 
+    # Destination rows are buffered and written in batches (executemany; for
+    # MySQL, a multi-row INSERT ... ON DUPLICATE KEY UPDATE). All rows in a
+    # batch must have the same keys; they will, since every row we write has
+    # one value per non-omitted field (plus hash/TRID, if used).
+    insert_query = sqla_table.insert_on_duplicate()
+    max_rows_per_insert = config.max_rows_per_insert
+    records = []  # type: List[Dict[str, Any]]
+    n_bytes_in_records = 0
+
+    # Pipelined processing? Then source rows are read by a background thread,
+    # and destination rows are written by another, each with its own database
+    # connection; this (main) thread just transforms them. Only for
+    # non-patient tables: we're called for each patient for each patient
+    # table, usually for a few rows, and starting threads and connections
+    # (and committing) each time would cost more than it saved.
+    pipelined = config.pipelined_processing and pid is None
+    writer = None  # type: BackgroundConsumer
+
+    # Bulk loading (full runs only)? Then rows are spooled to a file, to be
+    # loaded later by load_spooled_rows(), rather than written here.
+    bulk_load = config.bulk_load and not incremental
+
+    # Scrubbing in a process pool? If so, values to be scrubbed are set
+    # aside (as (record index, field, text) tuples) and done in a batch just
+    # before the rows are written. We can only do that for fields whose last
+    # alteration is scrubbing.
+    if patient is None or not plan.can_defer_scrubbing:
+        scrub_pool = None
+    min_deferred_length = config.scrub_pool_min_text_length
+    deferred = []  # type: List[Tuple[int, str, str]]
+    row_deferred = [] if scrub_pool else None  # type: List[Tuple[str, str]]
+    scrubber_key = patient.get_scrubber_hash() if scrub_pool else None
+
+    def flush():
+        nonlocal records, n_bytes_in_records, deferred
+        if not records:
+            return
+        if deferred:
+            scrubbed = scrub_pool.scrub(scrubber_key, patient.scrubber,
+                                        [text for _, _, text in deferred])
+            for (recindex, field, _), text in zip(deferred, scrubbed):
+                records[recindex][field] = text
+            deferred = []  # type: List[Tuple[int, str, str]]
+        if bulk_load:
+            get_bulk_loader(dest_table, records[0].keys()).write(records)
+            config.notify_dest_bytes_written(n_bytes_in_records)
+        elif writer:
+            writer.put((records, n_bytes_in_records))
+        else:
+            session.execute(insert_query, records)
+            # Trigger an early commit?
+            config.notify_dest_db_transaction(
+                n_rows=len(records), n_bytes=n_bytes_in_records)
+        records = []  # type: List[Dict[str, Any]]
+        n_bytes_in_records = 0
+
+    # Incremental change detection. We can probe the destination once per
+    # source row, or (with bulk_change_detection) fetch the destination's
+    # {pk: hash} map in bulk: once for this patient, or once per chunk of
+    # rows for a non-patient table. With an integer PK (not a hashed patient
+    # ID), rows are fetched in PK order and a chunk is a PK range; otherwise,
+    # a chunk's destination PKs are looked up by value, MAX_IN_CLAUSE_VALUES
+    # at a time, so we never hold the whole table's map.
+    bulk_lookup = (
+        incremental and (addhash or constant) and
+        config.bulk_change_detection and
+        (pid is None or dest_pid_name is not None)
+    )
+    dest_hashes = {}  # type: Dict[Any, Optional[str]]
+
+    def get_dest_pk_value(row_: List[Any]) -> Any:
+        # The destination PK is the source PK, unless that is a (master)
+        # patient ID, in which case it will have been encrypted.
+        pk = row_[pkfield_index]
+        if pkddr.primary_pid:
+            return patient.get_rid()
+        if pkddr.master_pid:
+            return config.encrypt_master_pid(pk)
+        return pk
+
+    def fetch_dest_hashes(*criteria: Any) -> None:
+        dest_hashes.clear()
+        dest_hashes.update(get_dest_pk_hash_map(
+            dest_table, dest_pk_name, *criteria, with_hash=addhash))
+
+    if pk_ranges is not None:
+        log.debug(start + "PK ranges: {}".format(pk_ranges))
+
+    # Watermark? Then, incrementally, read only rows changed since the last
+    # completed run. Not when redoing interrupted work, which rewrites all.
+    watermark = None
+    if incremental and not delete_existing:
+        watermark = get_watermark_criterion(sourcedbname, sourcetable)
+        if watermark is not None:
+            log.debug(start + "reading rows by watermark")
+
+    # Delete any rows left by an interrupted attempt at this work?
+    if delete_existing:
+        delete_query = sqla_table.delete()
+        if pid is not None:
+            if dest_pid_name is None:
+                log.warning(start + "no destination patient ID field; can't "
+                            "delete rows from an interrupted run")
+                delete_query = None
+            else:
+                delete_query = delete_query.where(
+                    column(dest_pid_name) == patient.get_rid())
+        elif pk_ranges is not None:
+            delete_query = delete_query.where(or_(*[
+                column(dest_pk_name).between(first, last)
+                for first, last in pk_ranges
+            ])) if pk_ranges else None
+        elif intpkname is not None and ntasks > 1:
+            delete_query = delete_query.where(
+                column(dest_pk_name) % ntasks == tasknum)
+        if delete_query is not None:
+            log.debug(start + "deleting rows from an interrupted run")
+            session.execute(delete_query)
+            commit_destdb()  # before any other connection writes
+
+    def gen_source_rows() -> Generator[List[Any], None, None]:
+        chunked = (bulk_lookup and pid is None and intpkname is not None and
+                   not (pkddr.primary_pid or pkddr.master_pid))
+
+        def gen_raw_rows(session_: Session = None) -> Generator[List[Any],
+                                                                None, None]:
+            for pk_range in (pk_ranges if pk_ranges is not None else [None]):
+                yield from gen_rows(sourcedbname, sourcetable, sourcefields,
+                                    pid, debuglimit=debuglimit,
+                                    intpkname=intpkname, tasknum=tasknum,
+                                    ntasks=ntasks, order_by_pk=chunked,
+                                    session=session_, pk_range=pk_range,
+                                    criterion=watermark)
+
+        def gen_raw_rows_own_session() -> Generator[List[Any], None, None]:
+            # Runs in the reader thread, with its own connection.
+            srcsession = sessionmaker(
+                bind=config.sources[sourcedbname].engine)()
+            try:
+                yield from gen_raw_rows(srcsession)
+            finally:
+                srcsession.close()
+
+        if source_rows is not None:
+            rowgen = gen_rows_within_debug_limit(
+                sourcedbname, sourcetable, source_rows, debuglimit)
+        elif pipelined:
+            rowgen = gen_prefetched(gen_raw_rows_own_session,
+                                    chunksize=max_rows_per_insert,
+                                    max_chunks=config.pipeline_queue_size,
+                                    name="source_reader")
+        else:
+            rowgen = gen_raw_rows()
+        if not bulk_lookup:
+            yield from rowgen
+            return
+        if pid is not None:
+            fetch_dest_hashes(column(dest_pid_name) == patient.get_rid())
+            yield from rowgen
+            return
+        if not chunked:
+            chunk = []  # type: List[List[Any]]
+            for row_ in rowgen:
+                chunk.append(row_)
+                if len(chunk) >= MAX_IN_CLAUSE_VALUES:
+                    yield from gen_chunk_rows_by_pk_value(chunk)
+                    chunk = []  # type: List[List[Any]]
+            if chunk:  # remainder
+                yield from gen_chunk_rows_by_pk_value(chunk)
+            return
+        # Non-patient table with integer PK, in PK order: work through it in
+        # chunks, each covering a PK range. If the table is partitioned into
+        # PK ranges, a chunk mustn't span the gap between two of our ranges
+        # (that's another task's range, possibly big).
+        chunk = []  # type: List[List[Any]]
+        chunk_max_pk = None
+        range_last_pks = [last for _, last in pk_ranges or []]
+        for row_ in rowgen:
+            pk = row_[pkfield_index]
+            if chunk and chunk_max_pk is not None and pk > chunk_max_pk:
+                yield from gen_chunk_rows(chunk)
+                chunk = []  # type: List[List[Any]]
+            if not chunk and range_last_pks:
+                chunk_max_pk = range_last_pks[bisect_left(range_last_pks, pk)]
+            chunk.append(row_)
+            if len(chunk) >= config.chunksize:
+                yield from gen_chunk_rows(chunk)
+                chunk = []  # type: List[List[Any]]
+        if chunk:  # remainder
+            yield from gen_chunk_rows(chunk)
+
+    def gen_chunk_rows(chunk: List[List[Any]]) -> Generator[List[Any],
+                                                            None, None]:
+        pkcol = column(dest_pk_name)
+        criteria = [pkcol >= chunk[0][pkfield_index],
+                    pkcol <= chunk[-1][pkfield_index]]
+        if ntasks > 1 and pk_ranges is None:
+            criteria.append(pkcol % ntasks == tasknum)
+        fetch_dest_hashes(*criteria)
+        yield from chunk
+
+    def gen_chunk_rows_by_pk_value(chunk: List[List[Any]]) -> Generator[
+            List[Any], None, None]:
+        dest_pks = list(set(get_dest_pk_value(row_) for row_ in chunk))
+        fetch_dest_hashes(column(dest_pk_name).in_(dest_pks))
+        yield from chunk
+
     # Count what we'll do, so we can give a better indication of progress
-    count = count_rows(sourcedbname, sourcetable, pid)
+    if source_rows is not None:
+        count = len(source_rows)
+    else:
+        count = count_rows_for_progress(sourcedbname, sourcetable, pid)
     n = 0
     recnum = tasknum or 0
 
     # Process the rows
-    for row in gen_rows(sourcedbname, sourcetable, sourcefields,
-                        pid, debuglimit=debuglimit,
-                        intpkname=intpkname, tasknum=tasknum, ntasks=ntasks):
-        n += 1
-        if n % config.report_every_n_rows == 0:
-            log.info(
-                start + "processing record {recnum}/{count}{for_pt} "
-                "({progress})".format(
-                    n=n, recnum=recnum+1, count=count,
-                    for_pt=" for this patient" if pid is not None else "",
-                    progress=config.overall_progress()))
-        recnum += ntasks or 1
-        if addhash:
-            srchash = config.hash_object(row)
-            if incremental and identical_record_exists_by_hash(
-                    dest_table, dest_pk_name, row[pkfield_index], srchash):
-                log.debug(
-                    "... ... skipping unchanged record (identical by hash): "
-                    "{sd}.{st}.{spkf} = "
-                    "(destination) {dt}.{dpkf} = {pkv}".format(
-                        sd=sourcedbname, st=sourcetable, spkf=src_pk_name,
-                        dt=dest_table, dpkf=dest_pk_name,
-                        pkv=row[pkfield_index]))
-                continue
-        if constant:
-            if incremental and identical_record_exists_by_pk(
-                    dest_table, dest_pk_name, row[pkfield_index]):
-                log.debug(
-                    "... ... skipping unchanged record (identical by PK and "
-                    "marked as constant): {sd}.{st}.{spkf} = "
-                    "(destination) {dt}.{dpkf} = {pkv}".format(
-                        sd=sourcedbname, st=sourcetable, spkf=src_pk_name,
-                        dt=dest_table, dpkf=dest_pk_name,
-                        pkv=row[pkfield_index]))
-                continue
-        destvalues = {}
-        skip_row = False
-        for i, ddr in enumerate(ddrows):
-            value = row[i]
-            if ddr.skip_row_by_value(value):
-                # log.debug("skipping row based on inclusion/exclusion values")
-                skip_row = True
-                break  # skip row
-            # NOTE: would be most efficient if ddrows were ordered with
-            # inclusion/exclusion fields first. (Not yet done automatically.)
-            if ddr.omit:
-                continue  # skip column
-
-            if ddr.primary_pid:
-                assert(value == patient.get_pid())
-                value = patient.get_rid()
-            elif ddr.master_pid:
-                value = config.encrypt_master_pid(value)
-
-            for alter_method in ddr.get_alter_methods():
-                value, skiprow = alter_method.alter(
-                    value=value, ddr=ddr, row=row,
-                    ddrows=ddrows, patient=patient)
-                if skiprow:
-                    break  # from alter method loop
-
-            if skip_row:
-                break  # from data dictionary row (field) loop
-
-            destvalues[ddr.dest_field] = value
-
-        if skip_row or not destvalues:
-            continue  # next row
-
-        if addhash:
-            destvalues[config.source_hash_fieldname] = srchash
-        if addtrid:
-            destvalues[config.trid_fieldname] = patient.get_trid()
-
-        q = sqla_table.insert_on_duplicate().values(destvalues)
-        session.execute(q)
-
-        # Trigger an early commit?
-        config.notify_dest_db_transaction(
-            n_rows=1, n_bytes=sys.getsizeof(destvalues))  # ... approximate!
-        # ... quicker than e.g. len(repr(...)), as judged by a timeit() call.
-
-    log.debug(start + "finished: pid={}".format(pid))
+    if pipelined and not bulk_load:
+        writer = make_background_dest_writer(insert_query)
+    lease = _patient_batch_lease if pid is not None else None
+    try:
+        for row in gen_source_rows():
+            n += 1
+            if lease is not None:
+                lease.renew_if_due()  # for patients with a lot of data
+            if n % config.report_every_n_rows == 0:
+                log.info(
+                    start + "processing record {recnum}{count}{for_pt} "
+                    "({progress})".format(
+                        n=n, recnum=recnum+1,
+                        count="" if count is None else "/{}".format(count),
+                        for_pt=" for this patient" if pid is not None else "",
+                        progress=config.overall_progress()))
+            recnum += ntasks or 1
+            if addhash:
+                srchash = config.hash_object(row)
+                if bulk_lookup:
+                    unchanged = (
+                        dest_hashes.get(get_dest_pk_value(row)) == srchash)
+                else:
+                    unchanged = (
+                        incremental and identical_record_exists_by_hash(
+                            dest_table, dest_pk_name, get_dest_pk_value(row),
+                            srchash))
+                if unchanged:
+                    log.debug(
+                        "... ... skipping unchanged record (identical by "
+                        "hash): {sd}.{st}.{spkf} = "
+                        "(destination) {dt}.{dpkf} = {pkv}".format(
+                            sd=sourcedbname, st=sourcetable, spkf=src_pk_name,
+                            dt=dest_table, dpkf=dest_pk_name,
+                            pkv=row[pkfield_index]))
+                    continue
+            if constant:
+                if bulk_lookup:
+                    unchanged = get_dest_pk_value(row) in dest_hashes
+                else:
+                    unchanged = (
+                        incremental and identical_record_exists_by_pk(
+                            dest_table, dest_pk_name, get_dest_pk_value(row)))
+                if unchanged:
+                    log.debug(
+                        "... ... skipping unchanged record (identical by PK "
+                        "and marked as constant): {sd}.{st}.{spkf} = "
+                        "(destination) {dt}.{dpkf} = {pkv}".format(
+                            sd=sourcedbname, st=sourcetable, spkf=src_pk_name,
+                            dt=dest_table, dpkf=dest_pk_name,
+                            pkv=row[pkfield_index]))
+                    continue
+            destvalues = plan.transform(row, patient, row_deferred,
+                                        min_deferred_length)
+            if destvalues is None:
+                continue  # next row
+            if row_deferred:
+                # Scrub in the pool (see flush()).
+                deferred.extend((len(records), field, text)
+                                for field, text in row_deferred)
+                row_deferred.clear()
+
+            if addhash:
+                destvalues[config.source_hash_fieldname] = srchash
+            if addtrid:
+                destvalues[config.trid_fieldname] = patient.get_trid()
+
+            records.append(destvalues)
+            n_bytes_in_records += sys.getsizeof(destvalues)  # approximate!
+            # ... quicker than e.g. len(repr(...)), as judged by a timeit()
+            # call.
+            if len(records) >= max_rows_per_insert:
+                flush()
+
+        flush()  # remainder
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
+    if writer:
+        writer.finish()
+    log.debug(start + "finished: pid={}, {} rows read".format(pid, n))
     commit_destdb()
 
 
-def create_indexes(tasknum: int = 0, ntasks: int = 1) -> None:
+def estimate_index_cost(tablename: str,
+                        tablerows: List[DataDictionaryRow],
+                        n_rows: int) -> int:
     """
-    Create indexes for the destination tables.
+    Rough relative cost of building a destination table's indexes: the
+    number of rows times the total width of the indexed values, with
+    full-text indexes weighted more heavily.
+    """
+    sqla_table = config.dd.get_dest_sqla_table(tablename)
+    width = 0
+    for tr in tablerows:
+        coltype = sqla_table.columns[tr.dest_field].type
+        if tr.indexlen:
+            colwidth = tr.indexlen
+        elif is_sqlatype_string(coltype):
+            colwidth = (getattr(coltype, 'length', None) or
+                        INDEX_COST_UNBOUNDED_TEXT_WIDTH)
+        else:
+            colwidth = INDEX_COST_DEFAULT_WIDTH
+        if tr.index is INDEX.FULLTEXT:
+            colwidth *= INDEX_COST_FULLTEXT_FACTOR
+        if tr.primary_pid:
+            colwidth += INDEX_COST_DEFAULT_WIDTH  # TRID index, too
+        width += colwidth
+    return max(n_rows, 1) * width
+
+
+def get_index_jobs() -> List[Tuple[str, List[DataDictionaryRow], int]]:
+    """
+    Returns (table, list-of-DD-rows-for-indexed-fields, estimated cost)
+    tuples for all tables requiring indexing, most costly first.
+    """
+    jobs = []  # type: List[Tuple[str, List[DataDictionaryRow], int]]
+    for tablename, tablerows in gen_index_row_sets_by_table():
+        n_rows = estimate_count_star(config.destdb.session, tablename)
+        jobs.append((tablename, tablerows,
+                     estimate_index_cost(tablename, tablerows, n_rows)))
+    jobs.sort(key=lambda job: (-job[2], job[0]))  # same order for all tasks
+    return jobs
+
+
+def create_indexes_for_table(engine: Engine,
+                             tablename: str,
+                             tablerows: List[DataDictionaryRow]) -> None:
+    """
+    Create the indexes for one destination table.
     """
-    log.info(SEP + "Create indexes")
-    engine = config.get_destdb_engine_outside_transaction()
     mssql = engine.dialect.name == 'mssql'
-    mssql_fulltext_columns_by_table = []  # type: List[List[Column]]
-    for (tablename, tablerows) in gen_index_row_sets_by_table(tasknum=tasknum,
-                                                              ntasks=ntasks):
-        sqla_table = config.dd.get_dest_sqla_table(tablename)
-        mssql_fulltext_columns = []  # type: List[Column]
-        for tr in tablerows:
-            sqla_column = sqla_table.columns[tr.dest_field]
-            fulltext = (tr.index is INDEX.FULLTEXT)
-            if fulltext and mssql:
-                # Special processing: we can only create one full-text index
-                # per table under SQL Server, but it can cover multiple
-                # columns; see below
-                mssql_fulltext_columns.append(sqla_column)
-            else:
-                add_index(engine=engine,
-                          sqla_column=sqla_column,
-                          unique=(tr.index is INDEX.UNIQUE),
-                          fulltext=fulltext,
-                          length=tr.indexlen)
-            # Extra index for TRID?
-            if tr.primary_pid:
-                add_index(engine, sqla_table.columns[config.trid_fieldname],
-                          unique=(tr.index is INDEX.UNIQUE))
-        if mssql_fulltext_columns:
-            mssql_fulltext_columns_by_table.append(mssql_fulltext_columns)
+    sqla_table = config.dd.get_dest_sqla_table(tablename)
+    mssql_fulltext_columns = []  # type: List[Column]
+    for tr in tablerows:
+        sqla_column = sqla_table.columns[tr.dest_field]
+        fulltext = (tr.index is INDEX.FULLTEXT)
+        if fulltext and mssql:
+            # Special processing: we can only create one full-text index
+            # per table under SQL Server, but it can cover multiple
+            # columns; see below
+            mssql_fulltext_columns.append(sqla_column)
+        else:
+            add_index(engine=engine,
+                      sqla_column=sqla_column,
+                      unique=(tr.index is INDEX.UNIQUE),
+                      fulltext=fulltext,
+                      length=tr.indexlen)
+        # Extra index for TRID?
+        if tr.primary_pid:
+            add_index(engine, sqla_table.columns[config.trid_fieldname],
+                      unique=(tr.index is INDEX.UNIQUE))
     # Special processing for SQL Server FULLTEXT indexes, if any:
-    for multiple_sqla_columns in mssql_fulltext_columns_by_table:
+    if mssql_fulltext_columns:
         add_index(engine=engine,
-                  multiple_sqla_columns=multiple_sqla_columns,
+                  multiple_sqla_columns=mssql_fulltext_columns,
                   fulltext=True)
 
 
+def create_indexes(tasknum: int = 0, ntasks: int = 1,
+                   resume: bool = False) -> None:
+    """
+    Create indexes for the destination tables.
+
+    Tables are handed out biggest first: each process walks down the same
+    list, ordered by estimated cost (see get_index_jobs()), and claims the
+    next table that no other process has claimed (see IndexJob).
+
+    Tables indexed before this step started (by create_indexes_when_loaded(),
+    or by an earlier --index step) are released first, so every table is
+    checked; add_index() skips indexes that already exist, so that's quick.
+    With resume, they're skipped instead.
+    """
+    log.info(SEP + "Create indexes: task {}/{}".format(tasknum, ntasks))
+    step_start = datetime.datetime.utcnow()
+    engine = config.get_destdb_engine_outside_transaction()
+    adminsession = config.admindb.session
+    try:
+        # The admin database may predate the index queue.
+        IndexJob.__table__.create(config.admindb.engine, checkfirst=True)
+    except DatabaseError:
+        pass  # another index process created it first
+    if not resume:
+        n_released = IndexJob.release_completed(adminsession, step_start)
+        if n_released:
+            log.info("Checking {} table(s) indexed previously".format(
+                n_released))
+    worker = get_worker_name(tasknum)
+    for tablename, tablerows, cost in get_index_jobs():
+        if not IndexJob.claim(adminsession, tablename, cost, worker):
+            continue
+        log.info("Indexing table {} (estimated cost {})".format(tablename,
+                                                                 cost))
+        create_indexes_for_table(engine, tablename, tablerows)
+        IndexJob.complete(adminsession, tablename)
+
+
+def create_indexes_when_loaded(srcdbname: str,
+                               src_table: str,
+                               tasknum: int = 0) -> None:
+    """
+    For a non-patient table that this process has loaded in full: if the
+    config asks, index its destination table now, rather than waiting for
+    all other data to be processed. Skipped if other source tables feed the
+    same destination table.
+    """
+    if not config.index_tables_when_loaded:
+        return
+    dest_table = config.dd.get_dest_table_for_src_db_table(srcdbname,
+                                                           src_table)
+    tablerows = [ddr for ddr in config.dd.get_rows_for_dest_table(dest_table)
+                 if ddr.index and not ddr.omit]
+    if not tablerows:
+        return
+    if any(dest_table in config.dd.get_dest_tables_for_src_db_table(d, t)
+           for d, t in config.dd.get_src_db_tablepairs()
+           if (d, t) != (srcdbname, src_table)):
+        return
+    if n_rows_awaiting_bulk_load():
+        load_spooled_rows()
+    n_rows = estimate_count_star(config.destdb.session, dest_table)
+    cost = estimate_index_cost(dest_table, tablerows, n_rows)
+    if not IndexJob.claim(config.admindb.session, dest_table, cost,
+                          get_worker_name(tasknum)):
+        return
+    log.info("Indexing table {} now that it's loaded".format(dest_table))
+    create_indexes_for_table(config.get_destdb_engine_outside_transaction(),
+                             dest_table, tablerows)
+    IndexJob.complete(config.admindb.session, dest_table)
+
+
+def drop_indexes_for_rebuild() -> None:
+    """
+    Drop the indexes that create_indexes() makes, except those on PK and
+    patient ID fields (which incremental processing uses to find existing
+    rows), so that loading data needn't maintain them. They're rebuilt by
+    the --index step.
+    """
+    log.info("Dropping indexes, to be rebuilt after loading")
+    engine = config.get_destdb_engine_outside_transaction()
+    for tablename, tablerows in gen_index_row_sets_by_table():
+        sqla_table = config.dd.get_dest_sqla_table(tablename)
+        for tr in tablerows:
+            if tr.pk or tr.primary_pid:
+                continue
+            drop_index(engine, sqla_table.columns[tr.dest_field],
+                       fulltext=(tr.index is INDEX.FULLTEXT))
+
+
 def patient_processing_fn(tasknum: int = 0,
                           ntasks: int = 1,
-                          incremental: bool = False) -> None:
+                          incremental: bool = False,
+                          resume: bool = False) -> None:
     """
     Iterate through patient IDs;
         build the scrubber for each patient;
         process source data for that patient, scrubbing it;
         insert the patient into the mapping table in the admin database.
     """
-    n_patients = estimate_count_patients() // ntasks
+    n_patients = estimate_count_patients()
+    if n_patients is not None:
+        n_patients //= ntasks
+    scrub_pool = None  # type: ScrubberPool
+    if config.scrub_pool_processes > 0:
+        scrub_pool = ScrubberPool(config.scrub_pool_processes,
+                                  config.nonspecific_scrubber,
+                                  single_pass=config.scrub_single_pass)
+    try:
+        _process_patients(tasknum=tasknum, ntasks=ntasks,
+                          incremental=incremental, n_patients=n_patients,
+                          scrub_pool=scrub_pool, resume=resume)
+        load_spooled_rows()
+    except BaseException:
+        discard_spooled_rows()
+        raise
+    finally:
+        if scrub_pool:
+            scrub_pool.close()
+    commit_destdb()
+
+
+def _process_patients(tasknum: int,
+                      ntasks: int,
+                      incremental: bool,
+                      n_patients: Optional[int],
+                      scrub_pool: ScrubberPool = None,
+                      resume: bool = False) -> None:
     i = 0
-    for pid in gen_patient_ids(tasknum, ntasks):
+    adminsession = config.admindb.session
+    dd_version = config.dd.get_version_hash()
+    scan = None  # type: PatientTableScan
+    if config.stream_patient_tables:
+        scan = make_patient_table_scan(tasknum, ntasks)
+        pidgen = gen_patient_ids_from_scan(scan)
+    elif config.dynamic_patient_scheduling:
+        pidgen = gen_patient_ids_from_queue(tasknum)
+    else:
+        pidgen = gen_patient_ids(tasknum, ntasks)
+    fetcher = None  # type: ScrubSourceFetcher
+    if config.scrub_src_fetch_block_size > 0:
+        fetcher = ScrubSourceFetcher(
+            block_size=config.scrub_src_fetch_block_size,
+            max_depth=config.thirdparty_xref_max_depth)
+        pidgen = fetcher.gen_patient_ids(pidgen)
+    for pid in pidgen:
         # gen_patient_ids() assigns the work to the appropriate thread/process
+        # (or, for dynamic scheduling, gen_patient_ids_from_queue() does)
         # Check for an abort signal once per patient processed
         i += 1
         log.info(
             "Processing patient ID: {pid} (incremental={incremental}; "
-            "patient {i}/~{n_patients} for this process; {progress})".format(
-                pid=pid, incremental=incremental, i=i, n_patients=n_patients,
+            "patient {i}{n_patients} for this process; {progress})".format(
+                pid=pid, incremental=incremental, i=i,
+                n_patients=("" if n_patients is None
+                            else "/~{}".format(n_patients)),
                 progress=config.overall_progress()))
 
         # Opt out based on PID?
@@ -771,7 +1970,7 @@ def patient_processing_fn(tasknum: int = 0,
         # we do as we build the scrubber).
 
         # Gather scrubbing information for a patient. (Will save.)
-        patient = Patient(pid)
+        patient = Patient(pid, scan=scan, fetcher=fetcher)
 
         if patient.mandatory_scrubbers_unfulfilled:
             log.warning(
@@ -792,17 +1991,51 @@ def patient_processing_fn(tasknum: int = 0,
             else:
                 log.debug("Scrubber new or changed; reprocessing in full")
 
+        # Resuming? Then skip tables already done for this patient (with the
+        # same scrubber).
+        unit = ProgressLedgerEntry.patient_unit(pid)
+        scrubber_hash = patient.get_scrubber_hash()
+        completed = []  # type: List[Tuple[str, str]]
+        if resume:
+            completed = ProgressLedgerEntry.get_completed(
+                adminsession, unit, dd_version, scrubber_hash)
+        processed = []  # type: List[Tuple[str, str]]
+        # Only patients reached by the interrupted run (or, with dynamic
+        # scheduling, by a worker that lost this batch) can have left rows to
+        # delete. (That matters after a full run: its destination tables have
+        # no patient ID indexes yet, so each delete is a table scan.)
+        reclaimed = (_patient_batch_lease is not None and
+                     _patient_batch_lease.reclaimed)
+        delete_existing = (resume or reclaimed) and patient.seen_before()
+
         # For each source database/table...
         for d in config.dd.get_source_databases():
             log.debug("Patient {}, processing database: {}".format(pid, d))
             for t in config.dd.get_patient_src_tables_with_active_dest(d):
+                if (d, t) in completed:
+                    log.debug("Patient {}, table {}.{} already done".format(
+                        pid, d, t))
+                    continue
                 log.debug("Patient {}, processing table {}.{}".format(
                     pid, d, t))
+                source_rows = None  # type: List[List[Any]]
+                if scan is not None:
+                    fields = [ddr.src_field
+                              for ddr in get_ddrows_to_process(d, t)]
+                    if not fields:
+                        continue
+                    source_rows = scan.get_rows(
+                        d, t, config.dd.get_pid_name(d, t), fields)
                 process_table(d, t,
                               patient=patient,
-                              incremental=(incremental and patient_unchanged))
+                              incremental=(incremental and patient_unchanged),
+                              scrub_pool=scrub_pool,
+                              source_rows=source_rows,
+                              delete_existing=delete_existing)
+                processed.append((d, t))
 
-    commit_destdb()
+        # Record the work as done (once it's committed).
+        record_progress(unit, processed, dd_version, scrubber_hash)
 
 
 def wipe_opt_out_patients(report_every: int = 1000,
@@ -895,7 +2128,8 @@ def drop_remake(incremental: bool = False,
     """
     Drop and rebuild (a) mapping table, (b) destination tables.
     If incremental is True, doesn't drop tables; just deletes destination
-    information where source information no longer exists.
+    information where source information no longer exists (except for tables
+    left to delete_dead_dest_rows(); see deletes_by_sorted_diff()).
     """
     log.info(SEP + "Creating database structure +/- deleting dead data")
     engine = config.admindb.engine
@@ -904,17 +2138,34 @@ def drop_remake(incremental: bool = False,
         # not OptOut
         PatientInfo.__table__.drop(engine, checkfirst=True)
         TridRecord.__table__.drop(engine, checkfirst=True)
+        ScrubberElementStore.__table__.drop(engine, checkfirst=True)
+        PatientQueueEntry.__table__.drop(engine, checkfirst=True)
+        PatientBatch.__table__.drop(engine, checkfirst=True)
+    log.info("Wiping progress ledger and index queue")  # a new run starts
+    ProgressLedgerEntry.__table__.drop(engine, checkfirst=True)
+    IndexJob.__table__.drop(engine, checkfirst=True)
     log.info("Creating admin tables")
     OptOutPid.__table__.create(engine, checkfirst=True)
     OptOutMpid.__table__.create(engine, checkfirst=True)
     PatientInfo.__table__.create(engine, checkfirst=True)
     TridRecord.__table__.create(engine, checkfirst=True)
+    ScrubberElementStore.__table__.create(engine, checkfirst=True)
+    PatientQueueEntry.__table__.create(engine, checkfirst=True)
+    PatientBatch.__table__.create(engine, checkfirst=True)
+    ProgressLedgerEntry.__table__.create(engine, checkfirst=True)
+    IndexJob.__table__.create(engine, checkfirst=True)
+    SourceWatermark.__table__.create(engine, checkfirst=True)
+    start_watermarks(incremental=incremental)
 
     wipe_and_recreate_destination_db(incremental=incremental)
+    if incremental and config.rebuild_indexes_incremental:
+        drop_indexes_for_rebuild()
     if skipdelete or not incremental:
         return
     for d in config.dd.get_source_databases():
         for t in config.dd.get_src_tables(d):
+            if deletes_by_sorted_diff(d, t):
+                continue
             delete_dest_rows_with_no_src_row(
                 d, t, report_every=config.report_every_n_rows,
                 chunksize=config.chunksize)
@@ -965,7 +2216,6 @@ def gen_opt_out_pids_from_database(mpid: bool = False) -> Generator[int, None,
         if not id_colname:
             continue
         found_one = True
-        session = config.sources[src_db].session
         log.info("... {}.{}.{} ({}={})".format(
             src_db, src_table, optout_colname, text, id_colname))
         sqla_table = table(src_table)
@@ -978,8 +2228,7 @@ def gen_opt_out_pids_from_database(mpid: bool = False) -> Generator[int, None,
             distinct()
         )
         # no need for an order_by clause
-        result = session.execute(query)
-        for row in result:
+        for row in config.sources[src_db].gen_query_rows(query):
             pid = row[0]
             yield pid
     if not found_one:
@@ -1007,6 +2256,7 @@ def setup_opt_out(incremental: bool = False) -> None:
         OptOutMpid.add(adminsession, mpid)
 
     adminsession.commit()
+    clear_optout_filters()
     if not incremental:
         return
     wipe_opt_out_patients()
@@ -1014,39 +2264,156 @@ def setup_opt_out(incremental: bool = False) -> None:
 
 def process_nonpatient_tables(tasknum: int = 0,
                               ntasks: int = 1,
-                              incremental: bool = False) -> None:
+                              incremental: bool = False,
+                              resume: bool = False) -> None:
     """
     Copies all non-patient tables.
     If they have an integer PK, the work may be parallelized.
     If not, whole tables are assigned to different processes in parallel mode.
+    Each table, or each process's share of it, is a unit of work recorded in
+    the progress ledger; if resume is set, units already done are skipped.
     """
+    adminsession = config.admindb.session
+    dd_version = config.dd.get_version_hash()
+
+    def completed(unit_: str, d_: str, t_: str) -> bool:
+        if not resume:
+            return False
+        if (d_, t_) not in ProgressLedgerEntry.get_completed(
+                adminsession, unit_, dd_version):
+            return False
+        log.info("... {}.{} ({}) already done".format(d_, t_, unit_))
+        return True
+
     log.info(SEP + "Non-patient tables: (a) with integer PK")
     for (d, t, pkname) in gen_nonpatient_tables_with_int_pk():
         log.info("Processing non-patient table {}.{} (PK: {}) ({})...".format(
             d, t, pkname, config.overall_progress()))
-        # noinspection PyTypeChecker
-        process_table(d, t, patient=None,
-                      incremental=incremental,
-                      intpkname=pkname, tasknum=tasknum, ntasks=ntasks)
-        commit_destdb()
+        pk_ranges = get_task_pk_ranges(d, t, pkname, tasknum, ntasks)
+        if pk_ranges is None:
+            units = [("pk%{}={}".format(ntasks, tasknum), None)]
+        else:
+            units = [("pk:{}-{}".format(first, last), [(first, last)])
+                     for first, last in pk_ranges]
+        for unit, unit_pk_ranges in units:
+            if completed(unit, d, t):
+                continue
+            # noinspection PyTypeChecker
+            process_table(d, t, patient=None,
+                          incremental=incremental,
+                          intpkname=pkname, tasknum=tasknum, ntasks=ntasks,
+                          pk_ranges=unit_pk_ranges, delete_existing=resume)
+            record_progress(unit, [(d, t)], dd_version)
+        report_memory_high_water_mark("after table {}.{}".format(d, t))
+        if ntasks == 1:
+            create_indexes_when_loaded(d, t, tasknum)
     log.info(SEP + "Non-patient tables: (b) without integer PK")
     for (d, t) in gen_nonpatient_tables_without_int_pk(tasknum=tasknum,
                                                        ntasks=ntasks):
         log.info("Processing non-patient table {}.{} ({})...".format(
             d, t, config.overall_progress()))
+        if completed("all", d, t):
+            continue
         # Force this into single-task mode, i.e. we have already parallelized
         # by assigning different tables to different processes; don't split
         # the work within a single table.
         # noinspection PyTypeChecker
         process_table(d, t, patient=None,
                       incremental=incremental,
-                      intpkname=None, tasknum=0, ntasks=1)
-        commit_destdb()
+                      intpkname=None, tasknum=0, ntasks=1,
+                      delete_existing=resume)
+        record_progress("all", [(d, t)], dd_version)
+        report_memory_high_water_mark("after table {}.{}".format(d, t))
+        create_indexes_when_loaded(d, t, tasknum)
+    load_spooled_rows()
+
+
+def build_patient_queue(chunksize: int = DEFAULT_CHUNKSIZE,
+                        resume: bool = False) -> None:
+    """
+    For dynamic scheduling: put all patient IDs into numbered batches in the
+    admin database's work queue, replacing any previous queue. Single-tasking
+    only; run this before launching the patient-processing processes.
+
+    If resume is set and there is a queue already, it's kept (so completed
+    batches aren't redone), but unfinished batches are released from the
+    (presumably dead) processes that held them.
+    """
+    engine = config.admindb.engine
+    session = config.admindb.session
+    PatientQueueEntry.__table__.create(engine, checkfirst=True)
+    PatientBatch.__table__.create(engine, checkfirst=True)
+    if resume and session.query(PatientBatch.batch_num).first() is not None:
+        log.info(SEP + "Resuming: keeping patient work queue; released {} "
+                 "unfinished batches".format(
+                     PatientBatch.release_leases(session)))
+        return
+    log.info(SEP + "Building patient work queue")
+    session.query(PatientQueueEntry).delete(synchronize_session=False)
+    session.query(PatientBatch).delete(synchronize_session=False)
+    batch_size = config.patient_batch_size
+
+    def insert(records_):
+        log.debug("... inserting {} patients".format(len(records_)))
+        session.execute(PatientQueueEntry.__table__.insert(), records_)
+
+    n = 0
+    records = []  # type: List[Dict[str, Any]]
+    for pid in gen_patient_ids():
+        records.append({'pid': pid, 'batch_num': n // batch_size})
+        n += 1
+        if n % chunksize == 0:
+            insert(records)
+            records = []  # type: List[Dict[str, Any]]
+    if records:  # remainder
+        insert(records)
+    n_batches = (n + batch_size - 1) // batch_size
+    if n_batches:
+        session.execute(PatientBatch.__table__.insert(), [
+            {
+                'batch_num': b,
+                'n_patients': min(batch_size, n - b * batch_size),
+                'n_claims': 0,
+                'completed': False,
+            }
+            for b in range(n_batches)
+        ])
+    commit_admindb()
+    log.info("... {} patients in {} batches".format(n, n_batches))
+
+
+def build_secret_map(chunksize: int = DEFAULT_CHUNKSIZE) -> None:
+    """
+    Create mapping (PatientInfo) records, with RIDs and TRIDs, for all
+    patients that don't yet have one, in bulk. Patients opting out by PID are
+    skipped. Single-tasking only; run this before launching the
+    patient-processing processes.
+    """
+    log.info(SEP + "Creating patient mapping records in bulk")
+    session = config.admindb.session
+    existing = set(row[0] for row in session.query(PatientInfo.pid))
+    new_pids = [pid for pid in gen_patient_ids()
+                if pid not in existing and not opting_out_pid(pid)]
+    pid_to_trid = TridRecord.get_trids_bulk(session, new_pids,
+                                            chunksize=chunksize)
+    for start in range(0, len(new_pids), chunksize):
+        pids = new_pids[start:start + chunksize]
+        session.execute(PatientInfo.__table__.insert(), [
+            {
+                'pid': pid,
+                'rid': rid,
+                'trid': pid_to_trid[pid],
+            }
+            for pid, rid in zip(pids, config.encrypt_primary_pids(pids))
+        ])
+        commit_admindb()
+    log.info("... {} new patients".format(len(new_pids)))
 
 
 def process_patient_tables(tasknum: int = 0,
                            ntasks: int = 1,
-                           incremental: bool = False) -> None:
+                           incremental: bool = False,
+                           resume: bool = False) -> None:
     """
     Process all patient tables, optionally in a parallel-processing fashion.
     """
@@ -1058,12 +2425,14 @@ def process_patient_tables(tasknum: int = 0,
         log.info("PROCESS {} (numbered from zero) OF {} PROCESSES".format(
             tasknum, ntasks))
     patient_processing_fn(tasknum=tasknum, ntasks=ntasks,
-                          incremental=incremental)
+                          incremental=incremental, resume=resume)
 
     if ntasks > 1:
         log.info("Process {}: FINISHED ANONYMISATION".format(tasknum))
     else:
         log.info("FINISHED ANONYMISATION")
+    config.report_pid_hash_cache_stats()
+    config.report_scrub_cache_stats()
 
     # Commit (should be redundant)
     commit_destdb()
@@ -1096,6 +2465,36 @@ def show_dest_counts() -> None:
     print_record_counts(counts)
 
 
+def show_worker_throughput() -> None:
+    """
+    Show per-worker patient throughput, from the work queue used for dynamic
+    scheduling.
+    """
+    print("PATIENT THROUGHPUT BY WORKER:")
+    session = config.admindb.session
+    stats = {}  # type: Dict[str, List[Any]]
+    n_outstanding = 0
+    n_reclaimed = 0
+    for batch in session.query(PatientBatch):
+        if batch.n_claims > 1:
+            n_reclaimed += 1
+        if not batch.completed:
+            n_outstanding += 1
+            continue
+        s = stats.setdefault(batch.worker, [0, 0, 0.0])
+        s[0] += 1
+        s[1] += batch.n_patients
+        s[2] += (batch.completed_at_utc -
+                 batch.claimed_at_utc).total_seconds()
+    for worker in sorted(stats.keys()):
+        n_batches, n_patients, seconds = stats[worker]
+        print("{}: {} batches, {} patients in {:.1f} s ({} patients/s)".format(
+            worker, n_batches, n_patients, seconds,
+            "{:.2f}".format(n_patients / seconds) if seconds else "?"))
+    print("Batches reclaimed after lease expiry: {}".format(n_reclaimed))
+    print("Batches not completed: {}".format(n_outstanding))
+
+
 # =============================================================================
 # Main
 # =============================================================================
@@ -1112,11 +2511,17 @@ def anonymise(args: Any) -> None:
             "--process argument must be from 0 to (nprocesses - 1) inclusive")
     if args.nprocesses > 1 and args.dropremake:
         raise ValueError("Can't use nprocesses > 1 with --dropremake")
+    if args.nprocesses > 1 and args.patientqueue:
+        raise ValueError("Can't use nprocesses > 1 with --patientqueue")
+    if args.nprocesses > 1 and args.savewatermarks:
+        raise ValueError("Can't use nprocesses > 1 with --savewatermarks")
     if args.incrementaldd and args.draftdd:
         raise ValueError("Can't use --incrementaldd and --draftdd")
 
-    everything = not any([args.dropremake, args.optout, args.nonpatienttables,
-                          args.patienttables, args.index])
+    everything = not any([args.dropremake, args.deletedead, args.optout,
+                          args.patientqueue, args.nonpatienttables,
+                          args.patienttables, args.savewatermarks,
+                          args.index])
 
     # Load/validate config
     config.report_every_n_rows = args.reportevery
@@ -1136,12 +2541,21 @@ def anonymise(args: Any) -> None:
         return
 
     config.check_valid()
+    if config.bulk_load and args.incremental:
+        # Bulk loaders can only add rows, not replace them.
+        log.info("Incremental run: not using bulk_load")
+        config.bulk_load = False
 
     if args.count:
         show_source_counts()
         show_dest_counts()
         return
 
+    if args.workerreport:
+        if config.dynamic_patient_scheduling:
+            show_worker_throughput()
+        return
+
     # random number seed
     random.seed(args.seed)
 
@@ -1149,36 +2563,520 @@ def anonymise(args: Any) -> None:
 
     log.info(BIGSEP + "Starting")
     start = get_now_utc()
+    if config.progress_ledger or args.resume:
+        start_progress_ledger()
 
     # 1. Drop/remake tables. Single-tasking only.
     if args.dropremake or everything:
-        drop_remake(incremental=args.incremental,
-                    skipdelete=args.skipdelete)
+        if args.resume:
+            log.info("Resuming an interrupted run: not dropping/remaking "
+                     "tables")
+            ProgressLedgerEntry.__table__.create(config.admindb.engine,
+                                                 checkfirst=True)
+            IndexJob.__table__.create(config.admindb.engine, checkfirst=True)
+            IndexJob.release_incomplete(config.admindb.session)
+        else:
+            drop_remake(incremental=args.incremental,
+                        skipdelete=args.skipdelete)
+
+    # 1b. Delete dead destination rows by sorted diff, where configured.
+    if ((args.deletedead or everything) and
+            args.incremental and not args.skipdelete):
+        delete_dead_dest_rows(tasknum=args.process, ntasks=args.nprocesses)
 
     # 2. Deal with opt-outs
     if args.optout or everything:
         setup_opt_out(incremental=args.incremental)
 
-    # 3. Tables with patient info.
+    # 3a. Patient mapping records, and the work queue for dynamic scheduling
+    #     of patients. Single-tasking only.
+    if args.patientqueue or everything:
+        if config.bulk_secret_map:
+            build_secret_map(chunksize=config.chunksize)
+        if config.dynamic_patient_scheduling:
+            build_patient_queue(chunksize=config.chunksize,
+                                resume=args.resume)
+        elif args.patientqueue and not config.bulk_secret_map:
+            log.info("Not using dynamic_patient_scheduling; no patient work "
+                     "queue required")
+
+    # 3b. Tables with patient info.
     #    Process PER PATIENT, across all tables, because we have to synthesize
     #    information to scrub across the entirety of that patient's record.
     if args.patienttables or everything:
         process_patient_tables(tasknum=args.process,
                                ntasks=args.nprocesses,
-                               incremental=args.incremental)
+                               incremental=args.incremental,
+                               resume=args.resume)
 
     # 4. Tables without any patient ID (e.g. lookup tables). Process PER TABLE.
     if args.nonpatienttables or everything:
         process_nonpatient_tables(tasknum=args.process,
                                   ntasks=args.nprocesses,
-                                  incremental=args.incremental)
+                                  incremental=args.incremental,
+                                  resume=args.resume)
+
+    # 4b. Data processing done; record source high-water marks for next time.
+    #     Single-tasking only.
+    if args.savewatermarks or everything:
+        save_watermarks()
 
     # 5. Indexes. ALWAYS FASTEST TO DO THIS LAST. Process PER TABLE.
     if args.index or everything:
-        create_indexes(tasknum=args.process, ntasks=args.nprocesses)
+        create_indexes(tasknum=args.process, ntasks=args.nprocesses,
+                       resume=args.resume)
 
     log.info(BIGSEP + "Finished")
     end = get_now_utc()
     time_taken = end - start
     log.info("Time taken: {} seconds".format(time_taken.total_seconds()))
+    report_memory_high_water_mark(force=True)
     # config.dd.debug_cache_hits()
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+# Like anything importing this module, these need a config (see
+# CRATE_ANON_CONFIG), but they use their own admin database, in memory, and
+# don't touch the source databases.
+
+def make_test_admin_db() -> SimpleNamespace:
+    """Returns an in-memory admin database, to stand in for config.admindb.
+    """
+    engine = create_engine("sqlite://")
+    for model in (IndexJob, PatientBatch, PatientQueueEntry,
+                  ProgressLedgerEntry):
+        model.__table__.create(engine)
+    return SimpleNamespace(engine=engine, session=sessionmaker(bind=engine)())
+
+
+class TestProgressLedger(unittest.TestCase):
+    def setUp(self) -> None:
+        global _progress_ledger_started
+        self.admindb = make_test_admin_db()
+        self.patches = [
+            mock.patch.object(config, 'admindb', self.admindb),
+            mock.patch.object(config, 'dd', SimpleNamespace(
+                get_version_hash=lambda: "v1")),
+            mock.patch.object(config, '_dest_db_commit_callbacks', []),
+        ]
+        for p in self.patches:
+            p.start()
+        self.was_started = _progress_ledger_started
+        _progress_ledger_started = False
+        _unwritten_progress.clear()
+
+    def tearDown(self) -> None:
+        global _progress_ledger_started
+        for p in self.patches:
+            p.stop()
+        _progress_ledger_started = self.was_started
+        _unwritten_progress.clear()
+        self.admindb.session.close()
+
+    def completed(self, unit: str,
+                  scrubber_hash: str = None) -> List[Tuple[str, str]]:
+        return sorted(ProgressLedgerEntry.get_completed(
+            self.admindb.session, unit, "v1", scrubber_hash))
+
+    def test_not_recorded_unless_started(self) -> None:
+        record_progress("all", [("db", "t")], "v1")
+        load_spooled_rows()
+        self.assertEqual(self.completed("all"), [])
+
+    def test_written_after_commits(self) -> None:
+        start_progress_ledger()
+        unit = ProgressLedgerEntry.patient_unit(1)
+        record_progress(unit, [("db", "t1"), ("db", "t2")], "v1", "h1")
+        commit_destdb()
+        self.assertEqual(self.completed(unit, "h1"), [])  # waits for more
+        for pid in range(2, LEDGER_ENTRIES_PER_WRITE + 1):
+            record_progress(ProgressLedgerEntry.patient_unit(pid),
+                            [("db", "t1")], "v1", "h1")
+        self.assertEqual(self.completed(unit, "h1"), [])  # not committed
+        commit_destdb()
+        self.assertEqual(self.completed(unit, "h1"),
+                         [("db", "t1"), ("db", "t2")])
+        # A patient whose scrubber has changed must be redone:
+        self.assertEqual(self.completed(unit, "h2"), [])
+
+    def test_resume_skips_finished_work(self) -> None:
+        start_progress_ledger()
+        record_progress("all", [("db", "done")], "v1")
+        load_spooled_rows()  # commits; writes what's waiting
+        tables = [("db", "done"), ("db", "new")]
+        for resume, expected in ((True, ["new"]), (False, ["done", "new"])):
+            with mock.patch(__name__ + '.process_table') as process, \
+                    mock.patch(__name__ + '.create_indexes_when_loaded'), \
+                    mock.patch(__name__ + '.gen_nonpatient_tables_with_int_pk',
+                               return_value=[]), \
+                    mock.patch(__name__ +
+                               '.gen_nonpatient_tables_without_int_pk',
+                               return_value=tables):
+                process_nonpatient_tables(resume=resume)
+            self.assertEqual([c[0][1] for c in process.call_args_list],
+                             expected)
+        self.assertEqual(self.completed("all"), tables)
+
+
+class TestPkRanges(unittest.TestCase):
+    def check_covers(self, ranges: List[Tuple[int, int]],
+                     pkmin: int, pkmax: int) -> None:
+        # Contiguous, non-overlapping, from pkmin to pkmax.
+        self.assertEqual(ranges[0][0], pkmin)
+        self.assertEqual(ranges[-1][1], pkmax)
+        for (first, last), (next_first, _) in zip(ranges, ranges[1:]):
+            self.assertLessEqual(first, last)
+            self.assertEqual(next_first, last + 1)
+
+    def test_split_pk_span(self) -> None:
+        self.assertEqual(split_pk_span(None, None, 4), [])
+        self.assertEqual(split_pk_span(5, 5, 4), [(5, 5)])
+        self.assertEqual(split_pk_span(1, 10, 3), [(1, 4), (5, 8), (9, 10)])
+        for pkmin, pkmax in ((0, 0), (1, 10), (-7, 12), (3, 1000003),
+                             (2 ** 40, 2 ** 40 + 99)):
+            for n_ranges in range(1, 30):
+                ranges = split_pk_span(pkmin, pkmax, n_ranges)
+                self.assertLessEqual(len(ranges), n_ranges)
+                self.check_covers(ranges, pkmin, pkmax)
+                widths = [last - first + 1 for first, last in ranges]
+                self.assertTrue(all(w == widths[0] for w in widths[:-1]))
+                self.assertLessEqual(widths[-1], widths[0])
+
+    def test_get_task_pk_ranges(self) -> None:
+        pks = [-3, 0, 1, 2, 50, 51, 52, 99, 1000]
+        engine = create_engine("sqlite://")
+        engine.execute("CREATE TABLE t (id INTEGER PRIMARY KEY)")
+        session = sessionmaker(bind=engine)()
+        session.execute(table("t", column("id")).insert(),
+                        [{"id": pk} for pk in pks])
+        fake_config = SimpleNamespace(pk_range_partitioning=True,
+                                      pk_ranges_per_process=1,
+                                      sources={"db": SimpleNamespace(
+                                          session=session)})
+        with mock.patch(__name__ + '.config', fake_config):
+            for per_process in (1, 2, 3):
+                fake_config.pk_ranges_per_process = per_process
+                for ntasks in range(1, 12):
+                    task_ranges = [get_task_pk_ranges("db", "t", "id",
+                                                      tasknum, ntasks)
+                                   for tasknum in range(ntasks)]
+                    for ranges in task_ranges:
+                        self.assertEqual(ranges, sorted(ranges))
+                    self.check_covers(sorted(sum(task_ranges, [])),
+                                      min(pks), max(pks))
+                    # Each row belongs to exactly one task.
+                    for pk in pks:
+                        self.assertEqual(
+                            sum(1 for ranges in task_ranges
+                                for first, last in ranges
+                                if first <= pk <= last), 1)
+            fake_config.pk_range_partitioning = False
+            self.assertIsNone(get_task_pk_ranges("db", "t", "id", 0, 2))
+        session.close()
+
+
+class TestSortedDiffDeletion(unittest.TestCase):
+    SRC_PKS = [1, 2, 4, 7, 8, 10, 15]
+    DEST_PKS = [1, 2, 3, 4, 5, 6, 9, 10, 11, 15, 20]
+
+    def setUp(self) -> None:
+        def make_db(tablename: str, pkname: str,
+                    pks: List[int]) -> SimpleNamespace:
+            engine = create_engine("sqlite://")
+            engine.execute("CREATE TABLE {} ({} INTEGER PRIMARY KEY)".format(
+                tablename, pkname))
+            session = sessionmaker(bind=engine)()
+            session.execute(table(tablename, column(pkname)).insert(),
+                            [{pkname: pk} for pk in pks])
+            session.commit()
+            return SimpleNamespace(name=tablename, session=session)
+
+        self.srcdb = make_db("src", "id", self.SRC_PKS)
+        self.destdb = make_db("dest", "id_d", self.DEST_PKS)
+        self.pkddr = SimpleNamespace(src_field="id", dest_field="id_d",
+                                     omit=False, primary_pid=False,
+                                     master_pid=False, addition_only=False)
+        self.int_pk_ddr = self.pkddr
+        self.config = SimpleNamespace(
+            chunksize=2,
+            deletion_method=DELETIONMETHOD.SORTED_DIFF,
+            destdb=self.destdb,
+            pk_ranges_per_process=2,
+            sources={"db": self.srcdb},
+            dd=SimpleNamespace(
+                get_dest_sqla_table=lambda t: table(t, column("id_d")),
+                get_dest_table_for_src_db_table=lambda d, t: "dest",
+                get_int_pk_ddr=lambda d, t: self.int_pk_ddr,
+                get_pk_ddr=lambda d, t: self.pkddr,
+                get_source_databases=lambda: ["db"],
+                get_src_tables=lambda d: ["src"],
+                has_active_destination=lambda d, t: True,
+            ),
+        )
+        self.patches = [
+            mock.patch(__name__ + '.config', self.config),
+            mock.patch(__name__ + '.commit_destdb'),
+            mock.patch(__name__ + '.MAX_IN_CLAUSE_VALUES', 2),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self) -> None:
+        for p in self.patches:
+            p.stop()
+        self.srcdb.session.close()
+        self.destdb.session.close()
+
+    def dest_pks(self) -> List[int]:
+        return [row[0] for row in self.destdb.session.execute(
+            "SELECT id_d FROM dest ORDER BY id_d")]
+
+    def test_applies(self) -> None:
+        self.assertTrue(deletes_by_sorted_diff("db", "src"))
+        for attr in ("omit", "primary_pid", "master_pid", "addition_only"):
+            with mock.patch.object(self.pkddr, attr, True):
+                self.assertFalse(deletes_by_sorted_diff("db", "src"), attr)
+        self.int_pk_ddr = None  # the PK isn't an integer
+        self.assertFalse(deletes_by_sorted_diff("db", "src"))
+        self.int_pk_ddr = self.pkddr
+        self.config.deletion_method = DELETIONMETHOD.TEMPORARY_TABLE
+        self.assertFalse(deletes_by_sorted_diff("db", "src"))
+
+    def test_delete_by_diff(self) -> None:
+        # Pages of two PKs, and deletes of two at a time.
+        self.assertEqual(delete_dest_rows_with_no_src_row_by_diff(
+            "db", "src", (4, 10), page_size=2), 3)
+        self.assertEqual(self.dest_pks(),
+                         [1, 2, 3, 4, 10, 11, 15, 20])  # not 5, 6, 9
+        self.assertEqual(delete_dest_rows_with_no_src_row_by_diff(
+            "db", "src", (1, 20), page_size=2), 3)
+        self.assertEqual(self.dest_pks(), [1, 2, 4, 10, 15])
+
+    def test_delete_dead_rows_across_tasks(self) -> None:
+        # However many tasks share the work, all dead rows go.
+        for ntasks in (1, 2, 3, 7):
+            for tasknum in range(ntasks):
+                delete_dead_dest_rows(tasknum=tasknum, ntasks=ntasks)
+            self.assertEqual(self.dest_pks(), [1, 2, 4, 10, 15])
+            # More dead rows, below, within and above the source's PKs:
+            self.destdb.session.execute(table("dest", column("id_d")).insert(),
+                                        [{"id_d": pk} for pk in (0, 5, 99)])
+
+
+class TestPatientBatch(unittest.TestCase):
+    def setUp(self) -> None:
+        self.admindb = make_test_admin_db()
+        self.session = self.admindb.session
+        self.patches = [
+            mock.patch.object(config, 'admindb', self.admindb),
+            mock.patch.object(config, 'patient_batch_size', 2),
+            mock.patch(__name__ + '.gen_patient_ids',
+                       return_value=[1, 2, 3, 4, 5]),
+        ]
+        for p in self.patches:
+            p.start()
+        build_patient_queue()  # batches 0-2
+
+    def tearDown(self) -> None:
+        for p in self.patches:
+            p.stop()
+        self.session.close()
+
+    def expire_lease(self, batch_num: int) -> None:
+        self.session.query(PatientBatch).filter(
+            PatientBatch.batch_num == batch_num).update({
+                PatientBatch.lease_expires_utc:
+                    datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+            }, synchronize_session=False)
+        self.session.commit()
+
+    def test_claim_expiry_reclaim(self) -> None:
+        s = self.session
+        self.assertEqual(PatientQueueEntry.get_pids(s, 2), [5])
+        self.assertEqual(PatientBatch.claim(s, "w1", 60), 0)
+        self.assertEqual(PatientBatch.claim(s, "w2", 60), 1)
+        self.assertTrue(PatientBatch.renew(s, 0, "w1", 60))
+        self.assertFalse(PatientBatch.was_reclaimed(s, 0))
+        # w1's lease runs out; w3 takes over its batch.
+        self.expire_lease(0)
+        self.assertEqual(PatientBatch.claim(s, "w3", 60), 0)
+        self.assertTrue(PatientBatch.was_reclaimed(s, 0))
+        self.assertFalse(PatientBatch.was_reclaimed(s, 1))
+        self.assertFalse(PatientBatch.renew(s, 0, "w1", 60))
+        self.assertFalse(PatientBatch.complete(s, 0, "w1"))
+        self.assertTrue(PatientBatch.complete(s, 0, "w3"))
+        self.assertEqual(PatientBatch.claim(s, "w4", 60), 2)
+        self.assertIsNone(PatientBatch.claim(s, "w5", 60))  # all taken
+        self.expire_lease(0)  # completed batches are never reclaimed
+        self.assertIsNone(PatientBatch.claim(s, "w5", 60))
+
+    def test_resume_keeps_queue(self) -> None:
+        s = self.session
+        self.assertEqual(PatientBatch.claim(s, "w1", 60), 0)
+        self.assertTrue(PatientBatch.complete(s, 0, "w1"))
+        self.assertEqual(PatientBatch.claim(s, "w2", 60), 1)  # then dies
+        build_patient_queue(resume=True)
+        self.assertEqual(PatientBatch.claim(s, "w3", 60), 1)
+        self.assertTrue(PatientBatch.was_reclaimed(s, 1))
+        self.assertEqual(PatientBatch.claim(s, "w3", 60), 2)
+        # Without resume, the queue starts again.
+        build_patient_queue()
+        self.assertEqual(PatientBatch.claim(s, "w4", 60), 0)
+        self.assertFalse(PatientBatch.was_reclaimed(s, 0))
+
+
+class TestIndexJobs(unittest.TestCase):
+    def setUp(self) -> None:
+        self.admindb = make_test_admin_db()
+        self.patches = [
+            mock.patch.object(config, 'admindb', self.admindb),
+            mock.patch.object(config, 'get_destdb_engine_outside_transaction'),
+            mock.patch(__name__ + '.get_index_jobs', return_value=[
+                ("big", [], 10), ("small", [], 1)]),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self) -> None:
+        for p in self.patches:
+            p.stop()
+        self.admindb.session.close()
+
+    def get_tables_indexed(self, resume: bool = False) -> List[str]:
+        with mock.patch(__name__ + '.create_indexes_for_table') as create:
+            create_indexes(resume=resume)
+        return [c[0][1] for c in create.call_args_list]
+
+    def test_index_step_checks_all_tables(self) -> None:
+        s = self.admindb.session
+        self.assertTrue(IndexJob.claim(s, "small", 1, "loader"))
+        IndexJob.complete(s, "small")  # e.g. when loaded
+        self.assertEqual(self.get_tables_indexed(), ["big", "small"])
+        # A second --index step does it all again...
+        self.assertEqual(self.get_tables_indexed(), ["big", "small"])
+        # ... unless it's resuming, and only unfinished work remains.
+        s.query(IndexJob).filter(IndexJob.dest_table == "big").delete()
+        s.commit()
+        self.assertEqual(self.get_tables_indexed(resume=True), ["big"])
+
+    def test_old_admin_db(self) -> None:
+        IndexJob.__table__.drop(self.admindb.engine)
+        self.assertEqual(self.get_tables_indexed(), ["big", "small"])
+
+
+class TestBulkChangeDetection(unittest.TestCase):
+    """Bulk change detection must skip the same rows as probing each row."""
+    def setUp(self) -> None:
+        engine = create_engine("sqlite://")
+        engine.execute("CREATE TABLE dest (pk, rid, src_hash)")
+        self.session = sessionmaker(bind=engine)()
+        self.ddrows = []  # type: List[SimpleNamespace]
+        self.config = SimpleNamespace(
+            sources={"db": SimpleNamespace(srccfg=SimpleNamespace(
+                debug_limited_tables=[], debug_row_limit=0))},
+            dd=SimpleNamespace(
+                get_rows_for_src_table=lambda db, t: self.ddrows,
+                get_dest_sqla_table=lambda t: mock.MagicMock()),
+            destdb=SimpleNamespace(session=self.session),
+            bulk_change_detection=True,
+            bulk_load=False,
+            chunksize=2,
+            encrypt_master_pid=lambda mpid: "enc{}".format(mpid),
+            hash_object=repr,
+            max_rows_per_insert=100,
+            pipelined_processing=False,
+            report_every_n_rows=1000,
+            rows_inserted_per_table=collections.Counter(),
+            scrub_pool_min_text_length=0,
+            source_hash_fieldname="src_hash",
+            trid_fieldname="trid",
+        )
+
+    def tearDown(self) -> None:
+        self.session.close()
+
+    def set_fields(self, *fields: str, pk: str = None, pid: str = None,
+                   mpid: str = None) -> None:
+        self.ddrows = [
+            SimpleNamespace(src_field=f, dest_table="dest",
+                            dest_field={pk: "pk", pid: "rid"}.get(f, f),
+                            pk=(f == pk), add_src_hash=(f == pk),
+                            primary_pid=(f == pid), master_pid=(f == mpid),
+                            omit=False, constant=False)
+            for f in fields
+        ]
+
+    def add_dest_rows(self, *rows: Tuple[Any, Any, str]) -> None:
+        self.session.execute(
+            table("dest", column("pk"), column("rid"), column("src_hash"))
+            .insert(),
+            [dict(zip(("pk", "rid", "src_hash"), row)) for row in rows])
+
+    def get_rows_processed(self, rows: List[List[Any]],
+                           bulk: bool = True,
+                           **kwargs: Any) -> List[List[Any]]:
+        transform = mock.Mock(return_value=None)
+        self.config.bulk_change_detection = bulk
+        with mock.patch(__name__ + '.config', self.config), \
+                mock.patch(__name__ + '.get_row_plan', return_value=(
+                    SimpleNamespace(ddrows=self.ddrows, transform=transform,
+                                    can_defer_scrubbing=False))), \
+                mock.patch(__name__ + '.get_watermark_criterion',
+                           return_value=None), \
+                mock.patch(__name__ + '.commit_destdb'), \
+                mock.patch(__name__ + '.MAX_IN_CLAUSE_VALUES', 2), \
+                mock.patch(__name__ + '.get_dest_pk_hash_map',
+                           wraps=get_dest_pk_hash_map) as fetch:
+            process_table("db", "src", incremental=True,
+                          source_rows=rows, **kwargs)
+        if not bulk:
+            self.assertEqual(fetch.call_count, 0)
+        self.n_fetches = fetch.call_count
+        return [c[0][0] for c in transform.call_args_list]
+
+    def check(self, rows: List[List[Any]], expected: List[List[Any]],
+              n_fetches: int, **kwargs: Any) -> None:
+        self.assertEqual(self.get_rows_processed(rows, bulk=False, **kwargs),
+                         expected)
+        self.assertEqual(self.get_rows_processed(rows, **kwargs), expected)
+        self.assertEqual(self.n_fetches, n_fetches)
+
+    def test_nonpatient_table(self) -> None:
+        # Unchanged: 1, 4. Changed: 2. New: 3, 5.
+        rows = [[1, "a"], [2, "b"], [3, "c"], [4, "d"], [5, "e"]]
+        self.set_fields("pk", "data", pk="pk")
+        self.add_dest_rows((1, None, repr([1, "a"])), (2, None, "old"),
+                           (4, None, repr([4, "d"])), (9, None, "gone"))
+        expected = [[2, "b"], [3, "c"], [5, "e"]]
+        # With an integer PK: by PK range, config.chunksize rows at a time.
+        self.check(rows, expected, n_fetches=3, intpkname="pk")
+        # Without: by PK value, MAX_IN_CLAUSE_VALUES at a time.
+        self.check(rows, expected, n_fetches=3)
+
+    def test_patient_table_with_pid_pk(self) -> None:
+        # The destination PK is the RID.
+        self.set_fields("pid", "data", pk="pid", pid="pid")
+        self.add_dest_rows(("rid1", "rid1", repr([1, "a"])),
+                           ("rid2", "rid2", "old"))
+        for pid, expected in ((1, []), (2, [[2, "b"]]), (3, [[3, "c"]])):
+            patient = SimpleNamespace(
+                get_pid=lambda: pid,
+                get_rid=lambda: "rid{}".format(pid),
+                get_trid=lambda: pid)
+            rows = [[pid, "abc"[pid - 1]]]
+            self.check(rows, expected, n_fetches=1, patient=patient)
+
+    def test_patient_table_with_mpid_pk(self) -> None:
+        # The destination PK is the encrypted MPID.
+        self.set_fields("mpid", "pid", "data", pk="mpid", pid="pid",
+                        mpid="mpid")
+        rows = [[10, 1, "a"], [11, 1, "b"], [12, 1, "c"]]
+        self.add_dest_rows(("enc10", "rid1", repr([10, 1, "a"])),
+                           ("enc11", "rid1", "old"),
+                           ("enc12", "rid2", "other patient"))
+        patient = SimpleNamespace(get_pid=lambda: 1, get_rid=lambda: "rid1",
+                                  get_trid=lambda: 1)
+        self.check(rows, [[11, 1, "b"], [12, 1, "c"]], n_fetches=1,
+                   patient=patient)
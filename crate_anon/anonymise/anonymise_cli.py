@@ -99,14 +99,32 @@ def main() -> None:
     parser.add_argument("--count", action="store_true",
                         help="Count records in source/destination databases, "
                              "then stop")
+    parser.add_argument("--workerreport", action="store_true",
+                        help="Report per-process patient throughput from the "
+                             "work queue used for dynamic scheduling, then "
+                             "stop")
     parser.add_argument("--dropremake", action="store_true",
                         help="Drop/remake destination tables, then stop")
+    parser.add_argument("--deletedead", action="store_true",
+                        help="For incremental updates, delete destination "
+                             "rows with no source row, for tables using the "
+                             "sorted_diff deletion method, then stop")
     parser.add_argument("--optout", action="store_true",
                         help="Build opt-out list, then stop")
+    parser.add_argument("--patientqueue", action="store_true",
+                        help="Build work queue of patients (if the config "
+                             "file asks for dynamic_patient_scheduling) "
+                             "and patient mapping records (if it asks for "
+                             "bulk_secret_map), then stop")
     parser.add_argument("--nonpatienttables", action="store_true",
                         help="Process non-patient tables only")
     parser.add_argument("--patienttables", action="store_true",
                         help="Process patient tables only")
+    parser.add_argument("--savewatermarks", action="store_true",
+                        help="Once all data has been processed: record the "
+                             "source tables' watermarks (see "
+                             "incremental_watermark_columns) for the next "
+                             "incremental run, then stop")
     parser.add_argument("--index", action="store_true",
                         help="Create indexes only")
     parser.add_argument("--skip_dd_check", action="store_true",
@@ -126,6 +144,12 @@ def main() -> None:
         "--skipdelete", dest="skipdelete", action="store_true",
         help="For incremental updates, skip deletion of rows present in the "
              "destination but not the source")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Resume an interrupted run: don't drop/remake anything, and "
+             "skip work recorded as finished in the progress ledger (as long "
+             "as the data dictionary and the patient's scrubber are "
+             "unchanged); partly finished work is deleted and redone")
     parser.add_argument(
         "--seed",
         help="String to use as the basis of the seed for the random number "
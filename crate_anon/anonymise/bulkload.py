@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# crate_anon/anonymise/bulkload.py
+
+"""
+===============================================================================
+    Copyright (C) 2015-2017 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+===============================================================================
+
+Loading destination tables with the database's own bulk loader.
+
+For a full (non-incremental) run, rather than INSERTing destination rows in
+batches, we can write them to a local file and have the database load the
+whole file in one go, which is much faster:
+
+- PostgreSQL: COPY ... FROM STDIN, in its text format (tab-separated; NULL as
+  \\N; backslash, tab, newline and carriage return escaped with a backslash;
+  binary values as \\x followed by hex digits);
+- MySQL: LOAD DATA LOCAL INFILE, in the same format (binary values as hex,
+  converted with UNHEX()). Both client and server must permit LOCAL INFILE
+  (e.g. local_infile=1 in the connection URL, and the server's local_infile
+  system variable);
+- anything else (e.g. SQLite, SQL Server): the rows are kept in the file in
+  Python's pickle format and written with executemany, as a stand-in.
+
+The file goes in the system's temporary directory unless you say otherwise,
+and is deleted once loaded.
+"""
+
+import datetime
+import logging
+import os
+import pickle
+import tempfile
+import unittest
+from typing import Any, BinaryIO, Callable, Dict, List, Sequence
+
+from sqlalchemy.orm.session import Session
+from sqlalchemy.schema import Table
+
+from crate_anon.common.sqla import is_sqlatype_binary
+
+log = logging.getLogger(__name__)
+
+DIALECT_MYSQL = 'mysql'
+DIALECT_POSTGRES = 'postgresql'
+NATIVE_DIALECTS = [DIALECT_MYSQL, DIALECT_POSTGRES]
+
+NULL_TEXT = "\\N"
+TEXT_ESCAPES = str.maketrans({
+    "\\": "\\\\",
+    "\t": "\\t",
+    "\n": "\\n",
+    "\r": "\\r",
+})
+MYSQL_TEXT_ESCAPES = str.maketrans({
+    "\\": "\\\\",
+    "\t": "\\t",
+    "\n": "\\n",
+    "\r": "\\r",
+    "\0": "\\0",
+})
+
+
+# =============================================================================
+# Text format
+# =============================================================================
+
+def make_text_encoder(dialect_name: str) -> Callable[[Any], str]:
+    """
+    Returns a function that converts a Python value into a field of the
+    tab-separated text format read by the dialect's bulk loader.
+    """
+    postgres = dialect_name == DIALECT_POSTGRES
+    escapes = TEXT_ESCAPES if postgres else MYSQL_TEXT_ESCAPES
+    true_text, false_text = ("t", "f") if postgres else ("1", "0")
+    binary_prefix = "\\\\x" if postgres else ""  # "\\" is an escaped "\"
+
+    def encode(value: Any) -> str:
+        if value is None:
+            return NULL_TEXT
+        if isinstance(value, str):
+            return value.translate(escapes)
+        if isinstance(value, bool):  # before int; bool is a subclass of int
+            return true_text if value else false_text
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return binary_prefix + bytes(value).hex()
+        if isinstance(value, datetime.datetime):
+            return value.isoformat(sep=" ")
+        return str(value).translate(escapes)
+
+    return encode
+
+
+# =============================================================================
+# Bulk loader
+# =============================================================================
+
+class BulkLoader(object):
+    """
+    Spools rows for one destination table (with a fixed set of fields) to a
+    local file, and loads them into the destination in one go.
+    """
+    def __init__(self,
+                 sqla_table: Table,
+                 fields: Sequence[str],
+                 dialect_name: str,
+                 tmpdir: str = None) -> None:
+        self.sqla_table = sqla_table
+        self.fields = list(fields)
+        self.dialect_name = dialect_name
+        self.tmpdir = tmpdir or None
+        self.native = dialect_name in NATIVE_DIALECTS
+        self.encode = make_text_encoder(dialect_name)
+        self.n_rows = 0
+        self._file = None  # type: BinaryIO
+
+    def _open(self) -> None:
+        self._file = tempfile.NamedTemporaryFile(
+            mode="wb", prefix="crate_bulk_{}_".format(self.sqla_table.name),
+            suffix=".tsv" if self.native else ".pickle",
+            dir=self.tmpdir, delete=False)
+
+    def write(self, records: List[Dict[str, Any]]) -> None:
+        """
+        Adds rows (as {field: value} dictionaries, with our fields) to the
+        spool file.
+        """
+        if not records:
+            return
+        if self._file is None:
+            self._open()
+        if self.native:
+            encode = self.encode
+            fields = self.fields
+            self._file.write("".join(
+                "\t".join([encode(record[f]) for f in fields]) + "\n"
+                for record in records
+            ).encode("utf-8"))
+        else:
+            pickle.dump(records, self._file, pickle.HIGHEST_PROTOCOL)
+        self.n_rows += len(records)
+
+    def load(self, session: Session) -> int:
+        """
+        Loads the rows spooled so far, within the session's transaction (the
+        caller commits), and empties the spool. Returns the number of rows.
+        """
+        if self._file is None:
+            return 0
+        filename = self._file.name
+        n_rows = self.n_rows
+        self._file.close()
+        self._file = None
+        self.n_rows = 0
+        log.debug("Bulk-loading {} rows into {} from {}".format(
+            n_rows, self.sqla_table.name, filename))
+        try:
+            if self.dialect_name == DIALECT_POSTGRES:
+                self._load_postgres(session, filename)
+            elif self.dialect_name == DIALECT_MYSQL:
+                self._load_mysql(session, filename)
+            else:
+                self._load_executemany(session, filename)
+        finally:
+            os.remove(filename)
+        return n_rows
+
+    def discard(self) -> None:
+        """Throws away the rows spooled so far."""
+        if self._file is None:
+            return
+        self._file.close()
+        os.remove(self._file.name)
+        self._file = None
+        self.n_rows = 0
+
+    def _quote(self, session: Session, name: str) -> str:
+        return session.get_bind().dialect.identifier_preparer.quote(name)
+
+    def _load_postgres(self, session: Session, filename: str) -> None:
+        sql = "COPY {table} ({fields}) FROM STDIN".format(
+            table=self._quote(session, self.sqla_table.name),
+            fields=", ".join(self._quote(session, f) for f in self.fields))
+        cursor = session.connection().connection.cursor()
+        try:
+            with open(filename, "rb") as f:
+                cursor.copy_expert(sql, f)
+        finally:
+            cursor.close()
+
+    def _load_mysql(self, session: Session, filename: str) -> None:
+        columns = self.sqla_table.columns
+        targets = []  # type: List[str]
+        assignments = []  # type: List[str]
+        for i, f in enumerate(self.fields):
+            quoted = self._quote(session, f)
+            if is_sqlatype_binary(columns[f].type):
+                var = "@v{}".format(i)
+                targets.append(var)
+                assignments.append("{} = UNHEX({})".format(quoted, var))
+            else:
+                targets.append(quoted)
+        sql = (
+            "LOAD DATA LOCAL INFILE %s INTO TABLE {table} "
+            "CHARACTER SET utf8mb4 "
+            "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+            "LINES TERMINATED BY '\\n' "
+            "({targets}){set}".format(
+                table=self._quote(session, self.sqla_table.name),
+                targets=", ".join(targets),
+                set=(" SET " + ", ".join(assignments)) if assignments else "")
+        )
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.execute(sql, (filename, ))
+        finally:
+            cursor.close()
+
+    def _load_executemany(self, session: Session, filename: str) -> None:
+        query = self.sqla_table.insert()
+        with open(filename, "rb") as f:
+            while True:
+                try:
+                    records = pickle.load(f)
+                except EOFError:
+                    return
+                session.execute(query, records)
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class TestTextEncoder(unittest.TestCase):
+    def test_postgres(self) -> None:
+        encode = make_text_encoder(DIALECT_POSTGRES)
+        self.assertEqual(encode(None), "\\N")
+        self.assertEqual(encode("a\\b\tc\nd\re"), "a\\\\b\\tc\\nd\\re")
+        self.assertEqual(encode("\\N"), "\\\\N")  # not NULL
+        self.assertEqual(encode(True), "t")
+        self.assertEqual(encode(False), "f")
+        self.assertEqual(encode(0), "0")
+        self.assertEqual(encode(b"\x00\xff\\"), "\\\\x00ff5c")
+        self.assertEqual(encode(bytearray(b"\x01")), "\\\\x01")
+        self.assertEqual(encode(datetime.datetime(2017, 1, 2, 3, 4, 5)),
+                         "2017-01-02 03:04:05")
+        self.assertEqual(encode(datetime.date(2017, 1, 2)), "2017-01-02")
+
+    def test_mysql(self) -> None:
+        encode = make_text_encoder(DIALECT_MYSQL)
+        self.assertEqual(encode(None), "\\N")
+        self.assertEqual(encode("a\\b\tc\nd\re\0f"),
+                         "a\\\\b\\tc\\nd\\re\\0f")
+        self.assertEqual(encode("\\N"), "\\\\N")  # not NULL
+        self.assertEqual(encode(True), "1")
+        self.assertEqual(encode(False), "0")
+        self.assertEqual(encode(b"\x00\xff\\"), "00ff5c")  # for UNHEX()
+        self.assertEqual(encode(1.5), "1.5")
+        self.assertEqual(encode(datetime.datetime(2017, 1, 2, 3, 4, 5)),
+                         "2017-01-02 03:04:05")
+
+    def test_one_line_per_row(self) -> None:
+        # Whatever the values, a row's fields must come out with no raw tab,
+        # newline or carriage return.
+        for dialect in NATIVE_DIALECTS:
+            encode = make_text_encoder(dialect)
+            for value in ["x\ty", "x\ny", "x\ry", "\t\n\r\\", b"\t\n"]:
+                encoded = encode(value)
+                for c in "\t\n\r":
+                    self.assertNotIn(c, encoded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -70,7 +70,7 @@ import fnmatch
 import logging
 import os
 import sys
-from typing import Any, Dict, List, Optional, TYPE_CHECKING
+from typing import Any, Callable, Dict, List, Optional, TYPE_CHECKING
 
 import regex
 from cardinal_pythonlib.rnc_db import (
@@ -86,20 +86,38 @@ from sqlalchemy.sql.sqltypes import TypeEngine
 
 from crate_anon.anonymise.constants import (
     CONFIG_ENV_VAR,
+    DEFAULT_BULK_LOAD_MAX_ROWS,
     DEFAULT_CHUNKSIZE,
     DEFAULT_REPORT_EVERY,
     DEFAULT_MAX_ROWS_BEFORE_COMMIT,
     DEFAULT_MAX_BYTES_BEFORE_COMMIT,
+    DEFAULT_MAX_ROWS_PER_INSERT,
+    DEFAULT_OPTOUT_REFRESH_INTERVAL_S,
+    DEFAULT_PATIENT_BATCH_LEASE_S,
+    DEFAULT_PATIENT_BATCH_SIZE,
+    DEFAULT_PID_HASH_CACHE_SIZE,
+    DEFAULT_PIPELINE_QUEUE_SIZE,
+    DEFAULT_PK_RANGES_PER_PROCESS,
+    DEFAULT_SCRUB_CACHE_MAX_BYTES,
+    DEFAULT_SCRUB_POOL_MIN_TEXT_LENGTH,
+    DELETIONMETHOD,
+    PROGRESSCOUNTS,
     SEP,
 )
 from crate_anon.anonymise.dd import DataDictionary
 from crate_anon.anonymise.scrub import (
     NonspecificScrubber,
+    ScrubCacheStats,
     WordList,
 )
 from crate_anon.common.extendedconfigparser import ExtendedConfigParser
 from crate_anon.common.formatting import sizeof_fmt
-from crate_anon.common.hash import GenericHasher, make_hasher
+from crate_anon.common.hash import (
+    CachingHasher,
+    GenericHasher,
+    make_hasher,
+    make_row_hasher,
+)
 from crate_anon.common.sql import TransactionSizeLimiter
 from crate_anon.common.sqla import (
     hack_in_mssql_xml_type,
@@ -229,6 +247,10 @@ class DatabaseSafeConfig(object):
         self.ddgen_convert_odd_chars_to_underscore = opt_bool(
             'ddgen_convert_odd_chars_to_underscore', True)
 
+        self.incremental_watermark_columns = opt_multiline_csv_pairs(
+            'incremental_watermark_columns')
+        # ... key: table; value: watermark field
+
         self.debug_row_limit = opt_int('debug_row_limit', 0)
         self.debug_limited_tables = opt_multiline('debug_limited_tables')
 
@@ -396,6 +418,8 @@ class Config(object):
             'master_patient_id_encryption_phrase')
         self.change_detection_encryption_phrase = opt_str(
             'change_detection_encryption_phrase')
+        self.change_detection_hash_method = opt_str(
+            'change_detection_hash_method')
         _extra_hash_config_section_names = opt_multiline(
             "extra_hash_config_sections")
 
@@ -422,10 +446,23 @@ class Config(object):
         self.master_pid_hasher = make_hasher(
             self.hash_method, self.master_patient_id_encryption_phrase)
 
+        self.pid_hash_cache_size = opt_int('pid_hash_cache_size',
+                                           DEFAULT_PID_HASH_CACHE_SIZE)
+        if self.pid_hash_cache_size > 0:
+            self.primary_pid_hasher = CachingHasher(self.primary_pid_hasher,
+                                                    self.pid_hash_cache_size)
+            self.master_pid_hasher = CachingHasher(self.master_pid_hasher,
+                                                   self.pid_hash_cache_size)
+
         if not self.change_detection_encryption_phrase:
             raise ValueError("Missing change_detection_encryption_phrase")
         self.change_detection_hasher = make_hasher(
             self.hash_method, self.change_detection_encryption_phrase)
+        self.source_hash_hasher = make_row_hasher(
+            self.change_detection_hash_method, self.hash_method,
+            self.change_detection_encryption_phrase)
+        self.SqlTypeSourceHash = String(
+            self.source_hash_hasher.output_length())
 
         # ---------------------------------------------------------------------
         # Text extraction
@@ -451,6 +488,8 @@ class Config(object):
             'replace_nonspecific_info_with')
         self.thirdparty_xref_max_depth = opt_int('thirdparty_xref_max_depth',
                                                  1)
+        self.scrubber_element_store = opt_bool('scrubber_element_store',
+                                               False)
         self.string_max_regex_errors = opt_int('string_max_regex_errors', 0)
         self.min_string_length_for_errors = opt_int(
             'min_string_length_for_errors', 1)
@@ -469,8 +508,12 @@ class Config(object):
             'anonymise_strings_at_word_boundaries_only', True)
 
         self.scrub_string_suffixes = opt_multiline('scrub_string_suffixes')
+        self.scrub_single_pass = opt_bool('scrub_single_pass', False)
+        self.scrub_factor_prefixes = opt_bool('scrub_factor_prefixes', False)
         self.whitelist_filenames = opt_multiline('whitelist_filenames')
         self.blacklist_filenames = opt_multiline('blacklist_filenames')
+        self.blacklist_literal_matching = opt_bool(
+            'blacklist_literal_matching', False)
         self.scrub_all_numbers_of_n_digits = opt_multiline_int(
             'scrub_all_numbers_of_n_digits', minimum=1)
 
@@ -492,6 +535,7 @@ class Config(object):
             at_word_boundaries_only=(
                 self.anonymise_strings_at_word_boundaries_only),
             max_errors=0,
+            literal_matching=self.blacklist_literal_matching,
         )
         self.nonspecific_scrubber = NonspecificScrubber(
             replacement_text=self.replace_nonspecific_info_with,
@@ -531,6 +575,38 @@ class Config(object):
                                               DEFAULT_MAX_ROWS_BEFORE_COMMIT)
         self.max_bytes_before_commit = opt_int('max_bytes_before_commit',
                                                DEFAULT_MAX_BYTES_BEFORE_COMMIT)
+        self.max_rows_per_insert = opt_int('max_rows_per_insert',
+                                           DEFAULT_MAX_ROWS_PER_INSERT)
+        self.bulk_change_detection = opt_bool('bulk_change_detection', True)
+        self.progress_ledger = opt_bool('progress_ledger', True)
+        self.bulk_load = opt_bool('bulk_load', False)
+        self.bulk_load_max_rows = opt_int('bulk_load_max_rows',
+                                          DEFAULT_BULK_LOAD_MAX_ROWS)
+        self.bulk_load_tmpdir = opt_str('bulk_load_tmpdir')
+        self.index_tables_when_loaded = opt_bool('index_tables_when_loaded',
+                                                 False)
+        self.rebuild_indexes_incremental = opt_bool(
+            'rebuild_indexes_incremental', False)
+        self.pipelined_processing = opt_bool('pipelined_processing', False)
+        self.pipeline_queue_size = opt_int('pipeline_queue_size',
+                                           DEFAULT_PIPELINE_QUEUE_SIZE)
+        self.scrub_pool_processes = opt_int('scrub_pool_processes', 0)
+        self.scrub_pool_min_text_length = opt_int(
+            'scrub_pool_min_text_length', DEFAULT_SCRUB_POOL_MIN_TEXT_LENGTH)
+        self.scrub_cache_max_bytes = opt_int('scrub_cache_max_bytes',
+                                             DEFAULT_SCRUB_CACHE_MAX_BYTES)
+        self.scrub_cache_stats = ScrubCacheStats()
+        self.stream_patient_tables = opt_bool('stream_patient_tables', False)
+        self.scrub_src_fetch_block_size = opt_int(
+            'scrub_src_fetch_block_size', 0)
+        self.progress_counts = PROGRESSCOUNTS.lookup(
+            opt_str('progress_counts') or PROGRESSCOUNTS.ESTIMATED.value)
+        self.pk_range_partitioning = opt_bool('pk_range_partitioning', False)
+        self.pk_ranges_per_process = opt_int('pk_ranges_per_process',
+                                             DEFAULT_PK_RANGES_PER_PROCESS)
+        self.deletion_method = DELETIONMETHOD.lookup(
+            opt_str('deletion_method') or
+            DELETIONMETHOD.TEMPORARY_TABLE.value)
         self.temporary_tablename = opt_str('temporary_tablename')
 
         # ---------------------------------------------------------------------
@@ -564,10 +640,12 @@ class Config(object):
             self.dest_dialect = self.destdb.engine.dialect
         else:  # in context of web framework, some sort of default
             self.dest_dialect = mysql_dialect
+        self._dest_db_commit_callbacks = []  # type: List[Callable[[], None]]  # noqa
         self._destdb_transaction_limiter = TransactionSizeLimiter(
             session=self.destdb.session,
             max_bytes_before_commit=self.max_bytes_before_commit,
-            max_rows_before_commit=self.max_rows_before_commit
+            max_rows_before_commit=self.max_rows_before_commit,
+            on_commit=self._on_dest_db_commit
         )
 
         self.admindb = get_database(admin_database_cfg_section,
@@ -598,6 +676,18 @@ class Config(object):
             else:  # in context of web framework
                 self.src_dialects[sourcedb_name] = mssql_dialect
 
+        # ---------------------------------------------------------------------
+        # Multiprocess scheduling of patients
+        # ---------------------------------------------------------------------
+
+        self.dynamic_patient_scheduling = opt_bool(
+            'dynamic_patient_scheduling', False)
+        self.patient_batch_size = opt_int('patient_batch_size',
+                                          DEFAULT_PATIENT_BATCH_SIZE)
+        self.patient_batch_lease_s = opt_int('patient_batch_lease_s',
+                                             DEFAULT_PATIENT_BATCH_LEASE_S)
+        self.bulk_secret_map = opt_bool('bulk_secret_map', False)
+
         # ---------------------------------------------------------------------
         # Processing options
         # ---------------------------------------------------------------------
@@ -612,6 +702,11 @@ class Config(object):
         self.optout_pid_filenames = opt_multiline('optout_pid_filenames')
         self.optout_mpid_filenames = opt_multiline('optout_mpid_filenames')
         self.optout_col_values = opt_pyvalue_list('optout_col_values')
+        self.optout_in_memory = opt_bool('optout_in_memory', True)
+        self.optout_bloom_filter_threshold = opt_int(
+            'optout_bloom_filter_threshold', 0)
+        self.optout_refresh_interval_s = opt_int(
+            'optout_refresh_interval_s', DEFAULT_OPTOUT_REFRESH_INTERVAL_S)
 
         # ---------------------------------------------------------------------
         # Rest of initialization
@@ -679,6 +774,52 @@ class Config(object):
             raise ValueError("No temporary_tablename specified.")
         ensure_valid_table_name(self.temporary_tablename)
 
+        # Batching
+        if self.max_rows_per_insert < 1:
+            raise ValueError("max_rows_per_insert must be >= 1")
+        if self.bulk_load_max_rows < 1:
+            raise ValueError("bulk_load_max_rows must be >= 1")
+        if self.bulk_load_tmpdir and not os.path.isdir(self.bulk_load_tmpdir):
+            raise ValueError("bulk_load_tmpdir is not a directory: {}".format(
+                self.bulk_load_tmpdir))
+        if self.pipeline_queue_size < 1:
+            raise ValueError("pipeline_queue_size must be >= 1")
+        if self.scrub_pool_processes < 0:
+            raise ValueError("scrub_pool_processes must be >= 0")
+        if self.scrub_cache_max_bytes < 0:
+            raise ValueError("scrub_cache_max_bytes must be >= 0")
+        if self.pid_hash_cache_size < 0:
+            raise ValueError("pid_hash_cache_size must be >= 0")
+        if self.pk_ranges_per_process < 1:
+            raise ValueError("pk_ranges_per_process must be >= 1")
+        if self.optout_bloom_filter_threshold < 0:
+            raise ValueError("optout_bloom_filter_threshold must be >= 0")
+        if self.optout_refresh_interval_s < 0:
+            raise ValueError("optout_refresh_interval_s must be >= 0")
+
+        # Scheduling
+        if self.stream_patient_tables:
+            if not self.pidtype_is_integer:
+                raise ValueError("stream_patient_tables requires integer "
+                                 "patient IDs")
+            if self.dynamic_patient_scheduling:
+                raise ValueError("Can't use stream_patient_tables with "
+                                 "dynamic_patient_scheduling")
+        if self.scrub_src_fetch_block_size < 0:
+            raise ValueError("scrub_src_fetch_block_size must be >= 0")
+        if self.scrub_src_fetch_block_size > 0:
+            if not self.pidtype_is_integer:
+                raise ValueError("scrub_src_fetch_block_size requires "
+                                 "integer patient IDs")
+            if self.stream_patient_tables or self.dynamic_patient_scheduling:
+                raise ValueError("Can't use scrub_src_fetch_block_size with "
+                                 "stream_patient_tables or "
+                                 "dynamic_patient_scheduling")
+        if self.patient_batch_size < 1:
+            raise ValueError("patient_batch_size must be >= 1")
+        if self.patient_batch_lease_s < 1:
+            raise ValueError("patient_batch_lease_s must be >= 1")
+
         # Test field names
         def validate_fieldattr(name):
             if not getattr(self, name):
@@ -763,17 +904,43 @@ class Config(object):
             # be equated on the hash (e.g. hash(None) -> hash("None") -> ...)!
         return self.master_pid_hasher.hash(mpid)
 
+    def encrypt_primary_pids(self, pids: List[int]) -> List[str]:
+        """Encrypt several primary PIDs at once."""
+        if any(pid is None for pid in pids):
+            raise ValueError("Trying to hash NULL PID!")
+        return self.primary_pid_hasher.hash_many(pids)
+
+    def encrypt_master_pids(self, mpids: List[int]) -> List[Optional[str]]:
+        """Encrypt several master PIDs at once; NULL values stay NULL."""
+        hashed = iter(self.master_pid_hasher.hash_many(
+            [mpid for mpid in mpids if mpid is not None]))
+        return [None if mpid is None else next(hashed) for mpid in mpids]
+
+    def report_scrub_cache_stats(self) -> None:
+        """Log how well the patients' scrub-result caches did, if used."""
+        if self.scrub_cache_max_bytes > 0:
+            log.info("Scrub result cache: {}".format(self.scrub_cache_stats))
+
+    def report_pid_hash_cache_stats(self) -> None:
+        """Log how well the PID/MPID hash caches are doing, if used."""
+        for name, hasher in (("PID", self.primary_pid_hasher),
+                             ("MPID", self.master_pid_hasher)):
+            if isinstance(hasher, CachingHasher):
+                log.info("{} hash cache: {}".format(name,
+                                                    hasher.cache_info()))
+
     def hash_object(self, l: Any) -> str:
         """
-        Hashes a list with Python's built-in hash function.
+        Hashes a list (a source row), for change detection.
 
         We could use Python's build-in hash() function, which produces a 64-bit
         unsigned integer (calculated from: sys.maxint).
         However, there is an outside chance that someone uses a single-field
         table and therefore that this is vulnerable to content discovery via a
-        dictionary attack. Thus, we should use a better version.
+        dictionary attack. Thus, we should use a better version; by default,
+        an HMAC (see change_detection_hash_method).
         """
-        return self.change_detection_hasher.hash(repr(l))
+        return self.source_hash_hasher.hash(l)
 
     def get_extra_hasher(self, hasher_name: str) -> GenericHasher:
         if hasher_name not in self.extra_hashers.keys():
@@ -809,6 +976,19 @@ class Config(object):
     def commit_dest_db(self) -> None:
         self._destdb_transaction_limiter.commit()
 
+    def add_dest_db_commit_callback(self,
+                                    callback: Callable[[], None]) -> None:
+        """
+        Registers a function to be called after each commit of the main
+        destination database session (whether explicit, or triggered by the
+        transaction size limits).
+        """
+        self._dest_db_commit_callbacks.append(callback)
+
+    def _on_dest_db_commit(self) -> None:
+        for callback in self._dest_db_commit_callbacks:
+            callback()
+
     def notify_src_bytes_read(self, n_bytes: int) -> None:
         self._src_bytes_read += n_bytes
 
@@ -817,6 +997,10 @@ class Config(object):
         # ... may trigger a commit
         self._dest_bytes_written += n_bytes
 
+    def notify_dest_bytes_written(self, n_bytes: int) -> None:
+        # For writers using their own session (and transaction limiter)
+        self._dest_bytes_written += n_bytes
+
     def extract_text_extension_permissible(self, extension: str) -> bool:
         if not self.extract_text_extensions_case_sensitive:
             extension = extension.upper()
@@ -23,12 +23,15 @@
 """
 
 import logging
-from typing import List
+from typing import Any, Generator, List
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine.result import RowProxy
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.session import Session
 from sqlalchemy.schema import MetaData
 
+from crate_anon.anonymise.constants import DEFAULT_STREAM_FETCH_SIZE
 # from crate_anon.common.sqla import get_table_names
 
 log = logging.getLogger(__name__)
@@ -49,9 +52,13 @@ class DatabaseHolder(object):
                  with_session: bool = False,
                  with_conn: bool = True,
                  reflect: bool = True,
-                 encoding: str = 'utf-8') -> None:
+                 encoding: str = 'utf-8',
+                 stream_results: bool = False,
+                 fetch_size: int = DEFAULT_STREAM_FETCH_SIZE) -> None:
         self.name = name
         self.srccfg = srccfg
+        self.stream_results = stream_results
+        self.fetch_size = fetch_size
         self.engine = create_engine(url, encoding=encoding)
         self.conn = None
         self.session = None
@@ -87,3 +94,45 @@ class DatabaseHolder(object):
         if not self._reflected:
             self._reflect()
         return self._table_names
+
+    def gen_query_rows(self,
+                       query: Any,
+                       session: Session = None,
+                       stream: bool = None) -> Generator[RowProxy, None,
+                                                         None]:
+        """
+        Executes a SELECT query and generates its result rows. Use this for
+        queries that may return a lot of data.
+
+        If stream_results is set, a server-side cursor is used, on a
+        connection of its own (so other queries can be run via the session
+        while the rows are being read), and rows are fetched fetch_size at a
+        time. Otherwise, the query is run via the session (by default, our
+        own), and with several drivers the entire result is fetched into
+        memory before the first row is returned.
+
+        Pass stream to override stream_results for this query.
+
+        Close the generator if you stop reading early.
+        """
+        if stream is None:
+            stream = self.stream_results
+        if not stream:
+            result = (session or self.session).execute(query)
+            try:
+                yield from result
+            finally:
+                result.close()
+            return
+        connection = self.engine.connect().execution_options(
+            stream_results=True)
+        try:
+            result = connection.execute(query)
+            while True:
+                rows = result.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                yield from rows
+            result.close()
+        finally:
+            connection.close()
@@ -34,6 +34,7 @@ than a database table.
 import collections
 import csv
 from functools import lru_cache
+import hashlib
 import logging
 import operator
 from typing import (AbstractSet, Any, List, Optional, Tuple, TYPE_CHECKING,
@@ -471,6 +472,15 @@ class DataDictionary(object):
             [r.get_tsv() for r in self.rows]
         )
 
+    @lru_cache(maxsize=None)
+    def get_version_hash(self) -> str:
+        """
+        Return a digest (MD5, hex) of the DD's contents. If the DD changes,
+        so does this; work done under another version of the DD can be
+        recognized as such.
+        """
+        return hashlib.md5(self.get_tsv().encode('utf8')).hexdigest()
+
     # =========================================================================
     # Global DD queries
     # =========================================================================
@@ -801,7 +811,7 @@ class DataDictionary(object):
     def _get_srchash_sqla_column(self) -> Column:
         return Column(
             self.config.source_hash_fieldname,
-            self.config.SqlTypeEncryptedPid,
+            self.config.SqlTypeSourceHash,
             doc='Hashed amalgamation of all source fields'
         )
 
@@ -852,6 +862,8 @@ class DataDictionary(object):
             self.get_rows_for_dest_table,
 
             self.get_dest_sqla_table,
+
+            self.get_version_hash,
         ]
 
     def clear_caches(self) -> None:
@@ -114,6 +114,22 @@ def main() -> None:
     ] + common_options
     check_call_process(procargs)
 
+    # -------------------------------------------------------------------------
+    # Delete dead destination rows, for tables using the sorted_diff deletion
+    # method (if none, or for a full run, this does nothing). Parallel.
+    # -------------------------------------------------------------------------
+    args_list = [
+        [
+            sys.executable, '-m', ANONYMISER,
+            '--deletedead',
+            '--processcluster=DELETE',
+            '--nprocesses={}'.format(nprocesses_nonpatient),
+            '--process={}'.format(procnum),
+            '--skip_dd_check'
+        ] + common_options for procnum in range(nprocesses_nonpatient)
+    ]
+    run_multiple_processes(args_list)
+
     # -------------------------------------------------------------------------
     # Build opt-out lists. Only run one copy of this!
     # -------------------------------------------------------------------------
@@ -124,6 +140,19 @@ def main() -> None:
     ] + common_options
     check_call_process(procargs)
 
+    # -------------------------------------------------------------------------
+    # Build the patient work queue, if dynamic scheduling is configured, and
+    # the patient mapping records, if bulk_secret_map is (if neither, this does
+    # nothing). With --resume, an existing queue is kept, with its completed
+    # batches. Only run one copy of this!
+    # -------------------------------------------------------------------------
+    procargs = [
+        sys.executable, '-m', ANONYMISER,
+        '--patientqueue', '--processcluster=QUEUE',
+        '--skip_dd_check'
+    ] + common_options
+    check_call_process(procargs)
+
     # -------------------------------------------------------------------------
     # Now run lots of things simultaneously:
     # -------------------------------------------------------------------------
@@ -157,8 +186,28 @@ def main() -> None:
         args_list.append(procargs)
     run_multiple_processes(args_list)  # Wait for them all to finish
 
+    # -------------------------------------------------------------------------
+    # All data processed: record source high-water marks, for the next
+    # incremental run (if no tables have watermarks, this does nothing). Only
+    # run one copy of this!
+    # -------------------------------------------------------------------------
+    procargs = [
+        sys.executable, '-m', ANONYMISER,
+        '--savewatermarks', '--processcluster=WATERMARKS',
+        '--skip_dd_check'
+    ] + common_options
+    check_call_process(procargs)
+
     time_middle = time.time()
 
+    # Report per-process throughput for patients (dynamic scheduling only).
+    procargs = [
+        sys.executable, '-m', ANONYMISER,
+        '--workerreport',
+        '--skip_dd_check'
+    ] + common_options
+    check_call_process(procargs)
+
     # -------------------------------------------------------------------------
     # Now do the indexing, if nothing else failed.
     # (Always fastest to index last.)
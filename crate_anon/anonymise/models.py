@@ -30,18 +30,26 @@ To create a SQLAlchemy ORM programmatically:
     http://stackoverflow.com/questions/2574105/sqlalchemy-dynamic-mapping/2575016#2575016  # noqa
 """
 
+import datetime
 import logging
 import random
-from typing import TYPE_CHECKING
+from typing import Any, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
 
 from sqlalchemy import (
+    BigInteger,
+    Boolean,
     Column,
+    DateTime,
+    Integer,
     MetaData,
+    PickleType,
+    String,
     Text,
 )
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql import and_, or_
 from sqlalchemy.orm.session import Session
 
 from crate_anon.anonymise.config_singleton import config
@@ -159,6 +167,41 @@ class TridRecord(AdminBase):
             except IntegrityError:
                 session.rollback()
 
+    @classmethod
+    def get_trids_bulk(cls, session: Session, pids: Iterable[int],
+                       chunksize: int = 10000) -> Dict[int, int]:
+        """
+        Returns a {pid: trid} dictionary for the specified patients, making
+        new TRIDs as required. New TRIDs are drawn at random (without
+        replacement) from the TRID range, avoiding those already in use, and
+        written with multi-row INSERTs. SINGLE-TASKING ONLY: the collision
+        check is done in memory, not by the database, so no other process may
+        be creating TRIDs at the same time.
+        """
+        pid_to_trid = {}  # type: Dict[int, int]
+        used = set()
+        for pid, trid in session.query(cls.pid, cls.trid):
+            pid_to_trid[pid] = trid
+            used.add(trid)
+        new_pids = [pid for pid in pids if pid not in pid_to_trid]
+        new_trids = []  # type: List[int]
+        while len(new_trids) < len(new_pids):
+            for candidate in random.sample(range(1, MAX_TRID + 1),
+                                           len(new_pids) - len(new_trids)):
+                if candidate not in used:
+                    used.add(candidate)
+                    new_trids.append(candidate)
+        log.info("Creating {} new TRIDs".format(len(new_pids)))
+        for start in range(0, len(new_pids), chunksize):
+            session.execute(cls.__table__.insert(), [
+                {'pid': pid, 'trid': trid}
+                for pid, trid in zip(new_pids[start:start + chunksize],
+                                     new_trids[start:start + chunksize])
+            ])
+        session.commit()
+        pid_to_trid.update(zip(new_pids, new_trids))
+        return pid_to_trid
+
 
 class OptOutPid(AdminBase):
     __tablename__ = 'opt_out_pid'
@@ -199,3 +242,569 @@ class OptOutMpid(AdminBase):
         log.debug("Adding opt-out for MPID {}".format(mpid))
         newthing = cls(mpid=mpid)
         session.merge(newthing)
+
+
+# =============================================================================
+# Work queue for dynamic scheduling of patients across processes
+# =============================================================================
+# Patients are put into numbered batches by a single process (see
+# build_patient_queue() in anonymise.py). Each worker then repeatedly claims
+# the next free batch, holding a time-limited lease on it that it renews as it
+# works (between patients, and during a patient with a lot of data). If a
+# worker dies, its lease expires and another worker reclaims the batch; it
+# deletes the destination rows of any of the batch's patients that the first
+# worker got to, and processes them again. With --resume, the queue is kept,
+# and unfinished batches are released at once.
+# Claims are made by conditional UPDATE, so this works without row locking
+# across all our database backends, including SQLite.
+
+WORKER_NAME_MAX_LEN = 255
+
+
+class PatientQueueEntry(AdminBase):
+    __tablename__ = 'work_patient_queue'
+    __table_args__ = TABLE_KWARGS
+
+    pid = Column(
+        'pid', config.PidType,
+        primary_key=True, autoincrement=False,
+        doc="Patient ID (PID) (PK)")
+    batch_num = Column(
+        'batch_num', Integer,
+        nullable=False, index=True,
+        doc="Batch number (FK to work_patient_batch.batch_num)")
+
+    @classmethod
+    def get_pids(cls, session: Session, batch_num: int) -> List[int]:
+        return [
+            row[0] for row in
+            session.query(cls.pid).filter(cls.batch_num == batch_num)
+        ]
+
+
+class PatientBatch(AdminBase):
+    __tablename__ = 'work_patient_batch'
+    __table_args__ = TABLE_KWARGS
+
+    batch_num = Column(
+        'batch_num', Integer,
+        primary_key=True, autoincrement=False,
+        doc="Batch number (PK)")
+    n_patients = Column(
+        'n_patients', Integer,
+        nullable=False,
+        doc="Number of patients in this batch")
+    worker = Column(
+        'worker', String(WORKER_NAME_MAX_LEN),
+        doc="Worker currently (or last) holding this batch")
+    n_claims = Column(
+        'n_claims', Integer,
+        nullable=False, default=0,
+        doc="Number of times this batch has been claimed (>1 means a lease "
+            "expired and the batch was reclaimed)")
+    lease_expires_utc = Column(
+        'lease_expires_utc', DateTime,
+        doc="When the current worker's lease expires (UTC)")
+    claimed_at_utc = Column(
+        'claimed_at_utc', DateTime,
+        doc="When the current worker claimed this batch (UTC)")
+    completed = Column(
+        'completed', Boolean,
+        nullable=False, default=False,
+        doc="Has this batch been completed?")
+    completed_at_utc = Column(
+        'completed_at_utc', DateTime,
+        doc="When this batch was completed (UTC)")
+
+    @classmethod
+    def claimable(cls, now: datetime.datetime) -> Any:
+        return and_(
+            cls.completed == False,  # noqa
+            or_(cls.worker == None, cls.lease_expires_utc < now)  # noqa
+        )
+
+    @classmethod
+    def claim(cls, session: Session, worker: str,
+              lease_s: int) -> Optional[int]:
+        """
+        Claim the next free (or abandoned) batch for this worker, returning
+        its batch number, or None if there's no work left.
+        """
+        while True:
+            now = datetime.datetime.utcnow()
+            candidates = [
+                row[0] for row in
+                session.query(cls.batch_num).
+                filter(cls.claimable(now)).
+                order_by(cls.batch_num).
+                limit(10)
+            ]
+            if not candidates:
+                session.commit()
+                return None
+            for batch_num in candidates:
+                # Another worker may get there first; hence the repeated
+                # conditions.
+                n = (
+                    session.query(cls).
+                    filter(cls.batch_num == batch_num).
+                    filter(cls.claimable(now)).
+                    update({
+                        cls.worker: worker,
+                        cls.lease_expires_utc: now + datetime.timedelta(
+                            seconds=lease_s),
+                        cls.claimed_at_utc: now,
+                        cls.n_claims: cls.n_claims + 1,
+                    }, synchronize_session=False)
+                )
+                session.commit()
+                if n == 1:
+                    return batch_num
+
+    @classmethod
+    def was_reclaimed(cls, session: Session, batch_num: int) -> bool:
+        """
+        Has this batch been claimed more than once?
+        """
+        n_claims = (
+            session.query(cls.n_claims).
+            filter(cls.batch_num == batch_num).
+            scalar()
+        )
+        return (n_claims or 0) > 1
+
+    @classmethod
+    def renew(cls, session: Session, batch_num: int, worker: str,
+              lease_s: int) -> bool:
+        """
+        Extend our lease on a batch. Returns False if we no longer hold it
+        (because our lease expired and someone else has claimed it).
+        """
+        now = datetime.datetime.utcnow()
+        n = (
+            session.query(cls).
+            filter(cls.batch_num == batch_num).
+            filter(cls.worker == worker).
+            filter(cls.completed == False).  # noqa
+            update({
+                cls.lease_expires_utc: now + datetime.timedelta(
+                    seconds=lease_s),
+            }, synchronize_session=False)
+        )
+        session.commit()
+        return n == 1
+
+    @classmethod
+    def release_leases(cls, session: Session) -> int:
+        """
+        Ends the leases on unfinished batches (e.g. held by processes that
+        crashed), so that they can be claimed again at once; they then count
+        as reclaimed. Returns the number released.
+        """
+        n = (
+            session.query(cls).
+            filter(cls.completed == False).  # noqa
+            filter(cls.worker != None).  # noqa
+            update({
+                cls.lease_expires_utc: datetime.datetime.utcnow(),
+            }, synchronize_session=False)
+        )
+        session.commit()
+        return n
+
+    @classmethod
+    def complete(cls, session: Session, batch_num: int, worker: str) -> bool:
+        """
+        Mark a batch as done. Returns False if we no longer held it.
+        """
+        n = (
+            session.query(cls).
+            filter(cls.batch_num == batch_num).
+            filter(cls.worker == worker).
+            update({
+                cls.completed: True,
+                cls.completed_at_utc: datetime.datetime.utcnow(),
+            }, synchronize_session=False)
+        )
+        session.commit()
+        return n == 1
+
+
+# =============================================================================
+# Index work queue, for size-aware scheduling of index builds
+# =============================================================================
+# All index-building processes work out the same list of destination tables to
+# index, most costly first. Each walks down the list and claims tables by
+# inserting a row here; the table's PK makes sure that only one process gets
+# each. So the biggest jobs start first, and each process takes the next
+# biggest job when it's free. The queue is wiped when a run starts afresh
+# (see drop_remake() in anonymise.py); on --resume, unfinished claims are
+# released. An --index step that isn't resuming also releases tables indexed
+# before it started, so that indexing again (e.g. after an --index-only run)
+# does check them.
+
+INDEX_TABLE_NAME_MAX_LEN = 128
+
+
+class IndexJob(AdminBase):
+    __tablename__ = 'work_index_queue'
+    __table_args__ = TABLE_KWARGS
+
+    dest_table = Column(
+        'dest_table', String(INDEX_TABLE_NAME_MAX_LEN),
+        primary_key=True,
+        doc="Destination table to be indexed (PK)")
+    cost = Column(
+        'cost', BigInteger,
+        doc="Estimated cost of building this table's indexes")
+    worker = Column(
+        'worker', String(WORKER_NAME_MAX_LEN),
+        doc="Worker that claimed this table")
+    claimed_at_utc = Column(
+        'claimed_at_utc', DateTime,
+        nullable=False,
+        doc="When the worker claimed this table (UTC)")
+    completed = Column(
+        'completed', Boolean,
+        nullable=False, default=False,
+        doc="Have this table's indexes been built?")
+    completed_at_utc = Column(
+        'completed_at_utc', DateTime,
+        doc="When this table's indexes were built (UTC)")
+
+    @classmethod
+    def claim(cls, session: Session, dest_table: str, cost: int,
+              worker: str) -> bool:
+        """
+        Claim a table for indexing; returns True if we got it.
+        """
+        try:
+            session.execute(cls.__table__.insert(), {
+                'dest_table': dest_table,
+                'cost': cost,
+                'worker': worker,
+                'claimed_at_utc': datetime.datetime.utcnow(),
+                'completed': False,
+            })
+            session.commit()
+            return True
+        except IntegrityError:  # someone else has claimed it
+            session.rollback()
+            return False
+
+    @classmethod
+    def release_incomplete(cls, session: Session) -> None:
+        """
+        Forget claims that were never completed (e.g. by processes that
+        crashed), so that the tables can be claimed again.
+        """
+        session.query(cls).filter(cls.completed == False).delete(  # noqa
+            synchronize_session=False)
+        session.commit()
+
+    @classmethod
+    def release_completed(cls, session: Session,
+                          completed_by: datetime.datetime) -> int:
+        """
+        Forget tables whose indexing was completed by the given time (UTC),
+        so that they can be claimed again. Returns the number released.
+        """
+        n = session.query(cls).filter(
+            cls.completed == True,  # noqa
+            cls.completed_at_utc <= completed_by,
+        ).delete(synchronize_session=False)
+        session.commit()
+        return n
+
+    @classmethod
+    def complete(cls, session: Session, dest_table: str) -> None:
+        session.query(cls).filter(cls.dest_table == dest_table).update({
+            cls.completed: True,
+            cls.completed_at_utc: datetime.datetime.utcnow(),
+        }, synchronize_session=False)
+        session.commit()
+
+
+# =============================================================================
+# Progress ledger, for resuming interrupted runs
+# =============================================================================
+# Each process records the units of work it has finished, once their data has
+# been committed to the destination database. A unit is a patient's data from
+# one source table, or (for non-patient tables) one process's share of a table:
+# a PK range, a PK modulus, or the whole table. The ledger is wiped when a run
+# starts afresh (see drop_remake() in anonymise.py); with --resume, finished
+# units are skipped, as long as the data dictionary and (for patients) the
+# patient's scrubber haven't changed since.
+
+LEDGER_NAME_MAX_LEN = 128
+LEDGER_UNIT_MAX_LEN = 100
+LEDGER_DD_VERSION_LEN = 32
+
+
+class ProgressLedgerEntry(AdminBase):
+    __tablename__ = 'work_progress_ledger'
+    __table_args__ = TABLE_KWARGS
+
+    unit = Column(
+        'unit', String(LEDGER_UNIT_MAX_LEN),
+        primary_key=True,
+        doc="Unit of work within the table, e.g. 'pid:123' for a patient, "
+            "'pk:1-1000' for a PK range (PK, part 1)")
+    src_db = Column(
+        'src_db', String(LEDGER_NAME_MAX_LEN),
+        primary_key=True,
+        doc="Source database (PK, part 2)")
+    src_table = Column(
+        'src_table', String(LEDGER_NAME_MAX_LEN),
+        primary_key=True,
+        doc="Source table (PK, part 3)")
+    scrubber_hash = Column(
+        'scrubber_hash', config.SqlTypeEncryptedPid,
+        doc="For patient units: scrubber hash used")
+    dd_version = Column(
+        'dd_version', String(LEDGER_DD_VERSION_LEN),
+        nullable=False,
+        doc="Digest of the data dictionary used")
+    completed_at_utc = Column(
+        'completed_at_utc', DateTime,
+        nullable=False,
+        doc="When this unit was completed (UTC)")
+
+    @staticmethod
+    def patient_unit(pid: int) -> str:
+        return "pid:{}".format(pid)
+
+    @classmethod
+    def get_completed(cls, session: Session, unit: str, dd_version: str,
+                      scrubber_hash: str = None) -> List[Tuple[str, str]]:
+        """
+        Returns (src_db, src_table) pairs for which this unit of work is
+        finished, with the same data dictionary and scrubber.
+        """
+        return [
+            (row[0], row[1]) for row in
+            session.query(cls.src_db, cls.src_table).
+            filter(cls.unit == unit).
+            filter(cls.dd_version == dd_version).
+            filter(cls.scrubber_hash == scrubber_hash)
+        ]
+
+    @classmethod
+    def record(cls, session: Session,
+               entries: List[Tuple[str, List[Tuple[str, str]], str,
+                                   Optional[str]]],
+               chunksize: int = 100) -> None:
+        """
+        Records units of work as finished, replacing any previous entries for
+        them, and commits. Each entry is a tuple of (unit, list of (src_db,
+        src_table) pairs, dd_version, scrubber_hash).
+        """
+        records = [
+            {
+                'unit': unit,
+                'src_db': src_db,
+                'src_table': src_table,
+                'scrubber_hash': scrubber_hash,
+                'dd_version': dd_version,
+            }
+            for unit, db_table_pairs, dd_version, scrubber_hash in entries
+            for src_db, src_table in db_table_pairs
+        ]
+        if not records:
+            return
+        for start in range(0, len(records), chunksize):
+            (
+                session.query(cls).
+                filter(or_(*[
+                    and_(cls.unit == r['unit'],
+                         cls.src_db == r['src_db'],
+                         cls.src_table == r['src_table'])
+                    for r in records[start:start + chunksize]
+                ])).
+                delete(synchronize_session=False)
+            )
+        now = datetime.datetime.utcnow()
+        for r in records:
+            r['completed_at_utc'] = now
+        session.execute(cls.__table__.insert(), records)
+        session.commit()
+
+
+# =============================================================================
+# Source high-water marks, for watermark-based incremental runs
+# =============================================================================
+# For source tables with a watermark column (e.g. a last-modified time; see
+# incremental_watermark_columns in the source database config), incremental
+# runs read only rows whose watermark is at least the high-water mark reached
+# by the last completed run. When a run starts (see drop_remake() in
+# anonymise.py), each table's current MAX(watermark) is stored as "pending";
+# once the run has completed (the --savewatermarks step), that becomes the
+# high-water mark for the next run. A run that never completes therefore
+# leaves the previous high-water mark in place.
+
+class SourceWatermark(AdminBase):
+    __tablename__ = 'work_source_watermark'
+    __table_args__ = TABLE_KWARGS
+
+    src_db = Column(
+        'src_db', String(LEDGER_NAME_MAX_LEN),
+        primary_key=True,
+        doc="Source database (PK, part 1)")
+    src_table = Column(
+        'src_table', String(LEDGER_NAME_MAX_LEN),
+        primary_key=True,
+        doc="Source table (PK, part 2)")
+    watermark_field = Column(
+        'watermark_field', String(LEDGER_NAME_MAX_LEN),
+        nullable=False,
+        doc="Source watermark field (e.g. last-modified time)")
+    high_water = Column(
+        'high_water', PickleType,
+        doc="Highest watermark value read by the last completed run")
+    dd_version = Column(
+        'dd_version', String(LEDGER_DD_VERSION_LEN),
+        doc="Digest of the data dictionary used by the last completed run")
+    pending_high_water = Column(
+        'pending_high_water', PickleType,
+        doc="Highest watermark value when the current run started")
+    pending_dd_version = Column(
+        'pending_dd_version', String(LEDGER_DD_VERSION_LEN),
+        doc="Digest of the data dictionary used by the current run")
+
+    @classmethod
+    def get_high_water(cls, session: Session, src_db: str, src_table: str,
+                       watermark_field: str, dd_version: str) -> Any:
+        """
+        Returns the high-water mark from the last completed run, if it used
+        the same watermark field and data dictionary; otherwise, None.
+        """
+        try:
+            wm = (
+                session.query(cls).
+                filter(cls.src_db == src_db).
+                filter(cls.src_table == src_table).
+                one()
+            )
+        except NoResultFound:
+            return None
+        if (wm.watermark_field != watermark_field or
+                wm.dd_version != dd_version):
+            return None
+        return wm.high_water
+
+    @classmethod
+    def start_run(cls, session: Session, src_db: str, src_table: str,
+                  watermark_field: str, pending_high_water: Any,
+                  dd_version: str, incremental: bool) -> None:
+        """
+        Records the table's current highest watermark, for use once this run
+        completes. For a full run, forgets the old high-water mark.
+        """
+        wm = session.query(cls).get((src_db, src_table))
+        if wm is None:
+            wm = cls(src_db=src_db, src_table=src_table)
+            session.add(wm)
+        if wm.watermark_field != watermark_field or not incremental:
+            wm.high_water = None
+            wm.dd_version = None
+        wm.watermark_field = watermark_field
+        wm.pending_high_water = pending_high_water
+        wm.pending_dd_version = dd_version
+        session.commit()
+
+    @classmethod
+    def complete_run(cls, session: Session) -> int:
+        """
+        Makes the pending high-water marks current. Returns the number of
+        tables.
+        """
+        n = 0
+        for wm in session.query(cls).filter(
+                cls.pending_dd_version != None):  # noqa
+            wm.high_water = wm.pending_high_water
+            wm.dd_version = wm.pending_dd_version
+            wm.pending_high_water = None
+            wm.pending_dd_version = None
+            n += 1
+        session.commit()
+        return n
+
+
+# =============================================================================
+# Scrubber element store, to save rebuilding unchanged scrubbers
+# =============================================================================
+# Making a patient's scrubber means reading their scrub-source values and
+# turning each into regex elements (see PersonalizedScrubber.add_value()). If
+# the scrubber_element_store option is set, we keep, for each patient and
+# each scrub-source table, a digest of the values read from that table (in
+# order, with their scrub methods, and with those of any third parties they
+# refer to), along with the elements they made. If every table's digest
+# matches next time, the stored elements are used as they are.
+
+class ScrubberElementStore(AdminBase):
+    __tablename__ = 'secret_scrubber_elements'
+    __table_args__ = TABLE_KWARGS
+
+    pid = Column(
+        'pid', config.PidType,
+        primary_key=True, autoincrement=False,
+        doc="Patient ID (PID) (PK, part 1)")
+    src_db = Column(
+        'src_db', String(LEDGER_NAME_MAX_LEN),
+        primary_key=True,
+        doc="Source database (PK, part 2)")
+    src_table = Column(
+        'src_table', String(LEDGER_NAME_MAX_LEN),
+        primary_key=True,
+        doc="Source table (PK, part 3)")
+    digest = Column(
+        'digest', config.SqlTypeSourceHash,
+        nullable=False,
+        doc="Digest of the scrubber settings and the scrub-source values "
+            "read from this table")
+    elements = Column(
+        'elements', PickleType,
+        doc="Scrubber elements made from those values: a tuple of (patient "
+            "regex elements, third-party regex elements, raw element "
+            "tuples); see PersonalizedScrubber.get_elements()")
+
+    @classmethod
+    def get_digests(cls, session: Session,
+                    pid: int) -> Dict[Tuple[str, str], str]:
+        """
+        Returns a {(src_db, src_table): digest} dictionary of what we have
+        stored for a patient.
+        """
+        return {
+            (src_db, src_table): digest
+            for src_db, src_table, digest in session.query(
+                cls.src_db, cls.src_table, cls.digest).filter(cls.pid == pid)
+        }
+
+    @classmethod
+    def get_elements(cls, session: Session, pid: int,
+                     db_table_pairs: List[Tuple[str, str]]) -> List[Any]:
+        """
+        Returns the stored elements for a patient, one item per table, in the
+        order of db_table_pairs.
+        """
+        stored = {
+            (src_db, src_table): elements
+            for src_db, src_table, elements in session.query(
+                cls.src_db, cls.src_table, cls.elements).filter(
+                cls.pid == pid)
+        }
+        return [stored[pair] for pair in db_table_pairs]
+
+    @classmethod
+    def replace(cls, session: Session, pid: int,
+                records: List[Tuple[str, str, str, Any]]) -> None:
+        """
+        Replaces what's stored for a patient with records of (src_db,
+        src_table, digest, elements). The caller commits.
+        """
+        session.query(cls).filter(cls.pid == pid).delete(
+            synchronize_session=False)
+        for src_db, src_table, digest, elements in records:
+            session.add(cls(pid=pid, src_db=src_db, src_table=src_table,
+                            digest=digest, elements=elements))
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# crate_anon/anonymise/optout.py
+
+"""
+===============================================================================
+    Copyright (C) 2015-2017 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+===============================================================================
+
+In-memory copies of the opt-out lists.
+
+Rather than asking the admin database whether each patient has opted out, a
+process can load the opt-out list once and check it in memory:
+
+- integer IDs are held in a sorted array (8 bytes each), searched by
+  bisection;
+- other IDs (e.g. strings) are held in a set;
+- very large lists can instead be held as a Bloom filter (a bit over one byte
+  per ID), which can say "definitely not opted out"; possible opt-outs are
+  then confirmed with the database.
+
+Opt-outs are only ever added, never removed (see the config file), so a
+cheap way to notice opt-outs added during a run is to check, now and then,
+whether the number of rows in the table has changed; if so, we reload.
+"""
+
+from array import array
+from bisect import bisect_left
+import logging
+import math
+import time
+from typing import Any, Iterable, List, Optional, Sequence
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.session import Session
+from sqlalchemy.schema import Column
+from sqlalchemy.sql import func, select
+from sqlalchemy.types import Integer, String
+
+from crate_anon.common.sqla import exists_orm
+
+log = logging.getLogger(__name__)
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+UINT64_MASK = 2 ** 64 - 1
+BLOOM_HASH_MULTIPLIER_1 = 0x9E3779B97F4A7C15  # odd 64-bit constants
+BLOOM_HASH_MULTIPLIER_2 = 0xC2B2AE3D27D4EB4F
+DEFAULT_BLOOM_FALSE_POSITIVE_RATE = 0.01
+
+
+# =============================================================================
+# Compact sets
+# =============================================================================
+
+class SortedIntegerSet(object):
+    """
+    Immutable set of 64-bit integers, held as a sorted array.
+    """
+    def __init__(self, values: Iterable[int]) -> None:
+        self._values = array('q', sorted(set(values)))
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __contains__(self, value: int) -> bool:
+        i = bisect_left(self._values, value)
+        return i < len(self._values) and self._values[i] == value
+
+
+class BloomFilter(object):
+    """
+    Bloom filter: answers "definitely not present" or "possibly present".
+    Uses double hashing on Python's hash(), so it's only meaningful within
+    the process that built it.
+    """
+    def __init__(self,
+                 values: Sequence[Any],
+                 false_positive_rate: float =
+                 DEFAULT_BLOOM_FALSE_POSITIVE_RATE) -> None:
+        n = max(len(values), 1)
+        self.n_bits = max(
+            int(-n * math.log(false_positive_rate) / (math.log(2) ** 2)), 8)
+        self.n_hashes = max(int(round(self.n_bits / n * math.log(2))), 1)
+        self._bits = bytearray((self.n_bits + 7) // 8)
+        for value in values:
+            for bit in self._gen_bits(value):
+                self._bits[bit >> 3] |= 1 << (bit & 7)
+
+    def _gen_bits(self, value: Any) -> Iterable[int]:
+        h = hash(value)
+        h1 = (h * BLOOM_HASH_MULTIPLIER_1) & UINT64_MASK
+        h2 = ((h * BLOOM_HASH_MULTIPLIER_2) & UINT64_MASK) | 1
+        for i in range(self.n_hashes):
+            yield (h1 + i * h2) % self.n_bits
+
+    def __contains__(self, value: Any) -> bool:
+        return all(self._bits[bit >> 3] & (1 << (bit & 7))
+                   for bit in self._gen_bits(value))
+
+
+# =============================================================================
+# Opt-out list
+# =============================================================================
+
+class OptOutFilter(object):
+    """
+    Answers "has this patient opted out?" for one opt-out table (e.g.
+    OptOutPid), from memory. The list is loaded on first use.
+    """
+    def __init__(self,
+                 model: Any,
+                 idcol: Any,
+                 bloom_filter_threshold: int = 0,
+                 refresh_interval_s: float = 0) -> None:
+        """
+        model: SQLAlchemy ORM class for the opt-out table
+        idcol: its ID column (e.g. OptOutPid.pid)
+        bloom_filter_threshold: if the list has at least this many entries,
+            use a Bloom filter (0 for never)
+        refresh_interval_s: how often to check for new opt-outs (0 for never)
+        """
+        self.model = model
+        self.idcol = idcol
+        self.bloom_filter_threshold = bloom_filter_threshold
+        self.refresh_interval_s = refresh_interval_s
+        self._members = None  # type: Any
+        self._bloom = False
+        self._n_loaded = None  # type: Optional[int]
+        self._last_checked = 0.0
+
+    def clear(self) -> None:
+        """Forget the list; it'll be reloaded when next needed."""
+        self._members = None
+        self._n_loaded = None
+
+    def _count(self, session: Session) -> int:
+        return session.execute(
+            select([func.count()]).select_from(self.model.__table__)
+        ).scalar()
+
+    def _load(self, session: Session) -> None:
+        ids = [row[0] for row in session.query(self.idcol)]
+        self._n_loaded = len(ids)
+        self._last_checked = time.monotonic()
+        self._bloom = bool(self.bloom_filter_threshold and
+                           len(ids) >= self.bloom_filter_threshold)
+        if self._bloom:
+            self._members = BloomFilter(ids)
+            kind = "Bloom filter ({} bits)".format(self._members.n_bits)
+        elif all(isinstance(x, int) and INT64_MIN <= x <= INT64_MAX
+                 for x in ids):
+            self._members = SortedIntegerSet(ids)
+            kind = "sorted array"
+        else:
+            self._members = frozenset(ids)
+            kind = "set"
+        log.debug("Loaded {} opt-outs from {} as {}".format(
+            len(ids), self.model.__tablename__, kind))
+
+    def _refresh_if_due(self, session: Session) -> None:
+        if self._members is None:
+            self._load(session)
+            return
+        if not self.refresh_interval_s:
+            return
+        now = time.monotonic()
+        if now - self._last_checked < self.refresh_interval_s:
+            return
+        self._last_checked = now
+        if self._count(session) != self._n_loaded:
+            log.info("Opt-out list {} has changed; reloading".format(
+                self.model.__tablename__))
+            self._load(session)
+
+    def opting_out(self, session: Session, value: Any) -> bool:
+        self._refresh_if_due(session)
+        if isinstance(self._members, SortedIntegerSet):
+            if isinstance(value, int):
+                return value in self._members
+            # Not an integer; let the database decide how to compare it.
+        elif value not in self._members:
+            return False
+        elif not self._bloom:
+            return True
+        # Possible (Bloom filter) or otherwise uncertain; ask the database.
+        return exists_orm(session, self.model, self.idcol == value)
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+SampleBase = declarative_base()
+
+
+class SampleIntOptOut(SampleBase):
+    __tablename__ = 'sample_opt_out_int'
+    pid = Column('pid', Integer, primary_key=True)
+
+
+class SampleStrOptOut(SampleBase):
+    __tablename__ = 'sample_opt_out_str'
+    pid = Column('pid', String(20), primary_key=True)
+
+
+class TestCompactSets(unittest.TestCase):
+    def test_sorted_integer_set(self) -> None:
+        values = [5, -3, 5, INT64_MAX, INT64_MIN, 0, 1000]
+        s = SortedIntegerSet(values)
+        self.assertEqual(len(s), 6)
+        for v in values:
+            self.assertIn(v, s)
+        for v in (-4, 1, 4, 6, 999, INT64_MAX - 1, INT64_MIN + 1):
+            self.assertNotIn(v, s)
+        self.assertNotIn(1, SortedIntegerSet([]))
+
+    def test_bloom_filter(self) -> None:
+        members = list(range(0, 20000, 2))
+        bloom = BloomFilter(members, false_positive_rate=0.01)
+        for v in members:
+            self.assertIn(v, bloom)  # never a false negative
+        n_false_positives = sum(1 for v in range(1, 20000, 2) if v in bloom)
+        self.assertLess(n_false_positives, 0.02 * 10000)
+        self.assertIn("x", BloomFilter(["x", "y"]))
+        self.assertNotIn(1, BloomFilter([]))
+
+
+class TestOptOutFilter(unittest.TestCase):
+    def setUp(self) -> None:
+        engine = create_engine("sqlite://")
+        SampleBase.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.session.add_all([SampleIntOptOut(pid=pid) for pid in (3, 7, 11)])
+        self.session.add_all([SampleStrOptOut(pid=pid) for pid in ("a", "b")])
+        self.session.commit()
+        self.now = 1000.0
+        patches = [
+            mock.patch(__name__ + '.time.monotonic', lambda: self.now),
+            mock.patch(__name__ + '.exists_orm', wraps=exists_orm),
+        ]
+        self.exists_orm = patches[1].start()
+        patches[0].start()
+        for p in patches:
+            self.addCleanup(p.stop)
+
+    def tearDown(self) -> None:
+        self.session.close()
+
+    def opting_out(self, f: OptOutFilter, values: Iterable[Any]) -> List[Any]:
+        return [v for v in values if f.opting_out(self.session, v)]
+
+    def test_integers(self) -> None:
+        f = OptOutFilter(SampleIntOptOut, SampleIntOptOut.pid)
+        self.assertEqual(self.opting_out(f, range(15)), [3, 7, 11])
+        self.assertIsInstance(f._members, SortedIntegerSet)
+        self.assertEqual(self.exists_orm.call_count, 0)
+        # Anything else is compared by the database.
+        self.assertEqual(self.opting_out(f, ["7", None]), ["7"])
+        self.assertEqual(self.exists_orm.call_count, 2)
+
+    def test_strings(self) -> None:
+        f = OptOutFilter(SampleStrOptOut, SampleStrOptOut.pid)
+        self.assertEqual(self.opting_out(f, ["a", "b", "c", 1]), ["a", "b"])
+        self.assertIsInstance(f._members, frozenset)
+        self.assertEqual(self.exists_orm.call_count, 0)
+
+    def test_bloom_filter(self) -> None:
+        f = OptOutFilter(SampleIntOptOut, SampleIntOptOut.pid,
+                         bloom_filter_threshold=3)
+        self.assertEqual(self.opting_out(f, range(15)), [3, 7, 11])
+        self.assertIsInstance(f._members, BloomFilter)
+        # Possible members are confirmed by the database (not many others).
+        self.assertGreaterEqual(self.exists_orm.call_count, 3)
+        self.assertLess(self.exists_orm.call_count, 15)
+        f = OptOutFilter(SampleIntOptOut, SampleIntOptOut.pid,
+                         bloom_filter_threshold=4)
+        f.opting_out(self.session, 3)
+        self.assertIsInstance(f._members, SortedIntegerSet)  # too few
+
+    def test_refresh(self) -> None:
+        f = OptOutFilter(SampleIntOptOut, SampleIntOptOut.pid,
+                         refresh_interval_s=60)
+        never = OptOutFilter(SampleIntOptOut, SampleIntOptOut.pid)
+        self.assertEqual(self.opting_out(f, [5]), [])
+        self.assertEqual(self.opting_out(never, [5]), [])
+        self.session.add(SampleIntOptOut(pid=5))
+        self.session.commit()
+        self.now += 59
+        self.assertEqual(self.opting_out(f, [5]), [])  # not yet
+        self.now += 1
+        self.assertEqual(self.opting_out(f, [5]), [5])
+        self.assertEqual(self.opting_out(never, [5]), [])
+        never.clear()
+        self.assertEqual(self.opting_out(never, [5]), [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
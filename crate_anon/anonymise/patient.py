@@ -25,13 +25,19 @@ Patient class for CRATE anonymiser.
 """
 
 import logging
-from typing import AbstractSet, Any, Generator, List
+from typing import (AbstractSet, Any, Dict, Generator, Iterable, List,
+                    Optional, Set, Tuple)
 
 from sqlalchemy.sql import column, select, table
 
 from crate_anon.anonymise.config_singleton import config
-from crate_anon.anonymise.constants import SCRUBSRC
-from crate_anon.anonymise.models import PatientInfo
+from crate_anon.anonymise.constants import (
+    MAX_IN_CLAUSE_VALUES,
+    SCRUBMETHOD,
+    SCRUBSRC,
+)
+from crate_anon.anonymise.models import PatientInfo, ScrubberElementStore
+from crate_anon.anonymise.patientscan import PatientTableScan
 from crate_anon.anonymise.scrub import PersonalizedScrubber
 
 log = logging.getLogger(__name__)
@@ -79,6 +85,123 @@ def gen_all_values_for_patient(dbname: str,
         yield row
 
 
+def gen_all_values_for_patients(
+        dbname: str,
+        tablename: str,
+        fields: List[str],
+        pids: List[int]) -> Generator[List[Any], None, None]:
+    """
+    As for gen_all_values_for_patient(), but for several patients at once.
+    Yields rows, where each row is a list of values: the PID, then values
+    that match "fields".
+    """
+    cfg = config.sources[dbname].srccfg
+    if not cfg.ddgen_per_table_pid_field:
+        return
+    log.debug(
+        "gen_all_values_for_patients: {n} PIDs, table {d}.{t}, "
+        "fields: {f}".format(
+            d=dbname, t=tablename, f=",".join(fields), n=len(pids)))
+    pidcol = column(cfg.ddgen_per_table_pid_field)
+    query = (
+        select([pidcol] + [column(f) for f in fields]).
+        where(pidcol.in_(pids)).
+        select_from(table(tablename))
+    )
+    for row in config.sources[dbname].gen_query_rows(query):
+        yield list(row)
+
+
+# =============================================================================
+# Fetch identifiable values for a block of patients at once
+# =============================================================================
+
+class ScrubSourceFetcher(object):
+    """
+    Fetches the scrub-source values for a block of patients together, with
+    one query (WHERE pid IN ...) per scrub-source table, rather than one per
+    table per patient, and holds them in memory until the next block. Third
+    parties that those values refer to (see thirdparty_xref_max_depth) are
+    fetched in the same way, one level of cross-reference at a time. (No IN
+    list is longer than MAX_IN_CLAUSE_VALUES; longer lists are split.)
+
+    Iterate through gen_patient_ids(); while each patient is current,
+    get_rows() returns their (or their third parties') values.
+    """
+    def __init__(self, block_size: int, max_depth: int) -> None:
+        self.block_size = block_size
+        self.max_depth = max_depth
+        self._rows = {}  # type: Dict[Tuple[str, str], Dict[int, List[List[Any]]]]  # noqa
+        self._fetched = set()  # type: Set[int]
+
+    def gen_patient_ids(
+            self, pidgen: Iterable[int]) -> Generator[int, None, None]:
+        """
+        Reads patient IDs in blocks, fetches each block's values, and
+        generates the IDs.
+        """
+        block = []  # type: List[int]
+        for pid in pidgen:
+            block.append(pid)
+            if len(block) >= self.block_size:
+                self.fetch(block)
+                yield from block
+                block = []
+        if block:
+            self.fetch(block)
+            yield from block
+        self.fetch([])  # free the last block
+
+    def fetch(self, pids: List[int]) -> None:
+        """
+        Fetches the values for these patients, and for their third parties,
+        replacing those from the previous block.
+        """
+        self._rows = {}
+        self._fetched = set()
+        for depth in range(self.max_depth + 1):
+            new_pids = []  # type: List[int]
+            for pid in pids:
+                if pid not in self._fetched:
+                    self._fetched.add(pid)
+                    new_pids.append(pid)
+            if not new_pids:
+                return
+            pids = []  # the next level of third parties
+            chunksize = min(self.block_size, MAX_IN_CLAUSE_VALUES)
+            for (src_db, src_table) in \
+                    config.dd.get_scrub_from_db_table_pairs():
+                ddrows = config.dd.get_scrub_from_rows(src_db, src_table)
+                fields = [ddr.src_field for ddr in ddrows]
+                xref_indexes = [
+                    i for i, ddr in enumerate(ddrows)
+                    if ddr.scrub_src is SCRUBSRC.THIRDPARTY_XREF_PID
+                ] if depth < self.max_depth else []
+                pid_to_rows = self._rows.setdefault((src_db, src_table), {})
+                for start in range(0, len(new_pids), chunksize):
+                    for row in gen_all_values_for_patients(
+                            src_db, src_table, fields,
+                            new_pids[start:start + chunksize]):
+                        values = row[1:]
+                        pid_to_rows.setdefault(row[0], []).append(values)
+                        for i in xref_indexes:
+                            try:
+                                pids.append(int(values[i]))
+                            except (ValueError, TypeError):
+                                pass  # as in Patient._gen_scrub_values()
+
+    def get_rows(self, src_db: str, src_table: str,
+                 pid: int) -> Optional[List[List[Any]]]:
+        """
+        Returns a patient's rows from a scrub-source table, each a list of
+        values matching the table's scrub-source fields, or None if we
+        haven't fetched that patient.
+        """
+        if pid not in self._fetched:
+            return None
+        return self._rows.get((src_db, src_table), {}).get(pid, [])
+
+
 # =============================================================================
 # Patient class, which hosts the patient-specific scrubber
 # =============================================================================
@@ -87,7 +210,9 @@ class Patient(object):
     """Class representing a patient-specific information, such as PIDs, RIDs,
     and scrubbers."""
 
-    def __init__(self, pid: int, debug: bool = False) -> None:
+    def __init__(self, pid: int, debug: bool = False,
+                 scan: PatientTableScan = None,
+                 fetcher: ScrubSourceFetcher = None) -> None:
         """
         Build the scrubber based on data dictionary information.
 
@@ -95,8 +220,15 @@ class Patient(object):
                 key: db name
                 value: rnc_db database object
             pid: integer patient identifier
+            scan: if specified, a PatientTableScan that is currently on this
+                patient, from which this patient's scrub-source values are
+                taken (rather than querying the source databases)
+            fetcher: if specified, a ScrubSourceFetcher that has fetched this
+                patient's scrub-source values (and their third parties')
         """
         self.pid = pid
+        self._scan = scan
+        self._fetcher = fetcher
         self.session = config.admindb.session
 
         # Fetch or create PatientInfo object
@@ -132,6 +264,10 @@ class Patient(object):
             scrub_string_suffixes=config.scrub_string_suffixes,
             string_max_regex_errors=config.string_max_regex_errors,
             whitelist=config.whitelist,
+            cache_max_bytes=config.scrub_cache_max_bytes,
+            cache_stats=config.scrub_cache_stats,
+            single_pass=config.scrub_single_pass,
+            factor_prefixes=config.scrub_factor_prefixes,
         )
         # Database
         # Construction. We go through all "scrub-from" fields in the data
@@ -141,9 +277,14 @@ class Patient(object):
         self._db_table_pair_list = config.dd.get_scrub_from_db_table_pairs()
         self._mandatory_scrubbers_unfulfilled = \
             config.dd.get_mandatory_scrubber_sigs().copy()
-        self._build_scrubber(pid,
-                             depth=0,
-                             max_depth=config.thirdparty_xref_max_depth)
+        if config.scrubber_element_store:
+            self._build_scrubber_via_store(
+                pid, max_depth=config.thirdparty_xref_max_depth)
+        else:
+            self._build_scrubber(pid,
+                                 depth=0,
+                                 max_depth=config.thirdparty_xref_max_depth)
+        self._seen_before = self.info.scrubber_hash is not None
         self._unchanged = self.get_scrubber_hash() == self.info.scrubber_hash
         self.info.set_scrubber_info(self.scrubber)
         self.session.commit()
@@ -152,52 +293,120 @@ class Patient(object):
         #   Deadlock found when trying to get lock; try restarting transaction
 
     def _build_scrubber(self, pid: int, depth: int, max_depth: int) -> None:
-        if depth > 0:
-            log.debug("Building scrubber recursively: depth = {}".format(
-                depth))
         for (src_db, src_table) in self._db_table_pair_list:
-            # Build a list of fields for this table.
-            ddrows = config.dd.get_scrub_from_rows(src_db, src_table)
-            fields = [ddr.src_field for ddr in ddrows]
-            # Precalculate things; we might being going through a lot of values
-            scrub_method = [
-                PersonalizedScrubber.get_scrub_method(ddr.src_datatype,
-                                                      ddr.scrub_method)
-                for ddr in ddrows
-            ]
-            is_patient = [depth == 0 and ddr.scrub_src is SCRUBSRC.PATIENT
-                          for ddr in ddrows]
-            is_mpid = [depth == 0 and ddr.master_pid for ddr in ddrows]
-            recurse = [depth < max_depth and
-                       ddr.scrub_src is SCRUBSRC.THIRDPARTY_XREF_PID
-                       for ddr in ddrows]
-            required_scrubber = [ddr.required_scrubber for ddr in ddrows]
-            sigs = [ddr.get_signature() for ddr in ddrows]
-            # Collect the actual patient-specific values for this table.
-            for values in gen_all_values_for_patient(src_db, src_table,
-                                                     fields, pid):
-                for i, val in enumerate(values):
-                    self.scrubber.add_value(val, scrub_method[i],
-                                            patient=is_patient[i])
-
-                    if is_mpid[i] and self.get_mpid() is None:
-                        # We've come across the master ID.
-                        self.set_mpid(val)
-
-                    if recurse[i]:
-                        # We've come across a patient ID of another patient,
-                        # whose information should be trawled and treated
-                        # as third-party information
-                        try:
-                            related_pid = int(val)
-                        except (ValueError, TypeError):
-                            # TypeError: NULL value (None)
-                            # ValueError: duff value, i.e. non-integer
-                            continue
-                        self._build_scrubber(related_pid, depth + 1, max_depth)
-
-                    if val is not None and required_scrubber[i]:
-                        self._mandatory_scrubbers_unfulfilled.discard(sigs[i])
+            for val, scrub_method, is_patient in self._gen_scrub_values(
+                    pid, src_db, src_table, depth, max_depth):
+                self.scrubber.add_value(val, scrub_method, patient=is_patient)
+
+    def _gen_scrub_values(self, pid: int, src_db: str, src_table: str,
+                          depth: int, max_depth: int) \
+            -> Generator[Tuple[Any, SCRUBMETHOD, bool], None, None]:
+        """
+        Generates (value, scrub method, is it patient information?) for every
+        scrub-source value in a table, in the order they should be added to
+        the scrubber, including (after the value that refers to them) those
+        of any third parties. Notes the master PID and any mandatory
+        scrubbers fulfilled along the way.
+        """
+        # Build a list of fields for this table.
+        ddrows = config.dd.get_scrub_from_rows(src_db, src_table)
+        fields = [ddr.src_field for ddr in ddrows]
+        # Precalculate things; we might being going through a lot of values
+        scrub_method = [
+            PersonalizedScrubber.get_scrub_method(ddr.src_datatype,
+                                                  ddr.scrub_method)
+            for ddr in ddrows
+        ]
+        is_patient = [depth == 0 and ddr.scrub_src is SCRUBSRC.PATIENT
+                      for ddr in ddrows]
+        is_mpid = [depth == 0 and ddr.master_pid for ddr in ddrows]
+        recurse = [depth < max_depth and
+                   ddr.scrub_src is SCRUBSRC.THIRDPARTY_XREF_PID
+                   for ddr in ddrows]
+        required_scrubber = [ddr.required_scrubber for ddr in ddrows]
+        sigs = [ddr.get_signature() for ddr in ddrows]
+        # Collect the actual patient-specific values for this table.
+        if depth == 0 and self._scan is not None:
+            srccfg = config.sources[src_db].srccfg
+            pidfield = srccfg.ddgen_per_table_pid_field
+            rowgen = (
+                self._scan.get_rows(src_db, src_table, pidfield, fields)
+                if pidfield else []
+            )
+        else:
+            rowgen = (
+                self._fetcher.get_rows(src_db, src_table, pid)
+                if self._fetcher is not None else None
+            )
+            if rowgen is None:
+                rowgen = gen_all_values_for_patient(src_db, src_table,
+                                                    fields, pid)
+        for values in rowgen:
+            for i, val in enumerate(values):
+                yield val, scrub_method[i], is_patient[i]
+
+                if is_mpid[i] and self.get_mpid() is None:
+                    # We've come across the master ID.
+                    self.set_mpid(val)
+
+                if recurse[i]:
+                    # We've come across a patient ID of another patient,
+                    # whose information should be trawled and treated
+                    # as third-party information
+                    try:
+                        related_pid = int(val)
+                    except (ValueError, TypeError):
+                        # TypeError: NULL value (None)
+                        # ValueError: duff value, i.e. non-integer
+                        continue
+                    log.debug("Building scrubber recursively: "
+                              "depth = {}".format(depth + 1))
+                    for (db, tablename) in self._db_table_pair_list:
+                        yield from self._gen_scrub_values(
+                            related_pid, db, tablename, depth + 1, max_depth)
+
+                if val is not None and required_scrubber[i]:
+                    self._mandatory_scrubbers_unfulfilled.discard(sigs[i])
+
+    def _build_scrubber_via_store(self, pid: int, max_depth: int) -> None:
+        """
+        As for _build_scrubber(), but if the scrub-source values from every
+        table are as they were last time, uses the scrubber elements we made
+        from them then, rather than making them again; see
+        ScrubberElementStore.
+        """
+        # What goes into each table's digest: the scrubber's settings (as
+        # the hash of a scrubber with no values yet), then each value with
+        # its scrub method and whether it's patient information.
+        settings_hash = self.scrubber.get_hash()
+        records = []  # type: List[Tuple[str, str, str, List[Any]]]
+        for (src_db, src_table) in self._db_table_pair_list:
+            plan = list(self._gen_scrub_values(pid, src_db, src_table,
+                                               0, max_depth))
+            digest = config.source_hash_hasher.hash(
+                [settings_hash] +
+                [x for val, scrub_method, is_patient in plan
+                 for x in (val, scrub_method.name, is_patient)]
+            )
+            records.append((src_db, src_table, digest, plan))
+        stored = ScrubberElementStore.get_digests(self.session, pid)
+        if stored == {(src_db, src_table): digest
+                      for src_db, src_table, digest, _ in records}:
+            log.debug("Scrub-source values unchanged; using stored scrubber "
+                      "elements")
+            for elements in ScrubberElementStore.get_elements(
+                    self.session, pid, self._db_table_pair_list):
+                self.scrubber.add_elements(*elements)
+            return
+        to_store = []  # type: List[Tuple[str, str, str, Any]]
+        all_elements = self.scrubber.get_elements()
+        for src_db, src_table, digest, plan in records:
+            starts = [len(x) for x in all_elements]
+            for val, scrub_method, is_patient in plan:
+                self.scrubber.add_value(val, scrub_method, patient=is_patient)
+            to_store.append((src_db, src_table, digest, tuple(
+                x[start:] for x, start in zip(all_elements, starts))))
+        ScrubberElementStore.replace(self.session, pid, to_store)
 
     @property
     def mandatory_scrubbers_unfulfilled(self) -> AbstractSet[str]:
@@ -238,3 +447,12 @@ class Patient(object):
         the admin database?
         """
         return self._unchanged
+
+    def seen_before(self) -> bool:
+        """
+        Had a scrubber for this patient been recorded in the admin database
+        before? If not, no run since the admin tables were made (see
+        drop_remake() in anonymise.py) has got as far as this patient, so
+        there's no destination data of theirs yet.
+        """
+        return self._seen_before
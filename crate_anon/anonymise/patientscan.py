@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# crate_anon/anonymise/patientscan.py
+
+"""
+===============================================================================
+    Copyright (C) 2015-2017 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+===============================================================================
+
+Sorted-merge scanning of patient tables.
+
+The default way of processing patients is to find each patient's ID, then
+query every scrub-source table for that patient (to build the scrubber), then
+query every patient table for that patient (to copy the data). That's a few
+small indexed queries per table per patient.
+
+The alternative here: open one query per table, ordered by patient ID, and
+walk through all of them in step (a merge join, done in Python). For each
+patient, in PID order, we collect that patient's rows from every table; the
+scrubber and the table processing then use those rows, and don't query the
+source database themselves.
+
+- Each table is read once, sequentially. Each stream has a server-side
+  cursor, and a database connection, of its own (whatever the source
+  database's stream_results option says), since the tables are read side by
+  side, and since they may be too big to fetch into memory at once.
+- Only one patient's rows are held in memory at a time.
+- PIDs must be integers, so that the database's sort order and Python's
+  agree.
+- Third-party cross-references (other patients' scrub-source information)
+  can't come from the streams, since they're not in PID order, and are still
+  fetched with a query per patient.
+"""
+
+from collections import OrderedDict
+import logging
+import sys
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+from sqlalchemy.engine.result import RowProxy
+from sqlalchemy.sql import column, select, table
+
+from crate_anon.anonymise.config_singleton import config
+
+log = logging.getLogger(__name__)
+
+StreamKey = Tuple[str, str, str]  # db name, table name, PID field name
+
+
+# =============================================================================
+# A single table, read in PID order
+# =============================================================================
+
+class SortedTableStream(object):
+    """
+    Reads rows from a source table, in PID order, handing them out one patient
+    at a time.
+    """
+    def __init__(self,
+                 dbname: str,
+                 tablename: str,
+                 pidfield: str,
+                 tasknum: int = 0,
+                 ntasks: int = 1) -> None:
+        self.dbname = dbname
+        self.tablename = tablename
+        self.pidfield = pidfield
+        self.tasknum = tasknum
+        self.ntasks = ntasks
+        self.fields = []  # type: List[str]
+        self.defines_pids = False
+        self._rows = None  # type: Generator[RowProxy, None, None]
+        self._next_row = None  # type: Optional[RowProxy]
+
+    def add_fields(self, fields: List[str]) -> None:
+        for f in fields:
+            if f not in self.fields:
+                self.fields.append(f)
+
+    def open(self) -> None:
+        log.debug("Opening sorted stream on {}.{}, ordered by {}".format(
+            self.dbname, self.tablename, self.pidfield))
+        pidcol = column(self.pidfield)
+        query = (
+            select([pidcol] + [column(f) for f in self.fields]).
+            select_from(table(self.tablename)).
+            where(pidcol.isnot(None)).
+            order_by(pidcol)
+        )
+        if self.ntasks > 1:
+            query = query.where(pidcol % self.ntasks == self.tasknum)
+        self._rows = config.sources[self.dbname].gen_query_rows(query,
+                                                                stream=True)
+        self._advance()
+
+    def _advance(self) -> None:
+        self._next_row = next(self._rows, None)
+        if self._next_row is None:
+            self.close()
+
+    @property
+    def next_pid(self) -> Optional[int]:
+        """The PID of the next unread row, or None if there are none left."""
+        return None if self._next_row is None else self._next_row[0]
+
+    def take_rows(self, pid: int) -> List[List[Any]]:
+        """
+        Return all rows for the specified PID, each a list of values matching
+        self.fields. Rows for lower PIDs (patients that we're not processing)
+        are read and discarded.
+        """
+        rows = []  # type: List[List[Any]]
+        while self._next_row is not None and self._next_row[0] <= pid:
+            config.notify_src_bytes_read(sys.getsizeof(self._next_row))
+            if self._next_row[0] == pid:
+                rows.append(list(self._next_row[1:]))
+            self._advance()
+        return rows
+
+    def close(self) -> None:
+        if self._rows is not None:
+            self._rows.close()
+            self._rows = None
+        self._next_row = None
+
+
+# =============================================================================
+# All patient tables, merged
+# =============================================================================
+
+class PatientTableScan(object):
+    """
+    Scans several source tables in parallel, in PID order, and merges them, so
+    that all rows for each patient are available together.
+
+    Register the tables and fields needed with add_table(), then iterate
+    through gen_patient_ids(); for each patient, get_rows() returns that
+    patient's rows.
+    """
+    def __init__(self, tasknum: int = 0, ntasks: int = 1) -> None:
+        self.tasknum = tasknum
+        self.ntasks = ntasks
+        self._streams = OrderedDict()  # type: Dict[StreamKey, SortedTableStream]  # noqa
+        self._current_rows = {}  # type: Dict[StreamKey, List[List[Any]]]
+
+    def add_table(self,
+                  dbname: str,
+                  tablename: str,
+                  pidfield: str,
+                  fields: List[str],
+                  defines_pids: bool = False) -> None:
+        """
+        Register a table (and the fields we'll want from it). If defines_pids
+        is set, any PID in that table is a patient to be processed.
+        """
+        key = (dbname, tablename, pidfield)
+        stream = self._streams.get(key)
+        if stream is None:
+            stream = SortedTableStream(dbname, tablename, pidfield,
+                                       tasknum=self.tasknum,
+                                       ntasks=self.ntasks)
+            self._streams[key] = stream
+        stream.add_fields(fields)
+        stream.defines_pids = stream.defines_pids or defines_pids
+
+    def gen_patient_ids(self) -> Generator[int, None, None]:
+        """
+        Generate patient IDs, in ascending order. While each is current,
+        get_rows() will return that patient's rows.
+        """
+        streams = list(self._streams.values())
+        definers = [s for s in streams if s.defines_pids]
+        try:
+            for stream in streams:
+                stream.open()
+            while True:
+                pids = [s.next_pid for s in definers if s.next_pid is not None]
+                if not pids:
+                    return
+                pid = min(pids)
+                self._current_rows = {
+                    key: stream.take_rows(pid)
+                    for key, stream in self._streams.items()
+                }
+                yield pid
+        finally:
+            self._current_rows = {}
+            for stream in streams:
+                stream.close()
+
+    def get_rows(self,
+                 dbname: str,
+                 tablename: str,
+                 pidfield: str,
+                 fields: List[str]) -> List[List[Any]]:
+        """
+        Returns the current patient's rows from a registered table, each
+        a list of values corresponding to fields.
+        """
+        key = (dbname, tablename, pidfield)
+        stream = self._streams[key]
+        rows = self._current_rows.get(key, [])
+        if fields == stream.fields:
+            return rows
+        indexes = [stream.fields.index(f) for f in fields]
+        return [[row[i] for i in indexes] for row in rows]
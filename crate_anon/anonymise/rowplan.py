@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# crate_anon/anonymise/rowplan.py
+
+"""
+===============================================================================
+    Copyright (C) 2015-2017 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+===============================================================================
+
+Row transformation plans.
+
+Turning a source row into a destination row means, for each field: checking
+the data dictionary's inclusion/exclusion values, dropping omitted fields,
+encrypting patient IDs, and applying the field's alter methods. Most of the
+decisions involved depend only on the data dictionary, so we make them once
+per table, in a RowPlan, rather than once per row:
+
+- filter fields (those with inclusion/exclusion values) are checked first,
+  using sets, so that rows we'll skip aren't altered at all;
+- the fields that reach the destination are listed with their positions in
+  the source row, the kind of ID they are (if any), and their alter methods
+  as ready-made functions (see AlterMethod.get_alter_func()).
+"""
+
+import datetime
+from typing import (Any, Callable, Dict, FrozenSet, List, Optional, Tuple,
+                    TYPE_CHECKING, Union)
+import unittest
+from unittest import mock
+
+from crate_anon.anonymise.config_singleton import config
+from crate_anon.anonymise.ddr import DataDictionaryRow
+
+if TYPE_CHECKING:
+    from crate_anon.anonymise.patient import Patient
+
+AlterFunc = Callable[[Any, List[Any], Optional["Patient"]], Tuple[Any, bool]]
+Lookup = Union[FrozenSet[Any], Tuple[Any, ...]]
+OutputField = Tuple[int, str, int, List[AlterFunc], Optional[AlterFunc], bool]
+
+FIELD_PLAIN = 0
+FIELD_PRIMARY_PID = 1
+FIELD_MASTER_PID = 2
+
+
+def make_lookup(values: List[Any]) -> Lookup:
+    """
+    Returns a frozenset of the values, for quick membership tests, or (if any
+    can't be hashed) a tuple.
+    """
+    try:
+        return frozenset(values)
+    except TypeError:
+        return tuple(values)
+
+
+def contains(lookup: Lookup, value: Any) -> bool:
+    try:
+        return value in lookup
+    except TypeError:  # unhashable value (e.g. bytearray) against a set
+        return any(value == x for x in lookup)
+
+
+def make_output_field(index: int,
+                      ddr: DataDictionaryRow,
+                      ddrows: List[DataDictionaryRow]) -> OutputField:
+    """
+    Returns instructions for making one destination field: a tuple of
+    (index in source row, destination field name, kind of ID, all but the
+    last alteration function, the last alteration function, whether the last
+    alteration is scrubbing). The last is kept separate because scrubbing,
+    if it comes last, may be done later and in bulk; see RowPlan.transform().
+    """
+    if ddr.primary_pid:
+        kind = FIELD_PRIMARY_PID
+    elif ddr.master_pid:
+        kind = FIELD_MASTER_PID
+    else:
+        kind = FIELD_PLAIN
+    alter_methods = ddr.get_alter_methods()
+    funcs = [am.get_alter_func(ddr, ddrows) for am in alter_methods]
+    return (
+        index,
+        ddr.dest_field,
+        kind,
+        funcs[:-1],
+        funcs[-1] if funcs else None,
+        bool(alter_methods) and alter_methods[-1].scrub,
+    )
+
+
+class RowPlan(object):
+    """
+    Compiled instructions for transforming rows of one source table, read
+    with fields in the order of ddrows, into destination rows.
+    """
+    def __init__(self, ddrows: List[DataDictionaryRow]) -> None:
+        self.ddrows = ddrows
+        self.filters = [
+            (i,
+             (make_lookup(ddr.inclusion_values)
+              if ddr.inclusion_values else None),
+             make_lookup(ddr.exclusion_values or []))
+            for i, ddr in enumerate(ddrows)
+            if ddr.inclusion_values or ddr.exclusion_values
+        ]  # type: List[Tuple[int, Optional[Lookup], Lookup]]
+        self.outputs = [
+            make_output_field(i, ddr, ddrows)
+            for i, ddr in enumerate(ddrows)
+            if not ddr.omit
+        ]  # type: List[OutputField]
+        self.can_defer_scrubbing = any(o[5] for o in self.outputs)
+
+    def transform(self,
+                  row: List[Any],
+                  patient: "Patient" = None,
+                  deferred: List[Tuple[str, str]] = None,
+                  min_deferred_length: int = 0) -> Optional[Dict[str, Any]]:
+        """
+        Returns the destination row as a {dest_field: value} dictionary, or
+        None if the row is to be skipped.
+
+        If a list is passed as deferred, then string values at least
+        min_deferred_length long whose last alteration is scrubbing aren't
+        scrubbed; instead, (dest_field, text) is appended to that list, and
+        the field's value is left as None, for the caller to fill in.
+        """
+        for i, inclusion, exclusion in self.filters:
+            value = row[i]
+            if inclusion is not None and not contains(inclusion, value):
+                return None
+            if exclusion and contains(exclusion, value):
+                return None
+        destvalues = {}  # type: Dict[str, Any]
+        for index, dest_field, kind, head, last, scrub_last in self.outputs:
+            value = row[index]
+            if kind == FIELD_PRIMARY_PID:
+                assert value == patient.get_pid()
+                value = patient.get_rid()
+            elif kind == FIELD_MASTER_PID:
+                value = config.encrypt_master_pid(value)
+            if last is not None:
+                for alter in head:
+                    value, skiprow = alter(value, row, patient)
+                    if skiprow:
+                        break  # from alter method loop
+                else:
+                    if (deferred is not None and scrub_last and
+                            isinstance(value, str) and
+                            len(value) >= min_deferred_length):
+                        deferred.append((dest_field, value))
+                        value = None
+                    else:
+                        value, _ = last(value, row, patient)
+            destvalues[dest_field] = value
+        return destvalues or None
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+# These need a config (see CRATE_ANON_CONFIG), for the data dictionary rows
+# and master PID encryption.
+
+def transform_field_by_field(
+        ddrows: List[DataDictionaryRow],
+        row: List[Any],
+        patient: "Patient" = None) -> Optional[Dict[str, Any]]:
+    """
+    What process_table() did for each row before RowPlan: goes through the
+    fields in order, checking each one's inclusion/exclusion values and then
+    altering it. For comparison with RowPlan.transform().
+    """
+    destvalues = {}  # type: Dict[str, Any]
+    for i, ddr in enumerate(ddrows):
+        value = row[i]
+        if ddr.skip_row_by_value(value):
+            return None
+        if ddr.omit:
+            continue
+        if ddr.primary_pid:
+            assert value == patient.get_pid()
+            value = patient.get_rid()
+        elif ddr.master_pid:
+            value = config.encrypt_master_pid(value)
+        for alter_method in ddr.get_alter_methods():
+            value, skiprow = alter_method.alter(
+                value=value, ddr=ddr, row=row, ddrows=ddrows, patient=patient)
+            if skiprow:
+                break
+        destvalues[ddr.dest_field] = value
+    return destvalues or None
+
+
+class FakePatient(object):
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+        self.n_scrubbed = 0
+
+    def get_pid(self) -> int:
+        return self.pid
+
+    def get_rid(self) -> str:
+        return "rid{}".format(self.pid)
+
+    def scrub(self, text: str) -> str:
+        self.n_scrubbed += 1
+        return text.replace("Smith", "[XXX]")
+
+
+class TestRowPlan(unittest.TestCase):
+    def setUp(self) -> None:
+        patcher = mock.patch.object(
+            config, 'extract_text_extension_permissible',
+            side_effect=lambda ext: ext == ".txt")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def make_ddrows(*fields: Tuple[str, str, str, str, str, str]) \
+            -> List[DataDictionaryRow]:
+        """
+        Makes data dictionary rows from (field, src_flags, decision,
+        inclusion_values, exclusion_values, alter_method) tuples.
+        """
+        ddrows = []  # type: List[DataDictionaryRow]
+        for field, flags, decision, inclusion, exclusion, alter in fields:
+            ddr = DataDictionaryRow(config)
+            ddr.set_from_dict(dict(
+                src_db="db", src_table="t", src_field=field,
+                src_datatype="TEXT", src_flags=flags, scrub_src="",
+                scrub_method="", decision=decision,
+                inclusion_values=inclusion, exclusion_values=exclusion,
+                alter_method=alter, dest_table="t", dest_field=field + "_d",
+                dest_datatype="", index="", indexlen="", comment=""))
+            ddrows.append(ddr)
+        return ddrows
+
+    def check_same(self, ddrows: List[DataDictionaryRow],
+                   rows: List[List[Any]],
+                   expected: List[Optional[Dict[str, Any]]]) -> None:
+        plan = RowPlan(ddrows)
+        for row, exp in zip(rows, expected):
+            old = transform_field_by_field(ddrows, row, FakePatient(row[0]))
+            new = plan.transform(row, FakePatient(row[0]))
+            self.assertEqual(old, exp, row)
+            self.assertEqual(new, exp, row)
+            # Scrubbing deferred, then done by the caller:
+            deferred = []  # type: List[Tuple[str, str]]
+            patient = FakePatient(row[0])
+            new = plan.transform(row, patient, deferred, 1)
+            if new is not None:
+                for field, text in deferred:
+                    self.assertIsNone(new[field])
+                    new[field] = patient.scrub(text)
+            self.assertEqual(new, exp, row)
+
+    def test_fields(self) -> None:
+        ddrows = self.make_ddrows(
+            ("pid", "P", "include", "", "", ""),
+            ("mpid", "M", "include", "", "", ""),
+            ("secret", "", "OMIT", "", "", ""),
+            ("note", "", "include", "", "", "html_untag,scrub"),
+            ("when", "", "include", "", "", "truncate_date"),
+        )
+        rows = [
+            [1, 100, "x", "<b>Mr Smith</b>", "2017-05-17"],
+            [2, None, "y", "", None],
+        ]
+        expected = [
+            {"pid_d": "rid1", "mpid_d": config.encrypt_master_pid(100),
+             "note_d": "Mr [XXX]", "when_d": datetime.datetime(2017, 5, 1)},
+            {"pid_d": "rid2", "mpid_d": None, "note_d": "", "when_d": None},
+        ]
+        self.check_same(ddrows, rows, expected)
+
+    def test_filters(self) -> None:
+        ddrows = self.make_ddrows(
+            ("pid", "P", "include", "", "", ""),
+            ("note", "", "include", "", "", "scrub"),
+            ("kind", "", "OMIT", "['a', 'b', None]", "['b']", ""),
+            ("status", "", "include", "", "[0, 9]", ""),
+        )
+        rows = [
+            [1, "Smith", "a", 1],  # kept
+            [2, "Smith", "b", 1],  # included, but then excluded
+            [3, "Smith", "c", 1],  # not included
+            [4, "Smith", None, 1],  # None can be included
+            [5, "Smith", "a", 9],  # excluded by a later field
+            [6, "Smith", bytearray(b"a"), 1],  # unhashable; not included
+        ]
+        expected = [
+            {"pid_d": "rid1", "note_d": "[XXX]", "status_d": 1},
+            None,
+            None,
+            {"pid_d": "rid4", "note_d": "[XXX]", "status_d": 1},
+            None,
+            None,
+        ]
+        self.check_same(ddrows, rows, expected)
+        # The filters come first, so skipped rows aren't scrubbed at all.
+        plan = RowPlan(ddrows)
+        for row, exp in zip(rows, expected):
+            patient = FakePatient(row[0])
+            plan.transform(row, patient)
+            self.assertEqual(patient.n_scrubbed, 0 if exp is None else 1)
+
+    def test_alter_method_skiprow(self) -> None:
+        # An alter method's skiprow (here, from a failed text extraction
+        # with skip_if_extract_fails) ends that field's alterations, leaving
+        # it None; it doesn't skip the row.
+        ddrows = self.make_ddrows(
+            ("pid", "P", "include", "", "", ""),
+            ("ext", "", "include", "", "", ""),
+            ("doc", "", "include", "", "",
+             "binary_to_text=ext,scrub,skip_if_extract_fails"),
+        )
+        rows = [
+            [1, ".txt", b"Mr Smith"],
+            [2, ".bad", b"Mr Smith"],
+        ]
+        expected = [
+            {"pid_d": "rid1", "ext_d": ".txt", "doc_d": "Mr [XXX]"},
+            {"pid_d": "rid2", "ext_d": ".bad", "doc_d": None},
+        ]
+        self.check_same(ddrows, rows, expected)
+
+    def test_nothing_to_write(self) -> None:
+        # A row is skipped if no fields are written...
+        ddrows = self.make_ddrows(
+            ("id", "", "OMIT", "", "", ""),
+            ("note", "", "OMIT", "", "", ""),
+        )
+        self.check_same(ddrows, [[1, "x"], [None, None]], [None, None])
+        # ... but not if they're all None.
+        ddrows = self.make_ddrows(
+            ("id", "", "include", "", "", ""),
+            ("note", "", "include", "", "", "scrub"),
+            ("when", "", "include", "", "", "truncate_date"),
+        )
+        self.check_same(ddrows, [[None, None, None]],
+                        [{"id_d": None, "note_d": None, "when_d": None}])
+
+
+if __name__ == '__main__':
+    unittest.main()
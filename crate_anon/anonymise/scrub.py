@@ -26,8 +26,13 @@ Scrubber classes for CRATE anonymiser.
 
 from collections import OrderedDict
 import datetime
+import hashlib
 import logging
-from typing import Any, Dict, Iterable, Generator, List, Optional, Union
+import sys
+import time
+import unittest
+from typing import (Any, Callable, Dict, Iterable, Generator, List,
+                    Optional, Tuple, Union)
 
 from cardinal_pythonlib.rnc_datetime import (
     coerce_to_date,
@@ -36,8 +41,9 @@ from cardinal_pythonlib.rnc_db import (
     is_sqltype_date,
     is_sqltype_text_over_one_char,
 )
+import regex
 
-from crate_anon.common.hash import GenericHasher
+from crate_anon.common.hash import GenericHasher, make_hasher
 from crate_anon.anonymise.constants import SCRUBMETHOD
 from crate_anon.anonymise.anonregex import (
     get_anon_fragments_from_string,
@@ -50,6 +56,7 @@ from crate_anon.anonymise.anonregex import (
     get_string_regex_elements,
     get_uk_postcode_regex_elements,
 )
+from crate_anon.anonymise.wordmatch import LiteralWordMatcher
 from crate_anon.common.stringfunc import (
     get_digit_string_from_vaguely_numeric_string,
     reduce_to_alphanumeric,
@@ -58,6 +65,79 @@ from crate_anon.common.stringfunc import (
 log = logging.getLogger(__name__)
 
 
+# =============================================================================
+# Cache of scrubbed text
+# =============================================================================
+
+class ScrubCacheStats(object):
+    """Running totals for ScrubResultCache objects (e.g. across patients)."""
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0  # time spent scrubbing the misses
+
+    def __str__(self) -> str:
+        n = self.hits + self.misses
+        mean_miss_s = self.miss_seconds / self.misses if self.misses else 0
+        return (
+            "hits={}, misses={}, hit rate={:.1%}, time scrubbing misses="
+            "{:.3f} s, estimated time saved by hits={:.3f} s".format(
+                self.hits, self.misses, self.hits / n if n else 0,
+                self.miss_seconds, self.hits * mean_miss_s)
+        )
+
+
+class ScrubResultCache(object):
+    """
+    Remembers scrubbed versions of texts, so that a text seen again (e.g. a
+    templated assessment, or a letter stored in several tables) needn't be
+    scrubbed again. Keyed by a digest of the text (see digest()); bounded by
+    (approximate) size in bytes, discarding the least recently used results.
+    Only valid for one scrubber; clear it whenever that changes.
+    """
+
+    def __init__(self, max_bytes: int,
+                 stats: ScrubCacheStats = None) -> None:
+        self.max_bytes = max_bytes
+        self.stats = stats or ScrubCacheStats()
+        self.n_bytes = 0
+        self._results = OrderedDict()  # type: OrderedDict
+
+    @staticmethod
+    def digest(text: str) -> bytes:
+        # 128 bits, so a collision (which would give the wrong text back) is
+        # not a realistic concern.
+        return hashlib.md5(text.encode('utf-8', 'surrogatepass')).digest()
+
+    def get(self, key: bytes) -> Optional[str]:
+        result = self._results.get(key)
+        if result is not None:
+            self._results.move_to_end(key)
+            self.stats.hits += 1
+        return result
+
+    def put(self, key: bytes, result: str, seconds: float = 0) -> None:
+        """
+        Stores a result (scrubbed from scratch, a miss, taking the time
+        specified).
+        """
+        self.stats.misses += 1
+        self.stats.miss_seconds += seconds
+        size = sys.getsizeof(key) + sys.getsizeof(result)
+        if size > self.max_bytes or key in self._results:
+            return
+        self._results[key] = result
+        self.n_bytes += size
+        while self.n_bytes > self.max_bytes:
+            oldkey, oldresult = self._results.popitem(last=False)
+            self.n_bytes -= sys.getsizeof(oldkey) + sys.getsizeof(oldresult)
+
+    def clear(self) -> None:
+        self._results.clear()
+        self.n_bytes = 0
+
+
 # =============================================================================
 # Generic scrubber base class
 # =============================================================================
@@ -100,7 +180,13 @@ class WordList(ScrubberBase):
                  hasher: GenericHasher = None,
                  suffixes: List[str] = None,
                  at_word_boundaries_only: bool = True,
-                 max_errors: int = 0) -> None:
+                 max_errors: int = 0,
+                 literal_matching: bool = False) -> None:
+        """
+        literal_matching: scrub with a LiteralWordMatcher, rather than a
+            regex, if no typographical errors are allowed (max_errors is 0)?
+            Much quicker to set up and to use, for long lists.
+        """
         filenames = filenames or []
         words = words or []
 
@@ -109,9 +195,11 @@ class WordList(ScrubberBase):
         self.suffixes = suffixes
         self.at_word_boundaries_only = at_word_boundaries_only
         self.max_errors = max_errors
+        self.literal_matching = literal_matching and max_errors == 0
         self._regex = None
         self._cached_hash = None
         self._regex_built = False
+        self._matcher = None  # type: LiteralWordMatcher
 
         self.words = set()
         # Sets are faster than lists for "is x in s" operations:
@@ -126,6 +214,8 @@ class WordList(ScrubberBase):
     def clear_cache(self) -> None:
         """Clear cached information."""
         self._regex = None
+        self._regex_built = False
+        self._matcher = None
         self._cached_hash = None
 
     def add_word(self, word: str, clear_cache: bool = True) -> None:
@@ -155,15 +245,37 @@ class WordList(ScrubberBase):
         return self._cached_hash
 
     def scrub(self, text: str) -> str:
+        if self.literal_matching:
+            return self.get_matcher().sub(self.replacement_text, text)
         if not self._regex_built:
             self.build_regex()
         if not self._regex:
             return text
         return self._regex.sub(self.replacement_text, text)
 
+    def get_matcher(self) -> LiteralWordMatcher:
+        if self._matcher is None:
+            self._matcher = LiteralWordMatcher(
+                self.words,
+                suffixes=self.suffixes,
+                at_word_boundaries_only=self.at_word_boundaries_only)
+        return self._matcher
+
+    def get_pattern(self) -> Union[str, LiteralWordMatcher]:
+        """
+        Returns what scrub() uses to find words: a LiteralWordMatcher, or the
+        string version of the regex (which may be "").
+        """
+        if self.literal_matching:
+            return self.get_matcher()
+        return self.get_regex_string()
+
     def build_regex(self) -> None:
         elements = []
-        for w in self.words:
+        # Longest first, so that where words overlap (e.g. "anne" and
+        # "anne-marie"), the longest is used (and the result doesn't depend
+        # on the order of our set). As for LiteralWordMatcher.
+        for w in sorted(self.words, key=lambda x: (-len(x), x)):
             elements.extend(get_string_regex_elements(
                 w,
                 suffixes=self.suffixes,
@@ -173,6 +285,13 @@ class WordList(ScrubberBase):
         self._regex = get_regex_from_elements(elements)
         self._regex_built = True
 
+    def get_regex_string(self) -> str:
+        """Return the string version of the regex (or "" if there isn't one).
+        """
+        if not self._regex_built:
+            self.build_regex()
+        return self._regex.pattern if self._regex else ""
+
 
 # =============================================================================
 # NonspecificScrubber
@@ -247,10 +366,74 @@ class NonspecificScrubber(ScrubberBase):
         self._regex = get_regex_from_elements(elements)
         self._regex_built = True
 
+    def get_regex_string(self) -> str:
+        """
+        Return the string version of our own regex (not the blacklist's), or
+        "" if there isn't one.
+        """
+        if not self._regex_built:
+            self.build_regex()
+        return self._regex.pattern if self._regex else ""
+
+    def get_regex_replacements(
+            self,
+            blacklist_only: bool = False) \
+            -> List[Tuple[Union[str, LiteralWordMatcher], str]]:
+        """
+        Return (regex string, replacement text) pairs, in the order in which
+        scrub() applies them. For scrubbing elsewhere (e.g. another process).
+        The blacklist's "regex string" may be a LiteralWordMatcher instead.
+        If blacklist_only is true, leave out our own regex (e.g. because it's
+        part of a single-pass PersonalizedScrubber's combined regex).
+        """
+        pairs = []  # type: List[Tuple[Union[str, LiteralWordMatcher], str]]
+        if self.blacklist:
+            pairs.append((self.blacklist.get_pattern(),
+                          self.blacklist.replacement_text))
+        if not blacklist_only:
+            pairs.append((self.get_regex_string(), self.replacement_text))
+        return pairs
+
 
 # =============================================================================
 # PersonalizedScrubber
 # =============================================================================
+# Single-pass scrubbing.
+#
+# Normally, PersonalizedScrubber.scrub() makes up to four passes over the
+# text, each working on the result of the one before: the blacklist, the
+# other nonspecific regexes, the patient regex, and the third-party regex.
+# With single_pass, the last three are combined into one regex, with a named
+# group for each, and one pass replaces each match with the replacement text
+# for the group that matched. (The blacklist still has its own pass, first:
+# it's the same for every patient, may be very large, and may not be a regex
+# at all; see WordList.)
+#
+# Where the things found don't overlap, the results are the same. Where they
+# do, the rules are those of a single regex:
+# - Matches are found from left to right, so the one starting first wins.
+#   (With separate passes, the earlier pass wins, and a later pass may still
+#   match whatever's left.)
+# - Of matches starting at the same place, nonspecific beats patient beats
+#   third party; that is the order of the passes, too.
+# - Replacement text is never scrubbed again. (With separate passes, a later
+#   pass sees the replacement text from an earlier one.)
+
+SCRUB_GROUP_NONSPECIFIC = "nonspecific"
+SCRUB_GROUP_PATIENT = "patient"
+SCRUB_GROUP_THIRD_PARTY = "third_party"
+
+
+def make_group_replacer(replacements: Dict[str, str]) -> Callable[[Any], str]:
+    """
+    Returns a function for regex.sub() that replaces a match with the
+    replacement text for the named group that matched.
+    """
+    def replace(match: Any) -> str:
+        return replacements[match.lastgroup]
+
+    return replace
+
 
 class PersonalizedScrubber(ScrubberBase):
     """Accepts patient-specific (patient and third-party) information, and
@@ -270,7 +453,23 @@ class PersonalizedScrubber(ScrubberBase):
                  string_max_regex_errors: int = 0,
                  whitelist: WordList = None,
                  nonspecific_scrubber: NonspecificScrubber = None,
-                 debug: bool = False) -> None:
+                 debug: bool = False,
+                 cache_max_bytes: int = 0,
+                 cache_stats: ScrubCacheStats = None,
+                 single_pass: bool = False,
+                 factor_prefixes: bool = False) -> None:
+        """
+        If cache_max_bytes is set, scrubbed results are cached (up to about
+        that many bytes) for reuse; see ScrubResultCache. Totals are kept in
+        cache_stats, if given.
+
+        If single_pass is set, the nonspecific, patient and third-party
+        regexes are applied together, in one pass; see above.
+
+        If factor_prefixes is set, the patient and third-party regexes have
+        common beginnings factored out; see
+        get_prefix_factored_regex_string().
+        """
         scrub_string_suffixes = scrub_string_suffixes or []
 
         super().__init__(hasher)
@@ -293,10 +492,15 @@ class PersonalizedScrubber(ScrubberBase):
         self.whitelist = whitelist
         self.nonspecific_scrubber = nonspecific_scrubber
         self.debug = debug
+        self.single_pass = single_pass
+        self.factor_prefixes = factor_prefixes
 
         # Regex information
         self.re_patient = None  # re: regular expression
         self.re_tp = None
+        self.re_combined = None  # for single_pass
+        self.replace_combined = make_group_replacer(
+            self.get_combined_replacements())
         self.regexes_built = False
         self.re_patient_elements = []
         self.re_tp_elements = []
@@ -305,10 +509,16 @@ class PersonalizedScrubber(ScrubberBase):
         self.elements_tuplelist = []  # of tuples: (patient?, type, value)
         # ... used for get_raw_info(); since we've made the order important,
         #     we should detect changes in order here as well
+        self.result_cache = (
+            ScrubResultCache(cache_max_bytes, cache_stats)
+            if cache_max_bytes > 0 else None
+        )  # type: Optional[ScrubResultCache]
         self.clear_cache()
 
     def clear_cache(self) -> None:
         self.regexes_built = False
+        if self.result_cache is not None:
+            self.result_cache.clear()
 
     @staticmethod
     def get_scrub_method(datatype_long: str,
@@ -362,6 +572,32 @@ class PersonalizedScrubber(ScrubberBase):
         if clear_cache:
             self.clear_cache()
 
+    def get_elements(self) -> Tuple[List[str], List[str],
+                                    List[Tuple[bool, SCRUBMETHOD, str]]]:
+        """
+        Returns what add_value() has made so far: (patient regex elements,
+        third-party regex elements, raw element tuples). These are the lists
+        themselves, not copies.
+        """
+        return (self.re_patient_elements, self.re_tp_elements,
+                self.elements_tuplelist)
+
+    def add_elements(self,
+                     patient_elements: List[str],
+                     tp_elements: List[str],
+                     element_tuples: List[Tuple[bool, SCRUBMETHOD, str]]) \
+            -> None:
+        """
+        Adds elements previously made by add_value() (see get_elements()),
+        without making them again.
+        """
+        self.re_patient_elements.extend(patient_elements)
+        self.re_tp_elements.extend(tp_elements)
+        for t in element_tuples:
+            if t not in self.elements_tuplelist:
+                self.elements_tuplelist.append(t)
+        self.clear_cache()
+
     def get_elements_date(self,
                           value: Union[datetime.datetime,
                                        datetime.date]) -> Optional[List[str]]:
@@ -454,15 +690,78 @@ class PersonalizedScrubber(ScrubberBase):
 
     def get_patient_regex_string(self) -> str:
         """Return the string version of the patient regex, sorted."""
-        return get_regex_string_from_elements(self.re_patient_elements)
+        return get_regex_string_from_elements(
+            self.re_patient_elements, factor_prefixes=self.factor_prefixes)
 
     def get_tp_regex_string(self) -> str:
         """Return the string version of the third-party regex, sorted."""
-        return get_regex_string_from_elements(self.re_tp_elements)
+        return get_regex_string_from_elements(
+            self.re_tp_elements, factor_prefixes=self.factor_prefixes)
+
+    def get_combined_regex_string(self) -> str:
+        """
+        Return the string version of the single-pass regex: the nonspecific
+        (except blacklist), patient and third-party regexes, in that order,
+        as named groups.
+        """
+        groups = []  # type: List[str]
+        for name, regex_string in (
+                (SCRUB_GROUP_NONSPECIFIC,
+                 self.nonspecific_scrubber.get_regex_string()
+                 if self.nonspecific_scrubber else ""),
+                (SCRUB_GROUP_PATIENT, self.get_patient_regex_string()),
+                (SCRUB_GROUP_THIRD_PARTY, self.get_tp_regex_string())):
+            if regex_string:
+                groups.append("(?P<{}>{})".format(name, regex_string))
+        return "|".join(groups)
+
+    def get_combined_replacements(self) -> Dict[str, str]:
+        """
+        Return the replacement text for each group of the single-pass regex.
+        """
+        return {
+            SCRUB_GROUP_NONSPECIFIC: (
+                self.nonspecific_scrubber.replacement_text
+                if self.nonspecific_scrubber else ""),
+            SCRUB_GROUP_PATIENT: self.replacement_text_patient,
+            SCRUB_GROUP_THIRD_PARTY: self.replacement_text_third_party,
+        }
+
+    def get_personal_regex_replacements(
+            self) -> List[Tuple[str, Union[str, Dict[str, str]]]]:
+        """
+        Return (regex string, replacement text) pairs for the patient and
+        third-party regexes, in the order in which scrub() applies them (after
+        the nonspecific scrubber). For scrubbing elsewhere (e.g. another
+        process).
+
+        If single_pass is set, there's one pair, for the combined regex
+        (which includes the nonspecific regex, but not the blacklist), and
+        its replacement text is a dictionary of replacement texts by group
+        name (see make_group_replacer()).
+        """
+        if self.single_pass:
+            return [(self.get_combined_regex_string(),
+                     self.get_combined_replacements())]
+        return [
+            (self.get_patient_regex_string(), self.replacement_text_patient),
+            (self.get_tp_regex_string(), self.replacement_text_third_party),
+        ]
 
     def build_regexes(self) -> None:
-        self.re_patient = get_regex_from_elements(self.re_patient_elements)
-        self.re_tp = get_regex_from_elements(self.re_tp_elements)
+        if self.single_pass:
+            combined = self.get_combined_regex_string()
+            # Flags as for get_regex_from_elements()
+            self.re_combined = (
+                regex.compile(combined, regex.IGNORECASE | regex.UNICODE)
+                if combined else None
+            )
+        else:
+            self.re_patient = get_regex_from_elements(
+                self.re_patient_elements,
+                factor_prefixes=self.factor_prefixes)
+            self.re_tp = get_regex_from_elements(
+                self.re_tp_elements, factor_prefixes=self.factor_prefixes)
         self.regexes_built = True
         # Note that the regexes themselves may be None even if they have
         # been built.
@@ -476,9 +775,29 @@ class PersonalizedScrubber(ScrubberBase):
         """Scrub some text and return the scrubbed result."""
         if text is None:
             return None
+        if self.result_cache is None or not isinstance(text, str):
+            return self._scrub(text)
+        key = self.result_cache.digest(text)
+        result = self.result_cache.get(key)
+        if result is None:
+            start = time.perf_counter()
+            result = self._scrub(text)
+            self.result_cache.put(key, result, time.perf_counter() - start)
+        return result
+
+    def _scrub(self, text: str) -> str:
         if not self.regexes_built:
             self.build_regexes()
 
+        if self.single_pass:
+            blacklist = (self.nonspecific_scrubber.blacklist
+                         if self.nonspecific_scrubber else None)
+            if blacklist:
+                text = blacklist.scrub(text)
+            if self.re_combined:
+                text = self.re_combined.sub(self.replace_combined, text)
+            return text
+
         if self.nonspecific_scrubber:
             text = self.nonspecific_scrubber.scrub(text)
         if self.re_patient:
@@ -518,4 +837,60 @@ class PersonalizedScrubber(ScrubberBase):
              else None),
             ('elements', self.elements_tuplelist),
         )
+        if self.single_pass:
+            # Only if set, so as not to change everyone else's hashes.
+            d += (('single_pass', True), )
+        if self.factor_prefixes:
+            d += (('factor_prefixes', True), )
         return OrderedDict(d)
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class TestSinglePassScrubbing(unittest.TestCase):
+    @staticmethod
+    def make_scrubber(single_pass: bool) -> PersonalizedScrubber:
+        hasher = make_hasher("HMAC_MD5", "dummykey")
+        blacklist = WordList(words=["cambridge"], replacement_text="[---]",
+                             hasher=hasher, literal_matching=True)
+        nonspecific = NonspecificScrubber(
+            replacement_text="[~~~]", hasher=hasher, blacklist=blacklist,
+            scrub_all_numbers_of_n_digits=[10], scrub_all_uk_postcodes=True)
+        scrubber = PersonalizedScrubber(
+            replacement_text_patient="[PPP]",
+            replacement_text_third_party="[TTT]",
+            hasher=hasher, nonspecific_scrubber=nonspecific,
+            single_pass=single_pass)
+        scrubber.add_value("John Smith", SCRUBMETHOD.WORDS)
+        scrubber.add_value("01223 123456", SCRUBMETHOD.NUMERIC)
+        scrubber.add_value("Mary", SCRUBMETHOD.WORDS, patient=False)
+        scrubber.add_value("Anne Smith", SCRUBMETHOD.PHRASE, patient=False)
+        return scrubber
+
+    def test_same_as_separate_passes(self) -> None:
+        multi = self.make_scrubber(single_pass=False)
+        single = self.make_scrubber(single_pass=True)
+        text = ("John rang from Cambridge (CB2 0QQ) on 01223 123456. His "
+                "mother Mary gave 0123456789 as her number; SMITH agreed.")
+        expected = ("[PPP] rang from [---] ([~~~]) on [PPP]. His mother "
+                    "[TTT] gave [~~~] as her number; [PPP] agreed.")
+        self.assertEqual(multi.scrub(text), expected)
+        self.assertEqual(single.scrub(text), expected)
+
+    def test_precedence(self) -> None:
+        multi = self.make_scrubber(single_pass=False)
+        single = self.make_scrubber(single_pass=True)
+        # Overlapping: separate passes scrub the patient's "Smith" first, and
+        # the third-party phrase is then no longer there to be found; in one
+        # pass, the match that starts first wins.
+        text = "Seen with Anne Smith."
+        self.assertEqual(multi.scrub(text), "Seen with Anne [PPP].")
+        self.assertEqual(single.scrub(text), "Seen with [TTT].")
+        # Starting at the same place: patient beats third party either way.
+        single.add_value("Mary Jones", SCRUBMETHOD.PHRASE)
+        multi.add_value("Mary Jones", SCRUBMETHOD.PHRASE)
+        text = "Seen with Mary Jones."
+        self.assertEqual(multi.scrub(text), "Seen with [PPP].")
+        self.assertEqual(single.scrub(text), "Seen with [PPP].")
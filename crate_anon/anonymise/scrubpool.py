@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# crate_anon/anonymise/scrubpool.py
+
+"""
+===============================================================================
+    Copyright (C) 2015-2017 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+===============================================================================
+
+Process pool for scrubbing long text values in parallel, within a single
+anonymiser process (and so without extra database connections).
+
+- Scrubbing is CPU-bound regex work, so threads won't help (the GIL); we use
+  processes.
+- Regexes are sent as strings, and compiled in the worker. The nonspecific
+  regexes (blacklist, postcodes, etc.) are the same for everyone and may be
+  large, so are sent once, when each worker starts. Patient-specific regexes
+  are sent with each task, along with the patient's scrubber hash; workers
+  cache the compiled versions by that hash, so they are compiled once per
+  patient per worker, not once per task.
+- A blacklist may use a LiteralWordMatcher rather than a regex; that is sent
+  as it is, and used in the same way as a compiled regex.
+- For a single-pass PersonalizedScrubber, the patient-specific regex is its
+  combined regex, which includes the nonspecific regexes other than the
+  blacklist; then only the blacklist is sent to workers as nonspecific.
+- The regexes are applied in the same order as PersonalizedScrubber.scrub()
+  applies them, giving identical results.
+- If the patient's scrubber caches its results, texts already scrubbed (or
+  repeated within a batch) aren't sent at all, and new results are added to
+  that cache.
+
+Don't import the config here; pool workers don't need it.
+"""
+
+from collections import OrderedDict
+import logging
+import multiprocessing
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import regex
+
+from crate_anon.anonymise.scrub import (
+    make_group_replacer,
+    NonspecificScrubber,
+    PersonalizedScrubber,
+)
+from crate_anon.anonymise.wordmatch import LiteralWordMatcher
+
+log = logging.getLogger(__name__)
+
+RegexReplacementList = List[Tuple[Union[str, LiteralWordMatcher],
+                                  Union[str, Dict[str, str]]]]
+CompiledRegexReplacementList = List[Tuple[Any, Union[str, Callable]]]
+
+WORKER_PATIENT_CACHE_SIZE = 8  # compiled patient scrubbers per worker
+
+
+# =============================================================================
+# Worker side
+# =============================================================================
+
+_worker_nonspecific = []  # type: CompiledRegexReplacementList
+_worker_patient_cache = OrderedDict()  # type: OrderedDict
+
+
+def _compile(pairs: RegexReplacementList) -> CompiledRegexReplacementList:
+    # Must match get_regex_from_elements()
+    return [(regex.compile(s, regex.IGNORECASE | regex.UNICODE)
+             if isinstance(s, str) else s,
+             replacement if isinstance(replacement, str)
+             else make_group_replacer(replacement))
+            for s, replacement in pairs if s]
+
+
+def _init_worker(nonspecific_pairs: RegexReplacementList) -> None:
+    global _worker_nonspecific
+    _worker_nonspecific = _compile(nonspecific_pairs)
+    _worker_patient_cache.clear()
+
+
+def _get_patient_regexes(
+        key: str,
+        pairs: RegexReplacementList) -> CompiledRegexReplacementList:
+    compiled = _worker_patient_cache.get(key)
+    if compiled is None:
+        compiled = _compile(pairs)
+        _worker_patient_cache[key] = compiled
+        if len(_worker_patient_cache) > WORKER_PATIENT_CACHE_SIZE:
+            _worker_patient_cache.popitem(last=False)  # oldest
+    else:
+        _worker_patient_cache.move_to_end(key)
+    return compiled
+
+
+def _scrub_task(task: Tuple[str, RegexReplacementList, List[str]]) \
+        -> List[str]:
+    key, patient_pairs, texts = task
+    regexes = _worker_nonspecific + _get_patient_regexes(key, patient_pairs)
+    results = []  # type: List[str]
+    for text in texts:
+        for compiled_regex, replacement in regexes:
+            text = compiled_regex.sub(replacement, text)
+        results.append(text)
+    return results
+
+
+# =============================================================================
+# Client side
+# =============================================================================
+
+class ScrubberPool(object):
+    """
+    A pool of processes that scrub text on behalf of patients'
+    PersonalizedScrubber objects.
+    """
+    def __init__(self,
+                 nprocesses: int,
+                 nonspecific_scrubber: Optional[NonspecificScrubber],
+                 single_pass: bool = False) -> None:
+        """
+        single_pass: will the PersonalizedScrubber objects be single-pass?
+        """
+        self.nprocesses = nprocesses
+        nonspecific_pairs = (
+            nonspecific_scrubber.get_regex_replacements(
+                blacklist_only=single_pass)
+            if nonspecific_scrubber else []
+        )
+        log.info("Starting scrubber pool with {} processes".format(
+            nprocesses))
+        self._pool = multiprocessing.Pool(processes=nprocesses,
+                                          initializer=_init_worker,
+                                          initargs=(nonspecific_pairs, ))
+        self._last_key = None  # type: str
+        self._last_pairs = []  # type: RegexReplacementList
+
+    def scrub(self, key: str, scrubber: PersonalizedScrubber,
+              texts: List[str]) -> List[str]:
+        """
+        Scrub a list of texts (none of which may be None) with a patient's
+        scrubber, in parallel, returning the results in the same order.
+        The key must change whenever the scrubber does; use its hash.
+        """
+        if not texts:
+            return []
+        cache = scrubber.result_cache
+        if cache is None:
+            return self._scrub(key, scrubber, texts)
+        # Only scrub each distinct text we don't already have.
+        digests = [cache.digest(text) for text in texts]
+        known = {}  # type: Dict[bytes, str]
+        todo = OrderedDict()  # type: OrderedDict
+        for digest, text in zip(digests, texts):
+            if digest in known or digest in todo:
+                cache.stats.hits += 1  # repeated within this batch
+                continue
+            result = cache.get(digest)
+            if result is None:
+                todo[digest] = text
+            else:
+                known[digest] = result
+        if todo:
+            start = time.perf_counter()
+            scrubbed = self._scrub(key, scrubber, list(todo.values()))
+            seconds_each = (time.perf_counter() - start) / len(todo)
+            for digest, result in zip(todo.keys(), scrubbed):
+                known[digest] = result
+                cache.put(digest, result, seconds_each)
+        return [known[digest] for digest in digests]
+
+    def _scrub(self, key: str, scrubber: PersonalizedScrubber,
+               texts: List[str]) -> List[str]:
+        if key != self._last_key:
+            self._last_pairs = scrubber.get_personal_regex_replacements()
+            self._last_key = key
+        # Deal texts out, largest first, to the least-loaded task, so tasks
+        # take similar times.
+        n_tasks = min(len(texts), self.nprocesses)
+        task_indexes = [[] for _ in range(n_tasks)]  # type: List[List[int]]
+        task_sizes = [0] * n_tasks
+        for i in sorted(range(len(texts)), key=lambda x: -len(texts[x])):
+            t = task_sizes.index(min(task_sizes))
+            task_indexes[t].append(i)
+            task_sizes[t] += len(texts[i])
+        tasks = [(key, self._last_pairs, [texts[i] for i in indexes])
+                 for indexes in task_indexes]
+        results = [None] * len(texts)  # type: List[str]
+        for indexes, scrubbed in zip(task_indexes,
+                                     self._pool.map(_scrub_task, tasks)):
+            for i, text in zip(indexes, scrubbed):
+                results[i] = text
+        return results
+
+    def close(self) -> None:
+        self._pool.close()
+        self._pool.join()
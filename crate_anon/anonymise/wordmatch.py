@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# crate_anon/anonymise/wordmatch.py
+
+"""
+===============================================================================
+    Copyright (C) 2015-2017 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+===============================================================================
+
+Matching a large list of literal words (e.g. a blacklist of names) in text,
+without a regex.
+
+A regex made by joining every word with | takes a long time to compile when
+there are many words (minutes, for 150,000 names), and gets slower to match
+as the list grows. Instead, we keep the (case-folded) words in a set, and for
+each place in the text where a word might start, we look up the pieces of
+text that might be a word:
+
+- if matching at word boundaries only, the pieces between that word boundary
+  and each later word boundary (up to the length of the longest word);
+- otherwise, the pieces of each length that a word (plus suffix) could have.
+
+That's a fixed number of set lookups per position, however many words there
+are. The results are the same as those of the regex that WordList makes (from
+get_string_regex_elements(), with no typographical errors allowed, and the
+longest words first, so that where two words could match at the same place,
+e.g. "anne" and "anne-marie", the longest is used), except that words are
+matched literally, and case-insensitively via str.casefold().
+"""
+
+from typing import Iterable, List
+import unittest
+
+import regex
+
+from crate_anon.anonymise.anonregex import WB
+
+WORD_BOUNDARY_REGEX = regex.compile(WB, regex.UNICODE)
+
+
+class LiteralWordMatcher(object):
+    """
+    Finds and replaces words from a list, like a compiled regex (see sub()).
+    """
+    def __init__(self,
+                 words: Iterable[str],
+                 suffixes: List[str] = None,
+                 at_word_boundaries_only: bool = True) -> None:
+        """
+        words: the words to find
+        suffixes: suffixes the words may have, e.g. ["s"]
+        at_word_boundaries_only: match whole words only? (If not, "ann" will
+            be found in "banned".)
+        """
+        self.words = frozenset(w.casefold() for w in words if w)
+        self.suffixes = [s.casefold() for s in suffixes or [] if s]
+        self.at_word_boundaries_only = at_word_boundaries_only
+        word_lengths = set(len(w) for w in self.words)
+        span_lengths = word_lengths.union(
+            n + len(s) for n in word_lengths for s in self.suffixes)
+        self.span_lengths = sorted(span_lengths, reverse=True)
+        self.max_span = self.span_lengths[0] if self.span_lengths else 0
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def _is_match(self, piece: str) -> bool:
+        if piece in self.words:
+            return True
+        for suffix in self.suffixes:
+            if (piece.endswith(suffix) and
+                    piece[:-len(suffix)] in self.words):
+                return True
+        return False
+
+    def sub(self, replacement: str, text: str) -> str:
+        """
+        Returns the text with every match replaced by the replacement text
+        (taken literally), working from left to right, as for regex.sub().
+        """
+        if not self.words or not text:
+            return text
+        folded = text.casefold()
+        if len(folded) == len(text):
+            def get_piece(start_: int, end_: int) -> str:
+                return folded[start_:end_]
+            span_lengths = self.span_lengths
+        else:
+            # Rare: some character folds to more than one (e.g. German
+            # sharp s to "ss"), so positions in the folded text don't match
+            # those in the text. Fold piece by piece, and try every length.
+            def get_piece(start_: int, end_: int) -> str:
+                return text[start_:end_].casefold()
+            span_lengths = range(self.max_span, 0, -1)
+        is_match = self._is_match
+        max_span = self.max_span
+        n = len(text)
+        pieces = []  # type: List[str]
+        done = 0  # end of the last match
+        if self.at_word_boundaries_only:
+            bounds = [m.start() for m in WORD_BOUNDARY_REGEX.finditer(text)]
+            n_bounds = len(bounds)
+            for a, start in enumerate(bounds):
+                if start < done:
+                    continue
+                b = a + 1
+                while b < n_bounds and bounds[b] - start <= max_span:
+                    b += 1
+                for c in range(b - 1, a, -1):  # longest first
+                    end = bounds[c]
+                    if is_match(get_piece(start, end)):
+                        pieces.append(text[done:start])
+                        pieces.append(replacement)
+                        done = end
+                        break
+        else:
+            start = 0
+            while start < n:
+                for length in span_lengths:
+                    end = start + length
+                    if end <= n and is_match(get_piece(start, end)):
+                        pieces.append(text[done:start])
+                        pieces.append(replacement)
+                        done = start = end
+                        break
+                else:
+                    start += 1
+        if not pieces:
+            return text
+        pieces.append(text[done:])
+        return "".join(pieces)
+
+
+# =============================================================================
+# Unit tests
+# =============================================================================
+
+class TestLiteralWordMatcher(unittest.TestCase):
+    WORDS = ["anne", "anne-marie", "marie", "new york", "york", "smith",
+             "o'brien", "jo", "jones"]
+    TEXTS = [
+        "Anne-Marie Smith met ANNE and Marie in New York (york, yorkshire).",
+        "Smiths and Smithson; annemarie; o'brien's O'Brien jo-jo jones joanne",
+        "newyork new  york New York's jo.jones@x",
+        "",
+    ]
+
+    def test_same_as_regex(self) -> None:
+        # Imported here; scrub.py imports this module.
+        from crate_anon.anonymise.scrub import WordList
+        for at_word_boundaries_only in [True, False]:
+            for suffixes in [[], ["s"]]:
+                kwargs = dict(words=self.WORDS, suffixes=suffixes,
+                              at_word_boundaries_only=at_word_boundaries_only)
+                regex_list = WordList(literal_matching=False, **kwargs)
+                literal_list = WordList(literal_matching=True, **kwargs)
+                self.assertIsInstance(literal_list.get_pattern(),
+                                      LiteralWordMatcher)
+                for text in self.TEXTS:
+                    self.assertEqual(literal_list.scrub(text),
+                                     regex_list.scrub(text),
+                                     msg="{!r}, {!r}".format(text, kwargs))
+
+    def test_examples(self) -> None:
+        m = LiteralWordMatcher(self.WORDS, suffixes=["s"])
+        self.assertEqual(
+            m.sub("[---]", "Anne-Marie Jones of New York, not Yorkshire; "
+                           "Joanne's jo"),
+            "[---] [---] of [---], not Yorkshire; Joanne's [---]")
+        m = LiteralWordMatcher(["ann"], at_word_boundaries_only=False)
+        self.assertEqual(m.sub("X", "Banned, ANN"), "BXed, X")
+        self.assertEqual(LiteralWordMatcher([]).sub("X", "anne"), "anne")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,6 +31,7 @@ from typing import Dict, Iterable, Generator, Generic, List, Optional
 # https://www.python.org/dev/peps/pep-0484/
 # https://docs.python.org/3/library/typing.html
 
+from crate_anon.anonymise.constants import DEFAULT_STREAM_FETCH_SIZE
 from crate_anon.anonymise.dbholder import DatabaseHolder
 
 
@@ -179,10 +180,19 @@ class ExtendedConfigParser(configparser.ConfigParser):
                      reflect: bool = False) -> DatabaseHolder:
         dbname = dbname or section
         url = self.get_str(section, 'url', required=True)
+        stream_results = self.getboolean(section, 'stream_results',
+                                         fallback=False)
+        fetch_size = self.get_int_default_if_failure(
+            section, 'stream_fetch_size', DEFAULT_STREAM_FETCH_SIZE)
+        if fetch_size < 1:
+            raise ValueError("stream_fetch_size must be >= 1 (in config "
+                             "section [{}])".format(section))
         return DatabaseHolder(dbname, url, srccfg=srccfg,
                               with_session=with_session,
                               with_conn=with_conn,
-                              reflect=reflect)
+                              reflect=reflect,
+                              stream_results=stream_results,
+                              fetch_size=fetch_size)
 
     def get_env_dict(self,
                      section: str,
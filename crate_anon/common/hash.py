@@ -25,6 +25,7 @@ In general, consider these hash functions:
 - hash64(), using MurmurHash3 to provide a 64-bit integer: for fast INSECURE
   COMPARISON operations.
 - a Hmac* class for SECURE cryptographic hashes.
+- make_row_hasher(), for hashing whole rows (for change detection).
 
 Regarding None/NULL values:
 - For difference detection, it may be helpful to be able to compare a standard
@@ -41,15 +42,26 @@ Regarding None/NULL values:
         ... to Config.encrypt_primary_pid()
 """
 
+from collections import OrderedDict
+import datetime
+from decimal import Decimal
 import hashlib
 import hmac
+import logging
+import struct
 import sys
-from typing import Any, Callable, Tuple, Union
+import time
+import unittest
+from unittest import mock
+from typing import (Any, Callable, Dict, Iterable, List, Sequence, Tuple,
+                    Union)
 
 from sqlalchemy.sql.sqltypes import String, TypeEngine
 
 from crate_anon.common.timing import MultiTimerContext, timer
 
+log = logging.getLogger(__name__)
+
 try:
     import mmh3
 except ImportError:
@@ -67,6 +79,10 @@ except ImportError:
 IS_64_BIT = sys.maxsize > 2 ** 32
 TIMING_HASH = "hash"
 
+_pack_length = struct.Struct("<Q").pack
+_pack_float = struct.Struct("<d").pack
+MASK_128 = 2 ** 128 - 1
+
 
 # =============================================================================
 # Base classes
@@ -77,6 +93,10 @@ class GenericHasher(object):
         """The public interface to a hasher."""
         raise NotImplementedError()
 
+    def hash_many(self, raws: Iterable[Any]) -> List[str]:
+        """Hashes several things at once; returns a list of hashes."""
+        return [self.hash(raw) for raw in raws]
+
     def output_length(self) -> int:
         return len(self.hash("dummytext"))
 
@@ -136,6 +156,17 @@ class GenericHmacHasher(GenericHasher):
                                 digestmod=self.digestmod)
             return hmac_obj.hexdigest()
 
+    def hash_many(self, raws: Iterable[Any]) -> List[str]:
+        # Set up the keyed HMAC once, and copy it for each message.
+        with MultiTimerContext(timer, TIMING_HASH):
+            keyed = hmac.new(key=self.key_bytes, digestmod=self.digestmod)
+            hashes = []  # type: List[str]
+            for raw in raws:
+                hmac_obj = keyed.copy()
+                hmac_obj.update(str(raw).encode('utf-8'))
+                hashes.append(hmac_obj.hexdigest())
+            return hashes
+
 
 class HmacMD5Hasher(GenericHmacHasher):
     def __init__(self, key: str) -> None:
@@ -152,6 +183,73 @@ class HmacSHA512Hasher(GenericHmacHasher):
         super().__init__(hashlib.sha512, key)
 
 
+# =============================================================================
+# Caching hasher
+# =============================================================================
+
+class CachingHasher(GenericHasher):
+    """
+    Wraps another hasher with a least-recently-used cache of up to maxsize
+    entries, for things (like patient IDs) that get hashed again and again.
+    Since hashers hash the string form of what they're given, so does the
+    cache.
+    """
+    def __init__(self, hasher: GenericHasher, maxsize: int) -> None:
+        assert maxsize > 0
+        self.hasher = hasher
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()  # type: Dict[str, str]
+
+    def _store(self, key: str, hashed: str) -> None:
+        self._cache[key] = hashed
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)  # least recently used
+
+    def hash(self, raw: Any) -> str:
+        key = str(raw)
+        try:
+            hashed = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            hashed = self.hasher.hash(key)
+            self._store(key, hashed)
+            return hashed
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return hashed
+
+    def hash_many(self, raws: Iterable[Any]) -> List[str]:
+        keys = [str(raw) for raw in raws]
+        found = {}  # type: Dict[str, str]
+        missing = []  # type: List[str]
+        for key in keys:
+            if key in found:
+                self.hits += 1
+            elif key in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                found[key] = self._cache[key]
+            else:
+                self.misses += 1
+                found[key] = None
+                missing.append(key)
+        for key, hashed in zip(missing, self.hasher.hash_many(missing)):
+            found[key] = hashed
+            self._store(key, hashed)
+        return [found[key] for key in keys]
+
+    def output_length(self) -> int:
+        return self.hasher.output_length()
+
+    def cache_info(self) -> str:
+        n = self.hits + self.misses
+        return "{} hits, {} misses ({:.1f}% hit rate); {}/{} cached".format(
+            self.hits, self.misses, 100 * self.hits / n if n else 0,
+            len(self._cache), self.maxsize)
+
+
 # =============================================================================
 # Hash factory
 # =============================================================================
@@ -173,6 +271,166 @@ def make_hasher(hash_method: str, key: str) -> GenericHasher:
             hash_method))
 
 
+# =============================================================================
+# Change-detection hashers for whole rows
+# =============================================================================
+
+def _none_to_bytes(value: None) -> bytes:
+    return b"N"
+
+
+def _str_to_bytes(value: str) -> bytes:
+    data = value.encode("utf-8", "surrogatepass")
+    return b"S" + _pack_length(len(data)) + data
+
+
+def _bool_to_bytes(value: bool) -> bytes:
+    return b"T" if value else b"F"
+
+
+def _int_to_bytes(value: int) -> bytes:
+    data = b"%d" % value
+    return b"I" + _pack_length(len(data)) + data
+
+
+def _float_to_bytes(value: float) -> bytes:
+    return b"D" + _pack_float(value)
+
+
+def _binary_to_bytes(value: Union[bytes, bytearray, memoryview]) -> bytes:
+    data = bytes(value)
+    return b"B" + _pack_length(len(data)) + data
+
+
+def _other_to_bytes(value: Any) -> bytes:
+    # Anything else (dates, Decimals...) by its repr(), which names its type.
+    data = repr(value).encode("utf-8", "surrogatepass")
+    return b"R" + _pack_length(len(data)) + data
+
+
+_VALUE_TO_BYTES = {
+    type(None): _none_to_bytes,
+    str: _str_to_bytes,
+    bool: _bool_to_bytes,
+    int: _int_to_bytes,
+    float: _float_to_bytes,
+    bytes: _binary_to_bytes,
+    bytearray: _binary_to_bytes,
+    memoryview: _binary_to_bytes,
+}  # type: Dict[type, Callable[[Any], bytes]]
+
+
+def value_to_bytes(value: Any) -> bytes:
+    """
+    Returns an unambiguous binary form of a value from a database row: a
+    one-byte type tag, then (for variable-length types) an 8-byte length,
+    then the value itself. Concatenating these for the values of two
+    different rows can't give the same bytes.
+    """
+    return _VALUE_TO_BYTES.get(type(value), _other_to_bytes)(value)
+
+
+def row_to_bytes(row: Sequence[Any]) -> bytes:
+    """
+    Returns the binary forms (see value_to_bytes()) of a row's values, one
+    after another.
+    """
+    get = _VALUE_TO_BYTES.get
+    return b"".join([get(type(value), _other_to_bytes)(value)
+                     for value in row])
+
+
+class ReprRowHasher(GenericHasher):
+    """
+    Hashes the repr() of a row with another hasher. This is the original way
+    of hashing rows for change detection; it builds a string of the whole
+    row first.
+    """
+    def __init__(self, hasher: GenericHasher) -> None:
+        self.hasher = hasher
+
+    def hash(self, raw: Sequence[Any]) -> str:
+        return self.hasher.hash(repr(raw))
+
+    def output_length(self) -> int:
+        return self.hasher.output_length()
+
+
+class HmacRowHasher(GenericHasher):
+    """
+    HMAC of the binary form of a row (see row_to_bytes()).
+    """
+    def __init__(self, digestmod: Any, key: str) -> None:
+        self._keyed = hmac.new(key=str(key).encode('utf-8'),
+                               digestmod=digestmod)
+
+    def hash(self, raw: Sequence[Any]) -> str:
+        with MultiTimerContext(timer, TIMING_HASH):
+            hmac_obj = self._keyed.copy()
+            hmac_obj.update(row_to_bytes(raw))
+            return hmac_obj.hexdigest()
+
+    def output_length(self) -> int:
+        return 2 * self._keyed.digest_size
+
+
+class Murmur3RowHasher(GenericHasher):
+    """
+    Keyed 128-bit MurmurHash3 (x64 variant) of a row: much faster than an
+    HMAC, but NOT CRYPTOGRAPHIC. Someone who can see the hashes might be able
+    to work out what was hashed (e.g. for a table with a single field), so
+    use an HMAC if that matters.
+
+    We use the mmh3 module if it's installed, and a slow pure-Python version
+    otherwise; both give the same hashes.
+    """
+    def __init__(self, key: str) -> None:
+        # MurmurHash3 only takes a 32-bit seed, so the rest of the key goes
+        # in front of the data.
+        key_digest = hashlib.sha256(str(key).encode('utf-8')).digest()
+        self.seed = int.from_bytes(key_digest[:4], byteorder='little')
+        self.prefix = key_digest[4:]
+        if not mmh3:
+            log.warning("mmh3 module not installed; MurmurHash3 row hashing "
+                        "will be slow")
+
+    def hash(self, raw: Sequence[Any]) -> str:
+        with MultiTimerContext(timer, TIMING_HASH):
+            data = self.prefix + row_to_bytes(raw)
+            if mmh3:
+                h = mmh3.hash128(data, seed=self.seed, x64arch=True)
+            else:
+                h = pymmh3_hash128_x64(data, self.seed)
+            return "{:032x}".format(h & MASK_128)
+
+    def output_length(self) -> int:
+        return 32
+
+
+def make_row_hasher(row_hash_method: str,
+                    hash_method: str,
+                    key: str) -> GenericHasher:
+    """
+    Returns a hasher for whole rows (sequences of values), for change
+    detection. If row_hash_method is blank, this is the original method:
+    hash_method applied to the repr() of the row.
+    """
+    row_hash_method = (row_hash_method or "").upper()
+    if not row_hash_method:
+        return ReprRowHasher(make_hasher(hash_method, key))
+    elif row_hash_method == "HMAC_MD5":
+        return HmacRowHasher(hashlib.md5, key)
+    elif row_hash_method == "HMAC_SHA256":
+        return HmacRowHasher(hashlib.sha256, key)
+    elif row_hash_method == "HMAC_SHA512":
+        return HmacRowHasher(hashlib.sha512, key)
+    elif row_hash_method == "MURMUR3_128":
+        return Murmur3RowHasher(key)
+    else:
+        raise ValueError("Unknown value for row hash method: {}".format(
+            row_hash_method))
+
+
 # =============================================================================
 # Support functions
 # =============================================================================
@@ -764,7 +1022,155 @@ def hash64(data: Any, seed: int = 0) -> int:
 # Testing
 # =============================================================================
 
+def benchmark_row_hashers(n_rows: int = 2000) -> None:
+    """
+    Times the change-detection row hashers on some made-up rows, with short
+    and long text, and prints the results.
+    """
+    for text_repeats in (20, 2000):
+        rows = [
+            [
+                i,
+                "Some free text for row {}. ".format(i) * text_repeats,
+                datetime.datetime(2017, 1, 1, 12, 0, i % 60),
+                Decimal("3.14"),
+                None,
+                2.5 * i,
+                b"\x00\x01" * 50,
+            ]
+            for i in range(n_rows)
+        ]
+        print("Rows with {} characters of text:".format(len(rows[0][1])))
+        for row_hash_method in ("", "HMAC_MD5", "HMAC_SHA256",
+                                "MURMUR3_128"):
+            hasher = make_row_hasher(row_hash_method, "HMAC_MD5", "somekey")
+            start = time.perf_counter()
+            for row in rows:
+                hasher.hash(row)
+            elapsed = time.perf_counter() - start
+            print("    {:<28} {:8.2f} microseconds per row".format(
+                row_hash_method or "(repr() of row, HMAC_MD5)",
+                1e6 * elapsed / n_rows))
+
+
+class CountingHasher(GenericHasher):
+    """Wraps a hasher, counting the values it hashes."""
+    def __init__(self, hasher: GenericHasher) -> None:
+        self.hasher = hasher
+        self.n_hashed = 0
+
+    def hash(self, raw: Any) -> str:
+        self.n_hashed += 1
+        return self.hasher.hash(raw)
+
+    def hash_many(self, raws: Iterable[Any]) -> List[str]:
+        raws = list(raws)
+        self.n_hashed += len(raws)
+        return self.hasher.hash_many(raws)
+
+
+class TestCachingHasher(unittest.TestCase):
+    def setUp(self) -> None:
+        self.plain = HmacMD5Hasher("somekey")
+        self.inner = CountingHasher(self.plain)
+        self.hasher = CachingHasher(self.inner, maxsize=2)
+
+    def test_same_hashes(self) -> None:
+        values = [1, "1", 2, None, "None", "abc", 1, 2]
+        for value in values:
+            self.assertEqual(self.hasher.hash(value), self.plain.hash(value))
+        hasher = CachingHasher(HmacMD5Hasher("somekey"), maxsize=100)
+        self.assertEqual(hasher.hash_many(values),
+                         [self.plain.hash(v) for v in values])
+        self.assertEqual(hasher.hash_many(values),  # all cached now
+                         [self.plain.hash(v) for v in values])
+        self.assertEqual(hasher.output_length(), self.plain.output_length())
+
+    def test_lru_eviction(self) -> None:
+        h = self.hasher
+        h.hash("a")
+        h.hash("b")
+        h.hash("a")  # hit; "b" is now the least recently used
+        h.hash("c")  # evicts "b"
+        self.assertEqual((h.hits, h.misses, self.inner.n_hashed), (1, 3, 3))
+        h.hash("a")
+        h.hash("c")
+        self.assertEqual((h.hits, h.misses, self.inner.n_hashed), (3, 3, 3))
+        h.hash("b")  # evicts "a"
+        h.hash("a")  # evicts "c"
+        self.assertEqual((h.hits, h.misses, self.inner.n_hashed), (3, 5, 5))
+        self.assertEqual(list(h._cache.keys()), ["b", "a"])
+
+    def test_hash_many(self) -> None:
+        h = self.hasher
+        h.hash("a")
+        # A repeated value is hashed once; "a" is a hit, and "b" and "c"
+        # (the most recent) are left in the cache.
+        self.assertEqual(h.hash_many(["b", "a", "b", "c"]),
+                         [self.plain.hash(v) for v in ["b", "a", "b", "c"]])
+        self.assertEqual((h.hits, h.misses, self.inner.n_hashed), (2, 3, 3))
+        self.assertEqual(sorted(h._cache.keys()), ["b", "c"])
+
+
+class TestRowHashers(unittest.TestCase):
+    ROW = [1, "Mr Smith", None, datetime.datetime(2017, 1, 2, 3, 4, 5),
+           Decimal("3.14"), 2.5, True, b"\x00\x01"]
+
+    def test_stable_hashes(self) -> None:
+        # Hashes are stored in the destination; they mustn't change between
+        # runs, versions, or machines (with or without mmh3).
+        for row_hash_method, row_hash, empty_row_hash in (
+                ("", "186b31a048c6fd5a67febd53f3f99c71",
+                 "d5ef1700ff026aaed261c5e2653063df"),
+                ("HMAC_MD5", "c2399043a1541a1c8707de71b5bb169c",
+                 "54a4e3f828095c0a3411d428ec845a3f"),
+                ("HMAC_SHA256",
+                 "1b436ac9040eae2be588480dfd11a20260ec29ce726537465cb3a82996"
+                 "bb8b56",
+                 "edc361c04aac22013a952de2367cfb7419649881a7cb5f8c9eb5abfb6d"
+                 "8f5d0f"),
+                ("MURMUR3_128", "cf51104a6a4a04ef6a8147d3f4df8e77",
+                 "0ea45fc1fa648f65dc3608dc0e52feb8")):
+            hasher = make_row_hasher(row_hash_method, "HMAC_MD5", "somekey")
+            self.assertEqual(hasher.hash(self.ROW), row_hash)
+            self.assertEqual(hasher.hash([]), empty_row_hash)
+            self.assertEqual(len(row_hash), hasher.output_length())
+
+    def test_rows_told_apart(self) -> None:
+        rows = [[1], ["1"], [True], [1.0], [b"1"], [None], ["None"],
+                ["ab", "c"], ["a", "bc"], ["abc"], [], [None, None]]
+        for row_hash_method in ("HMAC_MD5", "MURMUR3_128"):
+            hasher = make_row_hasher(row_hash_method, "HMAC_MD5", "somekey")
+            self.assertEqual(len(set(hasher.hash(row) for row in rows)),
+                             len(rows))
+            other_key = make_row_hasher(row_hash_method, "HMAC_MD5", "other")
+            self.assertNotEqual(hasher.hash(self.ROW),
+                                other_key.hash(self.ROW))
+
+    def test_pure_python_murmur3(self) -> None:
+        # The example from the mmh3 documentation.
+        self.assertEqual(pymmh3_hash128_x64(b"foo", 42),
+                         215966891540331383248189432718888555506)
+
+    @unittest.skipUnless(mmh3, "mmh3 module not installed")
+    def test_mmh3_matches_pure_python(self) -> None:
+        # All lengths of tail, and more than one block.
+        for length in range(40):
+            data = bytes(range(length))
+            for seed in (0, 42, 2 ** 32 - 1):
+                self.assertEqual(
+                    mmh3.hash128(data, seed=seed, x64arch=True) & MASK_128,
+                    pymmh3_hash128_x64(data, seed) & MASK_128)
+        hasher = Murmur3RowHasher("somekey")
+        row_hash = hasher.hash(self.ROW)
+        with mock.patch(__name__ + '.mmh3', None):
+            self.assertEqual(hasher.hash(self.ROW), row_hash)
+
+
 def main():
+    if "--benchmark" in sys.argv[1:]:
+        benchmark_row_hashers()
+        return
     if False:
         print(twos_comp_to_signed(0, n_bits=32))  # 0
         print(twos_comp_to_signed(2 ** 31 - 1, n_bits=32))  # 2147483647
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# crate_anon/common/memory.py
+
+"""
+===============================================================================
+    Copyright (C) 2015-2017 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+===============================================================================
+
+Reporting of memory use.
+"""
+
+import logging
+import sys
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # e.g. Windows
+    resource = None
+
+log = logging.getLogger(__name__)
+
+HIGH_WATER_MARK_REPORT_FACTOR = 1.1  # report rises of 10% or more
+
+_last_reported_peak_bytes = 0
+
+
+def get_peak_memory_bytes() -> Optional[int]:
+    """
+    Returns the peak resident set size (memory use) of this process so far, in
+    bytes, or None if we can't tell on this platform.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss  # bytes
+    return maxrss * 1024  # kilobytes under Linux
+
+
+def report_memory_high_water_mark(context: str = "",
+                                  force: bool = False) -> None:
+    """
+    Logs the peak memory use of this process, if it has risen appreciably
+    since we last reported it (or regardless, if force is set).
+    """
+    global _last_reported_peak_bytes
+    peak = get_peak_memory_bytes()
+    if peak is None:
+        return
+    if (not force and
+            peak < _last_reported_peak_bytes * HIGH_WATER_MARK_REPORT_FACTOR):
+        return
+    _last_reported_peak_bytes = peak
+    log.info("Memory high-water mark: {:.1f} MiB{}".format(
+        peak / (1024 * 1024), " ({})".format(context) if context else ""))
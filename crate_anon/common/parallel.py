@@ -23,7 +23,9 @@
 """
 
 import logging
-from typing import Any
+import queue
+import threading
+from typing import Any, Callable, Generator, Iterable, List
 
 from crate_anon.common.hash import hash64
 
@@ -52,3 +54,162 @@ def is_my_job_by_hash(value: Any, tasknum: int, ntasks: int) -> bool:
     if ntasks == 1:
         return True
     return hash64(value) % ntasks == tasknum
+
+
+# =============================================================================
+# Pipelining with threads
+# =============================================================================
+# Threads overlap I/O (e.g. waiting on a database) with CPU work in the main
+# thread. Queues are bounded, so a fast producer is held back (backpressure)
+# rather than filling memory. Exceptions in a background thread are re-raised
+# in the main thread. Anything with thread affinity (e.g. a database
+# connection) must be created in the thread that uses it: hence the
+# background functions are passed as callables that are run in the thread.
+
+_QUEUE_POLL_INTERVAL_S = 0.1
+
+
+class _EndOfQueue(object):
+    pass
+
+
+class _QueuedException(object):
+    def __init__(self, exc: BaseException) -> None:
+        self.exc = exc
+
+
+def gen_prefetched(generator_fn: Callable[[], Iterable[Any]],
+                   chunksize: int = 100,
+                   max_chunks: int = 10,
+                   name: str = "prefetch") -> Generator[Any, None, None]:
+    """
+    Iterates over generator_fn() in a background thread, yielding its items
+    in the calling thread. Items are passed over in lists of up to chunksize,
+    with at most max_chunks lists waiting at any one time. If the consumer
+    stops early (or fails), the background thread is told to stop.
+    """
+    q = queue.Queue(maxsize=max_chunks)
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=_QUEUE_POLL_INTERVAL_S)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        try:
+            chunk = []  # type: List[Any]
+            for item in generator_fn():
+                chunk.append(item)
+                if len(chunk) >= chunksize:
+                    if not put(chunk):
+                        return
+                    chunk = []  # type: List[Any]
+            if chunk:
+                put(chunk)
+            put(_EndOfQueue)
+        except BaseException as exc:
+            put(_QueuedException(exc))
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = q.get()
+            if chunk is _EndOfQueue:
+                return
+            if isinstance(chunk, _QueuedException):
+                raise chunk.exc
+            yield from chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundConsumer(object):
+    """
+    Passes items, via a bounded queue, to process_fn(item) running in a
+    background thread. Call finish() to wait for all items to be processed
+    (then finish_fn() is called in the background thread), or abort() to give
+    up (then abort_fn() is called there instead). An exception in the
+    background thread is re-raised by the next put() or finish() (and any
+    after that); abort() just logs it.
+    """
+    def __init__(self,
+                 process_fn: Callable[[Any], None],
+                 finish_fn: Callable[[], None] = None,
+                 abort_fn: Callable[[], None] = None,
+                 maxsize: int = 10,
+                 name: str = "consumer") -> None:
+        self._process_fn = process_fn
+        self._finish_fn = finish_fn
+        self._abort_fn = abort_fn
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._aborting = threading.Event()
+        self._exc = None  # type: BaseException
+        self._exc_raised = False
+        self._thread = threading.Thread(target=self._consume, name=name,
+                                        daemon=True)
+        self._thread.start()
+
+    def _consume(self) -> None:
+        try:
+            while not self._aborting.is_set():
+                try:
+                    item = self._queue.get(timeout=_QUEUE_POLL_INTERVAL_S)
+                except queue.Empty:
+                    continue
+                if item is _EndOfQueue:
+                    if self._finish_fn:
+                        self._finish_fn()
+                    return
+                self._process_fn(item)
+        except BaseException as exc:
+            self._exc = exc
+        if self._abort_fn:
+            try:
+                self._abort_fn()
+            except BaseException as exc:
+                log.warning("Exception while aborting background "
+                            "consumer: {}".format(exc))
+
+    def _raise_if_failed(self) -> None:
+        # Keeps the exception, so every later call raises it too.
+        if self._exc is not None:
+            self._exc_raised = True
+            raise self._exc
+
+    def put(self, item: Any) -> None:
+        """Queue an item for processing; blocks if the queue is full."""
+        while True:
+            self._raise_if_failed()
+            if not self._thread.is_alive():
+                # It may have failed since we checked.
+                self._raise_if_failed()
+                raise RuntimeError("Background consumer has stopped")
+            try:
+                self._queue.put(item, timeout=_QUEUE_POLL_INTERVAL_S)
+                return
+            except queue.Full:
+                pass
+
+    def finish(self) -> None:
+        """Wait for all items to be processed."""
+        self.put(_EndOfQueue)
+        self._thread.join()
+        self._raise_if_failed()
+
+    def abort(self) -> None:
+        """
+        Stop, discarding any unprocessed items. Used when something else has
+        gone wrong, so doesn't raise; a background exception is just logged.
+        """
+        self._aborting.set()
+        self._thread.join()
+        if self._exc is not None and not self._exc_raised:
+            log.warning("Background consumer had failed: {}".format(
+                self._exc))
@@ -28,7 +28,7 @@ import datetime
 import functools
 import logging
 import re
-from typing import Any, Dict, Iterable, List, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
 
 from pyparsing import ParseResults
 from sqlalchemy import inspect
@@ -909,10 +909,15 @@ class ViewMaker(object):
 class TransactionSizeLimiter(object):
     def __init__(self, session: Session,
                  max_rows_before_commit: int = None,
-                 max_bytes_before_commit: int = None) -> None:
+                 max_bytes_before_commit: int = None,
+                 on_commit: Callable[[], None] = None) -> None:
+        """
+        on_commit: if given, called after each commit
+        """
         self._session = session
         self._max_rows_before_commit = max_rows_before_commit
         self._max_bytes_before_commit = max_bytes_before_commit
+        self._on_commit = on_commit
         self._bytes_in_transaction = 0
         self._rows_in_transaction = 0
 
@@ -921,6 +926,8 @@ class TransactionSizeLimiter(object):
             self._session.commit()
         self._bytes_in_transaction = 0
         self._rows_in_transaction = 0
+        if self._on_commit is not None:
+            self._on_commit()
 
     def notify(self, n_rows: int, n_bytes: int,
                force_commit: bool=False) -> None:
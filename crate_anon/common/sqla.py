@@ -134,6 +134,43 @@ def count_star(session: Union[Session, Engine, Connection],
     return session.execute(query).scalar()
 
 
+def estimate_count_star(session: Union[Session, Engine, Connection],
+                        tablename: str) -> int:
+    """
+    Estimates the number of rows in a table from the database's catalogue
+    statistics, which is much quicker than COUNT(*) for big tables but may be
+    out of date. Falls back to COUNT(*) for databases without such statistics
+    (e.g. SQLite), or if the statistics are missing.
+    """
+    if isinstance(session, Session):
+        dialect_name = session.get_bind().dialect.name
+    else:
+        dialect_name = session.dialect.name
+    if dialect_name == 'mysql':
+        # InnoDB's figure is approximate.
+        sql = """
+            SELECT table_rows FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name = :tablename
+        """
+    elif dialect_name == 'postgresql':
+        # As of the last VACUUM/ANALYZE.
+        sql = """
+            SELECT reltuples::BIGINT FROM pg_class
+            WHERE relname = :tablename AND pg_table_is_visible(oid)
+        """
+    elif dialect_name == 'mssql':
+        sql = """
+            SELECT SUM(p.rows) FROM sys.partitions AS p
+            WHERE p.object_id = OBJECT_ID(:tablename) AND p.index_id IN (0, 1)
+        """
+    else:
+        return count_star(session, tablename)
+    estimate = session.execute(text(sql), {'tablename': tablename}).scalar()
+    if estimate is None or estimate < 0:
+        return count_star(session, tablename)
+    return int(estimate)
+
+
 # -----------------------------------------------------------------------------
 # SELECT COUNT(*), MAX(field) (SQLAlchemy Core)
 # -----------------------------------------------------------------------------
@@ -275,7 +312,6 @@ def compile_insert_on_duplicate_key_update(insert: Insert,
     updates = ", ".join(
         ["{c} = VALUES({c})".format(c=c) for c in columns])
     s += ' ON DUPLICATE KEY UPDATE {}'.format(updates)
-    log.critical(s)
     return s
 
 
@@ -473,6 +509,13 @@ def mssql_transaction_count(engine_or_conn: Union[Connection, Engine]) -> int:
         return row[0] if row else None
 
 
+def make_index_name(colnames: List[str], fulltext: bool = False) -> str:
+    """
+    Name of the index that add_index() makes on these columns.
+    """
+    return "{}_{}".format("_idxft" if fulltext else "_idx", "_".join(colnames))
+
+
 def add_index(engine: Engine,
               sqla_column: Column = None,
               multiple_sqla_columns: List[Column] = None,
@@ -514,13 +557,10 @@ def add_index(engine: Engine,
                 "multiple_sqla_columns = {}".format(
                     repr(multiple_sqla_columns)))
 
-    if fulltext:
-        if is_mssql:
-            idxname = ''  # they are unnamed
-        else:
-            idxname = "_idxft_{}".format("_".join(colnames))
+    if fulltext and is_mssql:
+        idxname = ''  # they are unnamed
     else:
-        idxname = "_idx_{}".format("_".join(colnames))
+        idxname = make_index_name(colnames, fulltext=fulltext)
     if idxname and index_exists(engine, tablename, idxname):
         log.info("Skipping creation of index {} on table {}; already "
                  "exists".format(idxname, tablename))
@@ -614,6 +654,32 @@ def add_index(engine: Engine,
     # Index creation doesn't require a commit.
 
 
+def drop_index(engine: Engine,
+               sqla_column: Column,
+               fulltext: bool = False) -> None:
+    """
+    Drops an index made by add_index() on a single column, if it exists.
+    Under SQL Server, a full-text index covers the whole table, and dropping
+    it for one column drops it for all.
+    """
+    tablename = sqla_column.table.name
+    if fulltext and engine.dialect.name == 'mssql':
+        schemaname = engine.schema_for_object(sqla_column.table) or MSSQL_DEFAULT_SCHEMA  # noqa
+        if mssql_table_has_ft_index(engine=engine,
+                                    tablename=tablename,
+                                    schemaname=schemaname):
+            log.info("Dropping full-text index on table {}".format(tablename))
+            sql = "DROP FULLTEXT INDEX ON {}".format(
+                quote_identifier(tablename, engine))
+            DDL(sql, bind=engine).execute()
+        return
+    idxname = make_index_name([sqla_column.name], fulltext=fulltext)
+    if not index_exists(engine, tablename, idxname):
+        return
+    log.info("Dropping index {} on table {}".format(idxname, tablename))
+    Index(idxname, sqla_column).drop(engine)
+
+
 # =============================================================================
 # More DDL
 # =============================================================================
@@ -299,7 +299,6 @@ class InputFieldConfig(object):
             FN_SRCPKFIELD: self._srcpkfield,
             FN_SRCFIELD: self._srcfield,
         }
-        session = self.get_source_session()
         pkcol = column(self._srcpkfield)
         # ... don't use is_sqlatype_integer with this; it's a column clause,
         # not a full column definition.
@@ -323,7 +322,7 @@ class InputFieldConfig(object):
         nrows_returned = 0
         hashed_pk = None  # remove warning about reference before assignment
         with MultiTimerContext(timer, TIMING_GEN_TEXT_SQL_SELECT):
-            result = session.execute(query)
+            result = self._db.gen_query_rows(query)
             for row in result:  # ... a generator itself
                 with MultiTimerContext(timer, TIMING_PROCESS_GEN_TEXT):
                     pkval = row[0]
@@ -394,12 +393,11 @@ class InputFieldConfig(object):
         InputFieldConfig.
         Timing is subsumed under TIMING_DELETE_WHERE_NO_SOURCE.
         """
-        session = self.get_source_session()
         query = (
             select([column(self._srcpkfield)]).
             select_from(table(self._srctable))
         )
-        result = session.execute(query)
+        result = self._db.gen_query_rows(query)
         if self.is_pk_integer():
             for row in result:
                 yield row[0], None